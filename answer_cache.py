@@ -0,0 +1,274 @@
+"""
+Persistent NL→SQL answer cache
+Generated SQL is stored in a local SQLite file keyed on the normalized
+question, the app mode and the schema fingerprint. A question is answered
+from the cache when its normalized text matches exactly, or when its embedding
+is within ANSWER_CACHE_SIMILARITY of a cached question that mentions the same
+numbers ("top 5" never reuses the SQL for "top 10"). Entries expire after
+ANSWER_CACHE_TTL seconds, the least recently used are evicted beyond
+ANSWER_CACHE_MAX_ENTRIES, and a schema change drops every entry built for the
+old schema.
+"""
+
+import json
+import logging
+import re
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+
+import tracing
+from config import get_float_setting, get_int_setting, get_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = Path(__file__).parent / "answer_cache.db"
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_ENTRIES = 5000
+DEFAULT_SIMILARITY = 0.95
+
+CacheHit = namedtuple("CacheHit", ["response", "kind", "score", "question"])
+
+_cache = None
+_cache_lock = threading.Lock()
+_last = threading.local()
+
+
+def numbers_in(text):
+    """Numeric literals of a question, which must match for a near-duplicate hit"""
+    return " ".join(re.findall(r"\d+(?:\.\d+)?", text))
+
+
+class AnswerCache:
+    """SQLite-backed cache of generated answers with exact and embedding lookup"""
+
+    def __init__(self, path, ttl=DEFAULT_TTL, max_entries=DEFAULT_MAX_ENTRIES, similarity=DEFAULT_SIMILARITY):
+        self.path = Path(path)
+        self.ttl = ttl
+        self.max_entries = max(1, max_entries)
+        self.similarity = similarity
+        self._lock = threading.Lock()
+        # (mode, fingerprint) -> (keys, numbers, embedding matrix) for near-duplicate search
+        self._vectors = {}
+        self._fingerprint = None
+        self.exact_hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS answers (
+    mode TEXT NOT NULL,
+    question_key TEXT NOT NULL,
+    fingerprint TEXT NOT NULL,
+    question TEXT,
+    numbers TEXT,
+    response TEXT NOT NULL,
+    embedding BLOB,
+    created_at REAL NOT NULL,
+    last_used_at REAL NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (mode, question_key, fingerprint)
+)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_answers_last_used ON answers (last_used_at)")
+
+    def _cutoff(self):
+        return time.time() - self.ttl if self.ttl > 0 else float("-inf")
+
+    def _check_fingerprint(self, fingerprint):
+        """Drop entries built for any other schema the first time a new fingerprint is seen"""
+        if fingerprint != self._fingerprint:
+            deleted = self._conn.execute("DELETE FROM answers WHERE fingerprint != ?", (fingerprint,)).rowcount
+            if deleted:
+                logger.info("Schema changed: dropped %d cached answers", deleted)
+            self._vectors.clear()
+            self._fingerprint = fingerprint
+
+    def _semantic_index(self, mode, fingerprint):
+        """Embeddings of the live entries for one mode and schema (loaded lazily)"""
+        key = (mode, fingerprint)
+        if key not in self._vectors:
+            rows = self._conn.execute(
+                "SELECT question_key, numbers, embedding FROM answers "
+                "WHERE mode = ? AND fingerprint = ? AND embedding IS NOT NULL AND created_at >= ?",
+                (mode, fingerprint, self._cutoff())
+            ).fetchall()
+            if rows:
+                matrix = np.stack([np.frombuffer(row[2], dtype=np.float32) for row in rows])
+            else:
+                matrix = np.zeros((0, 0), dtype=np.float32)
+            self._vectors[key] = ([row[0] for row in rows], [row[1] for row in rows], matrix)
+        return self._vectors[key]
+
+    def lookup(self, question_key, mode, fingerprint, embedding=None):
+        """CacheHit for the question, or None (records hit / miss counters)"""
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            cutoff = self._cutoff()
+            kind, score, matched_key = "exact", 1.0, question_key
+            row = self._conn.execute(
+                "SELECT response, question FROM answers "
+                "WHERE mode = ? AND question_key = ? AND fingerprint = ? AND created_at >= ?",
+                (mode, question_key, fingerprint, cutoff)
+            ).fetchone()
+
+            if row is None and embedding is not None:
+                keys, numbers, matrix = self._semantic_index(mode, fingerprint)
+                if len(keys) and matrix.shape[1] == len(embedding):
+                    scores = matrix @ np.asarray(embedding, dtype=np.float32)
+                    wanted = numbers_in(question_key)
+                    for i in np.argsort(-scores):
+                        if scores[i] < self.similarity:
+                            break
+                        if numbers[i] == wanted:
+                            kind, score, matched_key = "semantic", float(scores[i]), keys[i]
+                            row = self._conn.execute(
+                                "SELECT response, question FROM answers "
+                                "WHERE mode = ? AND question_key = ? AND fingerprint = ? AND created_at >= ?",
+                                (mode, matched_key, fingerprint, cutoff)
+                            ).fetchone()
+                            break
+
+            if row is None:
+                self.misses += 1
+                return None
+
+            self._conn.execute(
+                "UPDATE answers SET last_used_at = ?, hits = hits + 1 "
+                "WHERE mode = ? AND question_key = ? AND fingerprint = ?",
+                (time.time(), mode, matched_key, fingerprint)
+            )
+            if kind == "exact":
+                self.exact_hits += 1
+            else:
+                self.semantic_hits += 1
+            return CacheHit(json.loads(row[0]), kind, score, row[1])
+
+    def store(self, question_key, question, mode, fingerprint, response, embedding=None):
+        """Insert or replace an answer, then apply TTL and LRU eviction"""
+        now = time.time()
+        blob = np.asarray(embedding, dtype=np.float32).tobytes() if embedding is not None else None
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            self._conn.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 0)",
+                (mode, question_key, fingerprint, question, numbers_in(question_key),
+                 json.dumps(response), blob, now, now)
+            )
+            self._conn.execute("DELETE FROM answers WHERE created_at < ?", (self._cutoff(),))
+            self._conn.execute(
+                "DELETE FROM answers WHERE rowid IN "
+                "(SELECT rowid FROM answers ORDER BY last_used_at DESC LIMIT -1 OFFSET ?)",
+                (self.max_entries,)
+            )
+            self._vectors.pop((mode, fingerprint), None)
+
+    def clear(self):
+        """Remove every entry"""
+        with self._lock:
+            self._conn.execute("DELETE FROM answers")
+            self._vectors.clear()
+
+    def stats(self):
+        """Entry count, exact / semantic hits, misses and hit rate"""
+        with self._lock:
+            entries = self._conn.execute("SELECT COUNT(*) FROM answers").fetchone()[0]
+            hits = self.exact_hits + self.semantic_hits
+            lookups = hits + self.misses
+            return {
+                "entries": entries,
+                "max_entries": self.max_entries,
+                "exact_hits": self.exact_hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0
+            }
+
+
+def is_enabled():
+    """ANSWER_CACHE_ENABLED setting (default on)"""
+    return str(get_setting("ANSWER_CACHE_ENABLED", "true")).lower() not in ("0", "false", "no", "off")
+
+
+def get_answer_cache():
+    """Process-wide answer cache, or None when disabled or the file cannot be opened"""
+    global _cache
+    if _cache is None and is_enabled():
+        with _cache_lock:
+            if _cache is None:
+                try:
+                    _cache = AnswerCache(
+                        get_setting("ANSWER_CACHE_PATH", DEFAULT_CACHE_PATH),
+                        ttl=get_float_setting("ANSWER_CACHE_TTL", DEFAULT_TTL),
+                        max_entries=get_int_setting("ANSWER_CACHE_MAX_ENTRIES", DEFAULT_MAX_ENTRIES),
+                        similarity=get_float_setting("ANSWER_CACHE_SIMILARITY", DEFAULT_SIMILARITY)
+                    )
+                except sqlite3.Error as e:
+                    logger.warning("Answer cache unavailable: %s", e)
+                    return None
+    return _cache if is_enabled() else None
+
+
+def question_embedding(question):
+    """Embedding used for near-duplicate matching (None if the model is unavailable)"""
+    import retrieval
+    try:
+        return retrieval.embed_query(question)
+    except Exception:
+        return None
+
+
+def lookup(question, mode, schema_info, embedding=None):
+    """Cached answer for the question under this schema, or None (embedding: precomputed question embedding)"""
+    _last.hit = None
+    cache = get_answer_cache()
+    if cache is None:
+        return None
+    from retrieval import normalize_question
+    from schema_cache import schema_fingerprint
+    try:
+        if embedding is None:
+            embedding = question_embedding(question)
+        hit = cache.lookup(normalize_question(question), mode, schema_fingerprint(schema_info), embedding)
+    except sqlite3.Error as e:
+        logger.warning("Answer cache lookup failed: %s", e)
+        return None
+    _last.hit = hit
+    tracing.annotate(cache_hit=hit.kind if hit is not None else "miss")
+    return hit
+
+
+def store(question, mode, schema_info, response, sql):
+    """
+    Cache an answer whose SQL already passed validation
+    The engine only stores SQL its validation (and repair) accepted, so this does
+    not run EXPLAIN again.
+    """
+    cache = get_answer_cache()
+    if cache is None or not sql:
+        return False
+    from retrieval import normalize_question
+    from schema_cache import schema_fingerprint
+    try:
+        cache.store(normalize_question(question), question, mode, schema_fingerprint(schema_info),
+                    response, question_embedding(question))
+    except sqlite3.Error as e:
+        logger.warning("Answer cache write failed: %s", e)
+        return False
+    return True
+
+
+def last_hit():
+    """CacheHit of the latest lookup in this thread (None on a miss)"""
+    return getattr(_last, "hit", None)
+
+
+def get_stats():
+    """Answer cache statistics, or None when disabled"""
+    cache = get_answer_cache()
+    return cache.stats() if cache is not None else None
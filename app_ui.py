@@ -0,0 +1,103 @@
+"""
+Streamlit helpers shared by streamlit_app.py and streamlit_app_advanced.py
+Query execution with a cancel button, the cost warning / confirmation, paged
+result display and export downloads, all keyed on st.session_state.
+"""
+
+import streamlit as st
+
+import engine
+import export
+import query_cost
+import visualization
+
+
+def execute_sql_query(sql_query):
+    """Execute SQL query and return its first page of results (a database.PagedResult) with timing"""
+    # Clicking Cancel reruns the script, which interrupts the query (see engine.execute_with_cancel)
+    cancel_placeholder = st.empty()
+    cancel_placeholder.button("⏹️ Cancel Query", key="cancel_query")
+    progress_placeholder = st.empty()
+    try:
+        result, error, execution_time, cache_hit = engine.execute_with_cancel(
+            sql_query,
+            on_wait=lambda elapsed: progress_placeholder.caption(f"⏳ Running for {elapsed:.1f}s..."),
+            paged=True
+        )
+    except BaseException:
+        st.session_state.query_cancelled = True
+        raise
+    finally:
+        cancel_placeholder.empty()
+        progress_placeholder.empty()
+    st.session_state.result_cache_hit = cache_hit
+    return result, error, execution_time
+
+
+def get_cost_estimate(sql_query):
+    """Planner cost estimate of the SQL (the one made during generation unless the SQL changed since)"""
+    cost = st.session_state.get('cost')
+    if cost and cost[0] == sql_query:
+        return cost[1]
+    estimate, _ = query_cost.estimate_query_cost(sql_query)
+    st.session_state.cost = (sql_query, estimate)
+    return estimate
+
+
+def confirm_cost(sql_query, estimate):
+    """Warn about expensive SQL; False while SQL over COST_CONFIRM_ROWS awaits confirmation"""
+    if estimate is None or estimate.cost_class in query_cost.COST_CLASSES[:2]:
+        return True
+    if not estimate.needs_confirmation:
+        st.warning(f"⚠️ Expensive query: {query_cost.describe(estimate)}")
+        return True
+    st.error(f"🛑 {query_cost.held_message(estimate)}")
+    return st.checkbox("Run it anyway", key=f"cost_confirm_{hash(sql_query)}")
+
+
+def row_count_label(result):
+    """Row count of a paged result, or "N+" while more rows remain unfetched"""
+    return f"{result.total_rows:,}" if result.exhausted else f"{result.fetched_rows:,}+"
+
+
+def render_result_page(result):
+    """Show one page of a paged result; later pages are fetched when selected"""
+    max_page = result.page_count or result.fetched_rows // result.page_size + 1
+    page = st.number_input("Page", min_value=1, max_value=max_page, value=1, step=1, key="result_page")
+    df_page = result.page(page - 1)
+    st.dataframe(df_page, use_container_width=True)
+    first_row = (page - 1) * result.page_size
+    st.caption(f"Rows {first_row + 1:,}–{first_row + len(df_page):,} of {row_count_label(result)}")
+    if result.truncated:
+        st.warning(f"⚠️ Result truncated to the first {result.total_rows:,} rows")
+
+
+def set_last_result(result):
+    """Replace the session's result, releasing the previous one's cursor"""
+    previous = st.session_state.get('last_result')
+    if previous is not None:
+        previous.close()
+        export.discard(previous.result_id)
+        visualization.discard(previous.result_id)
+    st.session_state.last_result = result
+
+
+def render_export(result, file_stem):
+    """Format picker plus download button; the file is only built when requested"""
+    fmt = st.selectbox("Export format", export.available_formats(),
+                       format_func=lambda f: export.FORMATS[f].label, key="export_format")
+    spec = export.FORMATS[fmt]
+    data = export.cached_export(result, fmt)
+    if data is None and st.button(f"📦 Prepare {spec.label}", use_container_width=True):
+        with st.spinner("⏳ Exporting..."):
+            data, error = export.export_result(result, fmt)
+        if error:
+            st.error(f"❌ {error}")
+    if data is not None:
+        st.download_button(
+            label=f"⬇️ Download {spec.label}",
+            data=data,
+            file_name=f"{file_stem}{spec.extension}",
+            mime=spec.mime,
+            use_container_width=True
+        )
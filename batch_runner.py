@@ -0,0 +1,126 @@
+"""
+Headless batch runner for the Text-to-SQL engine
+Reads questions from a JSONL file, answers them with concurrent workers and
+writes one JSON result (SQL, rows, per-stage timings) per line.
+
+Usage:
+    python batch_runner.py questions.jsonl -o results.jsonl --workers 8
+
+Each input line is a JSON object; the question is taken from --question-field
+(default: the first of "question", "query", "body", "title" that is present) and
+the id from "id" or "request_id" (default: the line number).
+"""
+
+import argparse
+import json
+import logging
+import sys
+import time
+from collections import deque
+
+import answer_cache
+import retrieval
+import tracing
+from engine import STAGES, run_batch
+
+DEFAULT_QUESTION_FIELDS = ("question", "query", "body", "title")
+DEFAULT_ID_FIELDS = ("id", "request_id")
+
+
+def read_questions(path, question_field=None):
+    """Yield (id, question) pairs from a JSONL file, skipping blank lines"""
+    fields = (question_field,) if question_field else DEFAULT_QUESTION_FIELDS
+    with open(path, encoding="utf-8") as f:
+        for line_no, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            record = json.loads(line)
+            question = next((record[field] for field in fields if record.get(field)), None)
+            if question is None:
+                raise ValueError(f"{path}:{line_no}: no question field ({', '.join(fields)})")
+            record_id = next((record[field] for field in DEFAULT_ID_FIELDS if field in record), line_no)
+            yield record_id, question
+
+
+def summarize(results_count, error_count, stage_totals, elapsed):
+    """Print throughput and mean per-stage latency to stderr"""
+    print(f"✓ {results_count} questions in {elapsed:.2f}s "
+          f"({results_count / elapsed if elapsed else 0:.2f} q/s), {error_count} errors", file=sys.stderr)
+    for stage in STAGES:
+        count, total = stage_totals.get(stage, (0, 0.0))
+        if count:
+            print(f"  {stage:<11} mean {total / count:9.1f} ms", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run NL→SQL over a JSONL file of questions")
+    parser.add_argument("input", help="JSONL file of questions")
+    parser.add_argument("-o", "--output", help="JSONL results file (default: stdout)")
+    parser.add_argument("-w", "--workers", type=int, default=4, help="concurrent workers (default: 4)")
+    parser.add_argument("--mode", choices=["basic", "advanced"], default="basic",
+                        help="basic = SQL only, advanced = SQL plus complexity metadata")
+    parser.add_argument("--question-field", help="JSON field holding the question")
+    parser.add_argument("--max-rows", type=int, default=100, help="result rows to keep per question (default: 100)")
+    parser.add_argument("--no-execute", action="store_true", help="generate and validate only")
+    parser.add_argument("--allow-expensive", action="store_true",
+                        help="also execute SQL whose estimated cost is over COST_CONFIRM_ROWS")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(name)s: %(message)s")
+    retrieval.start_warmup()
+    tracing.start_metrics_server()
+
+    # Questions stream into run_batch as it schedules them; their ids queue up in
+    # the same order, so each in-order result takes the oldest one
+    pending_ids = deque()
+
+    def questions():
+        for record_id, question in read_questions(args.input, args.question_field):
+            pending_ids.append(record_id)
+            yield question
+
+    out = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    result_count = 0
+    error_count = 0
+    stage_totals = {}
+    start = time.perf_counter()
+    try:
+        results = run_batch(
+            questions(),
+            workers=args.workers,
+            mode=args.mode,
+            execute=not args.no_execute,
+            max_rows=args.max_rows,
+            allow_expensive=args.allow_expensive
+        )
+        for result in results:
+            result = {"id": pending_ids.popleft(), **result}
+            result_count += 1
+            if result["error"]:
+                error_count += 1
+            for stage, ms in result["timings"].items():
+                count, total = stage_totals.get(stage, (0, 0.0))
+                stage_totals[stage] = (count + 1, total + ms)
+            out.write(json.dumps(result, default=str) + "\n")
+            out.flush()
+    finally:
+        if out is not sys.stdout:
+            out.close()
+
+    summarize(result_count, error_count, stage_totals, time.perf_counter() - start)
+    embedding_stats = retrieval.get_embedding_stats()
+    if embedding_stats['model_loaded']:
+        cache_stats = embedding_stats['cache']
+        print(f"  embedding model loaded in {embedding_stats['model_load_seconds']:.2f}s, "
+              f"cache hit rate {cache_stats['hit_rate']:.0%} ({cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']})",
+              file=sys.stderr)
+    answer_stats = answer_cache.get_stats()
+    if answer_stats:
+        print(f"  answer cache: {answer_stats['exact_hits']} exact + {answer_stats['semantic_hits']} near-duplicate hits, "
+              f"{answer_stats['misses']} misses ({answer_stats['hit_rate']:.0%})", file=sys.stderr)
+    return 1 if error_count == result_count and result_count else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,372 @@
+"""
+Benchmark harness for the NL→SQL pipeline
+Runs the graded questions of EVALUATION_DATASET.md through the full headless
+pipeline (engine.run_batch) and reports execution accuracy - the generated
+query returns the same rows as the gold SQL - plus p50 / p95 latency of every
+stage (retrieval, prompt build, generation, validation, execution, ...).
+
+By default the LLM is replaced by RecordedLLM, a deterministic stand-in that
+replays recorded replies (falling back to the gold SQL), so the benchmark runs
+offline and measures the pipeline rather than the model. --llm record captures
+live Azure OpenAI replies into the recordings file for later replay. The answer
+and result caches are disabled unless --with-caches is given.
+
+Usage:
+    python benchmark.py --repeat 5 -o report.json
+    python benchmark.py --baseline report.json        # exit 1 on a regression
+    python benchmark.py --llm record --recordings benchmark_recordings.json
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path
+
+import numpy as np
+
+DATASET_PATH = Path(__file__).parent / "EVALUATION_DATASET.md"
+DEFAULT_RECORDINGS_PATH = Path(__file__).parent / "benchmark_recordings.json"
+
+# p95 may grow by this fraction (and DEFAULT_MIN_DELTA_MS) before it counts as a regression
+DEFAULT_TOLERANCE = 0.25
+DEFAULT_MIN_DELTA_MS = 2.0
+
+BenchmarkCase = namedtuple("BenchmarkCase", ["number", "difficulty", "category", "question", "sql"])
+
+QUESTION_HEADER = re.compile(r"^### Question (\d+)\s*$", re.MULTILINE)
+PROMPT_QUESTION = re.compile(r"^USER QUERY: (.*)$", re.MULTILINE)
+
+
+def parse_dataset(path=DATASET_PATH):
+    """BenchmarkCase per "### Question N" section of the evaluation dataset"""
+    text = Path(path).read_text(encoding="utf-8")
+    headers = list(QUESTION_HEADER.finditer(text))
+    cases = {}
+    for i, header in enumerate(headers):
+        section = text[header.end():headers[i + 1].start() if i + 1 < len(headers) else len(text)]
+        difficulty = re.search(r"\*\*Difficulty:\*\*\s*(.+)", section)
+        category = re.search(r"\*\*Category:\*\*\s*(.+)", section)
+        question = re.search(r"\*\*NLP Query:\*\*\s*\"(.+?)\"", section, re.DOTALL)
+        sql = re.search(r"```sql\s*\n(.*?)```", section, re.DOTALL)
+        if not question or not sql:
+            raise ValueError(f"{path}: question {header.group(1)} has no NLP query or SQL block")
+        number = int(header.group(1))
+        cases[number] = BenchmarkCase(
+            number,
+            difficulty.group(1).strip() if difficulty else "",
+            category.group(1).strip() if category else "",
+            question.group(1).strip(),
+            sql.group(1).strip()
+        )
+    return [cases[number] for number in sorted(cases)]
+
+
+def prompt_question(prompt):
+    """The user question a generation prompt was built for"""
+    from retrieval import normalize_question
+    matches = PROMPT_QUESTION.findall(prompt)
+    return normalize_question(matches[-1]) if matches else ""
+
+
+def prompt_mode(prompt):
+    """ "advanced" for the SQL-plus-metadata prompt, else "basic" ("_repair" appended for repair prompts)"""
+    mode = "advanced" if '"complexity"' in prompt or "COMPLEXITY:" in prompt else "basic"
+    return mode + "_repair" if "PREVIOUS ATTEMPT" in prompt else mode
+
+
+def gold_reply(case, mode):
+    """The reply a perfect model would give for a case in the given mode's format"""
+    if not mode.startswith("advanced"):
+        return case.sql
+    complexity = {"Easy": "Simple", "Medium": "Medium", "Hard": "Complex"}.get(case.difficulty, "Medium")
+    return json.dumps({"sql": case.sql, "complexity": complexity, "estimated_rows": 0, "notes": "gold answer"})
+
+
+class RecordedLLM:
+    """
+    Deterministic stand-in for the LLM
+    Replies are looked up by prompt mode and question: recorded replies first,
+    then the gold SQL of a dataset case. latency (seconds) is slept per call to
+    simulate model time; an unknown question raises LookupError.
+    """
+
+    def __init__(self, recordings=None, cases=(), latency=0.0):
+        from retrieval import normalize_question
+        self.recordings = recordings or {}
+        self.cases = {normalize_question(case.question): case for case in cases}
+        self.latency = latency
+        self.calls = 0
+        self.replayed = 0
+
+    def __call__(self, prompt):
+        mode, question = prompt_mode(prompt), prompt_question(prompt)
+        self.calls += 1
+        reply = self.recordings.get(mode, {}).get(question)
+        if reply is not None:
+            self.replayed += 1
+        elif question in self.cases:
+            reply = gold_reply(self.cases[question], mode)
+        else:
+            raise LookupError(f"No recorded reply for question: {question}")
+        if self.latency > 0:
+            time.sleep(self.latency)
+        return reply
+
+
+class RecordingLLM:
+    """Pass-through to Azure OpenAI that keeps every reply for RecordedLLM"""
+
+    def __init__(self, recordings=None):
+        self.recordings = recordings or {}
+        self._lock = threading.Lock()
+
+    def __call__(self, prompt):
+        from generation import azure_complete
+        reply = azure_complete(prompt)
+        with self._lock:
+            self.recordings.setdefault(prompt_mode(prompt), {})[prompt_question(prompt)] = reply
+        return reply
+
+    def save(self, path):
+        Path(path).write_text(json.dumps(self.recordings, indent=2, sort_keys=True), encoding="utf-8")
+
+
+def load_recordings(path):
+    """{mode: {question: reply}} from a recordings file ({} if it does not exist)"""
+    path = Path(path)
+    if not path.exists():
+        return {}
+    return json.loads(path.read_text(encoding="utf-8"))
+
+
+def frame_rows(df):
+    """Rows of a DataFrame as JSON values, the form answer_question reports them in"""
+    return json.loads(df.to_json(orient="values", date_format="iso"))
+
+
+def _normalize_row(row):
+    return tuple(round(value, 4) if isinstance(value, float) else value for value in row)
+
+
+def rows_match(rows, gold_rows, ordered):
+    """Execution accuracy check: same rows (column names ignored), in order when the gold SQL sorts"""
+    if rows is None or len(rows) != len(gold_rows):
+        return False
+    rows = [_normalize_row(row) for row in rows]
+    gold_rows = [_normalize_row(row) for row in gold_rows]
+    if ordered:
+        return rows == gold_rows
+    return sorted(rows, key=repr) == sorted(gold_rows, key=repr)
+
+
+def gold_results(cases):
+    """
+    Execute every gold query
+    Returns ({case number: (rows, ordered)}, {case number: error}) - gold SQL that
+    does not run on SQLite cannot grade anything, so those cases are skipped.
+    Gold SQL runs exactly as written on a pooled read-only connection, bypassing
+    the result cache and the rollup rewrite, so a wrong rewrite of the generated
+    SQL shows up as a mismatch.
+    """
+    import database
+    from config import get_int_setting
+
+    max_rows = get_int_setting("QUERY_MAX_ROWS", database.DEFAULT_QUERY_MAX_ROWS)
+    results, errors = {}, {}
+    for case in cases:
+        guard = database.QueryGuard()
+        try:
+            with database.pooled_connection() as conn:
+                guard.attach(conn)
+                try:
+                    df = database.fetch_dataframe(conn, case.sql, max_rows)
+                finally:
+                    guard.detach(conn)
+        except sqlite3.Error as e:
+            errors[case.number] = guard.error_message() if guard.stopped else str(e)
+            continue
+        ordered = re.search(r"\bORDER\s+BY\b", case.sql, re.IGNORECASE) is not None
+        results[case.number] = (frame_rows(df), ordered)
+    return results, errors
+
+
+def percentile_summary(values):
+    """{"count", "mean", "p50", "p95"} of a list of milliseconds"""
+    if not values:
+        return {"count": 0, "mean": None, "p50": None, "p95": None}
+    values = np.asarray(values, dtype=float)
+    return {
+        "count": int(len(values)),
+        "mean": round(float(values.mean()), 3),
+        "p50": round(float(np.percentile(values, 50)), 3),
+        "p95": round(float(np.percentile(values, 95)), 3)
+    }
+
+
+def run_benchmark(cases, mode="basic", workers=1, repeat=3, warmup=1):
+    """
+    Answer every case warmup + repeat times; only the repeat rounds are measured
+    Returns the report dict: accuracy overall and by difficulty, per-stage
+    latency percentiles, the per-case results of the last round and the cases
+    skipped because their gold SQL fails.
+    """
+    from engine import STAGES, run_batch
+
+    gold, gold_errors = gold_results(cases)
+    cases = [case for case in cases if case.number in gold]
+    stage_times = {stage: [] for stage in STAGES}
+    correct = 0
+    total = 0
+    llm_calls = 0
+    by_difficulty = {}
+    last_round = []
+
+    for round_no in range(warmup + repeat):
+        measured = round_no >= warmup
+        # Accuracy is measured on every answer, however expensive its plan looks
+        results = run_batch((case.question for case in cases), workers=workers, mode=mode,
+                            execute=True, max_rows=None, allow_expensive=True)
+        round_cases = []
+        for case, result in zip(cases, results):
+            gold_rows, ordered = gold[case.number]
+            ok = not result["error"] and rows_match(result["rows"], gold_rows, ordered)
+            round_cases.append({
+                "number": case.number,
+                "difficulty": case.difficulty,
+                "question": case.question,
+                "sql": result["sql"],
+                "correct": ok,
+                "error": result["error"],
+                "attempts": len(result["attempts"]),
+                "timings": result["timings"]
+            })
+            if not measured:
+                continue
+            total += 1
+            correct += ok
+            llm_calls += sum(1 for attempt in result["attempts"] if attempt["kind"] != "cache")
+            stats = by_difficulty.setdefault(case.difficulty, [0, 0])
+            stats[0] += ok
+            stats[1] += 1
+            for stage, ms in result["timings"].items():
+                stage_times.setdefault(stage, []).append(ms)
+        last_round = round_cases
+
+    return {
+        "mode": mode,
+        "workers": workers,
+        "repeat": repeat,
+        "questions": len(cases),
+        "accuracy": correct / total if total else 0.0,
+        "llm_calls_per_question": llm_calls / total if total else 0.0,
+        "accuracy_by_difficulty": {level: hits / count for level, (hits, count) in by_difficulty.items()},
+        "stages": {stage: percentile_summary(values) for stage, values in stage_times.items()},
+        "cases": last_round,
+        "skipped": {number: f"gold SQL fails: {error}" for number, error in gold_errors.items()}
+    }
+
+
+def find_regressions(report, baseline, tolerance=DEFAULT_TOLERANCE, min_delta_ms=DEFAULT_MIN_DELTA_MS):
+    """Human-readable list of stage p95 increases and accuracy drops relative to a baseline report"""
+    regressions = []
+    if report["accuracy"] < baseline.get("accuracy", 0.0):
+        regressions.append(f"accuracy {baseline['accuracy']:.0%} → {report['accuracy']:.0%}")
+    for stage, stats in report["stages"].items():
+        old = baseline.get("stages", {}).get(stage, {}).get("p95")
+        new = stats["p95"]
+        if old is None or new is None:
+            continue
+        if new > old * (1 + tolerance) and new - old > min_delta_ms:
+            regressions.append(f"{stage} p95 {old:.1f} ms → {new:.1f} ms (+{(new - old) / old if old else 0:.0%})")
+    return regressions
+
+
+def summarize(report):
+    """Print accuracy and the per-stage latency table to stderr"""
+    print(f"✓ {report['questions']} questions × {report['repeat']} rounds ({report['mode']} mode, "
+          f"{report['workers']} workers): execution accuracy {report['accuracy']:.0%}, "
+          f"{report['llm_calls_per_question']:.2f} LLM calls per question", file=sys.stderr)
+    for level, accuracy in report["accuracy_by_difficulty"].items():
+        print(f"  {level:<11} {accuracy:6.0%}", file=sys.stderr)
+    print(f"  {'stage':<11} {'p50 ms':>9} {'p95 ms':>9} {'mean ms':>9}", file=sys.stderr)
+    for stage, stats in report["stages"].items():
+        if stats["count"]:
+            print(f"  {stage:<11} {stats['p50']:9.1f} {stats['p95']:9.1f} {stats['mean']:9.1f}", file=sys.stderr)
+    failed = [case for case in report["cases"] if not case["correct"]]
+    for case in failed:
+        print(f"  ✗ Q{case['number']}: {case['error'] or 'result differs from gold SQL'}", file=sys.stderr)
+    for number, reason in report["skipped"].items():
+        print(f"  – Q{number} skipped: {reason}", file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the NL→SQL pipeline on EVALUATION_DATASET.md")
+    parser.add_argument("--dataset", default=str(DATASET_PATH), help="evaluation dataset (markdown)")
+    parser.add_argument("--mode", choices=["basic", "advanced"], default="basic")
+    parser.add_argument("-w", "--workers", type=int, default=1, help="concurrent questions (default: 1)")
+    parser.add_argument("--repeat", type=int, default=3, help="measured rounds (default: 3)")
+    parser.add_argument("--warmup", type=int, default=1, help="unmeasured rounds first (default: 1)")
+    parser.add_argument("--llm", choices=["recorded", "live", "record"], default="recorded",
+                        help="recorded = offline replay (default), live = Azure OpenAI, "
+                             "record = Azure OpenAI and save the replies")
+    parser.add_argument("--recordings", default=str(DEFAULT_RECORDINGS_PATH), help="recorded replies (JSON)")
+    parser.add_argument("--llm-latency", type=float, default=0.0,
+                        help="simulated model time per recorded reply, in ms")
+    parser.add_argument("--with-caches", action="store_true", help="keep the answer and result caches on")
+    parser.add_argument("-o", "--output", help="write the JSON report here")
+    parser.add_argument("--baseline", help="JSON report to compare against; exit 1 on a regression")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help=f"allowed p95 growth as a fraction (default: {DEFAULT_TOLERANCE})")
+    args = parser.parse_args(argv)
+
+    # Offline runs have no embedding model; the pipeline falls back to the full schema quietly
+    logging.basicConfig(level=logging.ERROR, format="%(levelname)s %(name)s: %(message)s")
+    if not args.with_caches:
+        os.environ["ANSWER_CACHE_ENABLED"] = "false"
+        os.environ["RESULT_CACHE_MAX_MB"] = "0"
+
+    import generation
+
+    cases = parse_dataset(args.dataset)
+    recorder = None
+    if args.llm == "recorded":
+        generation.set_llm_backend(RecordedLLM(load_recordings(args.recordings), cases, args.llm_latency / 1000))
+    elif args.llm == "record":
+        recorder = RecordingLLM(load_recordings(args.recordings))
+        generation.set_llm_backend(recorder)
+
+    try:
+        report = run_benchmark(cases, args.mode, args.workers, args.repeat, args.warmup)
+    finally:
+        generation.set_llm_backend(None)
+        if recorder is not None:
+            recorder.save(args.recordings)
+            print(f"✓ Saved recorded replies to {args.recordings}", file=sys.stderr)
+
+    summarize(report)
+    if args.output:
+        Path(args.output).write_text(json.dumps(report, indent=2, default=str), encoding="utf-8")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text(encoding="utf-8"))
+        if (baseline.get("mode"), baseline.get("workers")) != (report["mode"], report["workers"]):
+            print(f"⚠️ Baseline ran with mode={baseline.get('mode')} workers={baseline.get('workers')}; "
+                  "latencies are not directly comparable", file=sys.stderr)
+        regressions = find_regressions(report, baseline, args.tolerance)
+        for regression in regressions:
+            print(f"⚠️ Regression: {regression}", file=sys.stderr)
+        if regressions:
+            return 1
+        print("✓ No regressions against the baseline", file=sys.stderr)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
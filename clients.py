@@ -0,0 +1,141 @@
+"""
+Process-wide handles for the remote services (Azure OpenAI, Pinecone)
+Each client is created once, shared by every thread and Streamlit session,
+and rebuilt only when its credentials change, so requests reuse pooled
+keep-alive connections instead of paying a TLS handshake per question.
+Remote calls go through call_with_retry: a per-request timeout plus
+exponential backoff with jitter on transient failures.
+"""
+
+import logging
+import random
+import threading
+import time
+
+from config import get_float_setting, get_int_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_REQUEST_TIMEOUT = 30.0
+DEFAULT_CONNECT_TIMEOUT = 5.0
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_RETRY_BASE_DELAY = 0.5
+DEFAULT_RETRY_MAX_DELAY = 8.0
+DEFAULT_MAX_CONNECTIONS = 20
+
+# HTTP statuses worth retrying: timeouts, rate limits and server-side errors
+RETRYABLE_STATUSES = {408, 409, 429, 500, 502, 503, 504}
+
+_clients = {}
+_clients_lock = threading.Lock()
+_stats = {"calls": 0, "retries": 0, "failures": 0}
+_stats_lock = threading.Lock()
+
+
+def get_request_timeout():
+    """Per-request timeout in seconds (REMOTE_TIMEOUT)"""
+    return get_float_setting("REMOTE_TIMEOUT", DEFAULT_REQUEST_TIMEOUT)
+
+
+def shared_client(name, key, factory):
+    """
+    Client registered under name, created by factory() on first use
+    key identifies the settings the client was built from (endpoint, API key);
+    a different key replaces the client, e.g. after secrets are edited.
+    """
+    entry = _clients.get(name)
+    if entry is None or entry[0] != key:
+        with _clients_lock:
+            entry = _clients.get(name)
+            if entry is None or entry[0] != key:
+                if entry is not None:
+                    close_client(entry[1])
+                entry = (key, factory())
+                _clients[name] = entry
+                logger.info("Created shared %s client", name)
+    return entry[1]
+
+
+def close_client(client):
+    """Close a client's connection pool if it has one"""
+    close = getattr(client, "close", None)
+    if callable(close):
+        try:
+            close()
+        except Exception:
+            pass
+
+
+def reset_clients():
+    """Close and forget every shared client (the next use recreates them)"""
+    with _clients_lock:
+        for _, client in _clients.values():
+            close_client(client)
+        _clients.clear()
+
+
+def is_transient(error):
+    """True for connection errors, timeouts, rate limits and 5xx responses"""
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return True
+    status = getattr(error, "status_code", None) or getattr(error, "status", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUSES
+    # SDK exceptions (openai.APIConnectionError, APITimeoutError, urllib3
+    # MaxRetryError, ...) without importing the SDKs here
+    name = type(error).__name__
+    return "Timeout" in name or "Connection" in name
+
+
+def backoff_delay(attempt, base_delay, max_delay):
+    """Exponential backoff with full jitter for the given retry attempt (0-based)"""
+    return random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def call_with_retry(fn, *args, **kwargs):
+    """Call fn(*args, **kwargs), retrying transient failures with exponential backoff"""
+    max_retries = get_int_setting("REMOTE_MAX_RETRIES", DEFAULT_MAX_RETRIES)
+    base_delay = get_float_setting("REMOTE_RETRY_BASE_DELAY", DEFAULT_RETRY_BASE_DELAY)
+    max_delay = get_float_setting("REMOTE_RETRY_MAX_DELAY", DEFAULT_RETRY_MAX_DELAY)
+
+    with _stats_lock:
+        _stats["calls"] += 1
+    attempt = 0
+    while True:
+        try:
+            return fn(*args, **kwargs)
+        except Exception as e:
+            if attempt >= max_retries or not is_transient(e):
+                with _stats_lock:
+                    _stats["failures"] += 1
+                raise
+            delay = backoff_delay(attempt, base_delay, max_delay)
+            logger.warning("Transient error from %s (%s), retry %d/%d in %.2fs",
+                           getattr(fn, "__qualname__", fn), e, attempt + 1, max_retries, delay)
+            with _stats_lock:
+                _stats["retries"] += 1
+            time.sleep(delay)
+            attempt += 1
+
+
+def build_http_client():
+    """httpx client with a bounded keep-alive pool and connect/read timeouts"""
+    import httpx
+    timeout = get_request_timeout()
+    max_connections = get_int_setting("REMOTE_MAX_CONNECTIONS", DEFAULT_MAX_CONNECTIONS)
+    return httpx.Client(
+        timeout=httpx.Timeout(timeout, connect=min(timeout, DEFAULT_CONNECT_TIMEOUT)),
+        limits=httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_connections,
+            keepalive_expiry=60.0
+        )
+    )
+
+
+def get_client_stats():
+    """Shared clients alive and remote call / retry / failure counters"""
+    with _stats_lock:
+        stats = dict(_stats)
+    stats["clients"] = sorted(_clients)
+    return stats
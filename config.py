@@ -0,0 +1,46 @@
+"""
+Shared configuration for the Text-to-SQL engine
+Settings are read from Streamlit secrets when running inside the app,
+otherwise from environment variables (a local .env file is loaded on import)
+"""
+
+import os
+import sys
+from dotenv import load_dotenv
+
+# Load environment variables from .env for local development
+load_dotenv()
+
+
+class ConfigurationError(RuntimeError):
+    """Raised when a required credential or setting is missing"""
+
+
+def get_setting(name, default=None):
+    """Get a setting from Streamlit secrets first, then environment variables"""
+    # Only consult st.secrets when Streamlit is already loaded (i.e. inside the app);
+    # headless callers never pay for importing it
+    st = sys.modules.get("streamlit")
+    if st is not None:
+        try:
+            if name in st.secrets:
+                return st.secrets[name]
+        except Exception:
+            pass  # No secrets.toml - fall back to the environment
+    return os.getenv(name, default)
+
+
+def get_int_setting(name, default):
+    """Get an integer setting, falling back to default when unset or invalid"""
+    try:
+        return int(get_setting(name, default))
+    except (TypeError, ValueError):
+        return default
+
+
+def get_float_setting(name, default):
+    """Get a float setting, falling back to default when unset or invalid"""
+    try:
+        return float(get_setting(name, default))
+    except (TypeError, ValueError):
+        return default
@@ -0,0 +1,671 @@
+"""
+SQLite access for the Text-to-SQL engine
+Builds bike_shop.db from the CSV exports and provides schema lookup,
+validation and execution helpers shared by the apps and the batch runner
+"""
+
+import hashlib
+import queue
+import sqlite3
+import threading
+import time
+import uuid
+import pandas as pd
+from contextlib import contextmanager
+from pathlib import Path
+
+import loader
+import result_cache
+import rollups
+import tracing
+import workload
+from config import get_int_setting, get_setting
+from loader import BASE_DIR
+from schema import TABLES
+
+CSV_FILES = {table_name: table['csv'] for table_name, table in TABLES.items()}
+
+# Read-connection tuning (overridable through secrets / environment)
+DEFAULT_POOL_SIZE = 8
+DEFAULT_POOL_TIMEOUT = 10  # seconds to wait for a free connection
+DEFAULT_CACHE_SIZE_KB = 64 * 1024
+DEFAULT_MMAP_SIZE = 256 * 1024 * 1024
+
+# Seconds between checks of the source CSVs for changes (0 disables auto-refresh)
+DEFAULT_REFRESH_INTERVAL = 60
+
+# Execution guardrails (0 disables a limit)
+DEFAULT_QUERY_TIMEOUT = 30  # seconds of wall-clock time per query
+DEFAULT_QUERY_MAX_VM_STEPS = 500_000_000  # SQLite virtual machine instructions per query
+DEFAULT_QUERY_MAX_ROWS = 100_000  # result rows kept; the rest is dropped and flagged
+PROGRESS_HANDLER_INTERVAL = 10_000  # VM instructions between guard checks
+
+# Rows per page of a lazily fetched result
+DEFAULT_PAGE_SIZE = 1000
+
+
+def get_database_path():
+    """Path of the SQLite database (DATABASE_PATH setting, default ./bike_shop.db)"""
+    return Path(get_setting("DATABASE_PATH", BASE_DIR / "bike_shop.db"))
+
+
+def get_database_connection():
+    """Create a standalone read-write connection (the apps use the pool instead)"""
+    db_path = get_database_path()
+
+    # Load database from CSV files if it doesn't exist
+    if not db_path.exists():
+        load_database(db_path)
+
+    conn = sqlite3.connect(str(db_path), check_same_thread=False)
+    return conn
+
+
+class QueryGuard:
+    """
+    Limits for one query run: wall-clock timeout, VM-step budget and cancellation
+    Checked from SQLite's progress handler every PROGRESS_HANDLER_INTERVAL
+    instructions; cancel() also calls interrupt() on the running connection so
+    it can be used from any thread.
+    """
+
+    def __init__(self, timeout=None, max_steps=None):
+        self.timeout = get_int_setting("QUERY_TIMEOUT", DEFAULT_QUERY_TIMEOUT) if timeout is None else timeout
+        self.max_steps = (get_int_setting("QUERY_MAX_VM_STEPS", DEFAULT_QUERY_MAX_VM_STEPS)
+                          if max_steps is None else max_steps)
+        self.reason = None
+        self.steps = 0
+        self._deadline = None
+        self._cancelled = threading.Event()
+        self._conn = None
+        self._lock = threading.Lock()
+
+    def attach(self, conn):
+        """Start enforcing the limits on conn"""
+        self.steps = 0
+        self._deadline = time.monotonic() + self.timeout if self.timeout > 0 else None
+        conn.set_progress_handler(self._check, PROGRESS_HANDLER_INTERVAL)
+        with self._lock:
+            self._conn = conn
+        if self._cancelled.is_set():
+            conn.interrupt()
+
+    def detach(self, conn):
+        """Stop enforcing (before the connection goes back to the pool)"""
+        with self._lock:
+            self._conn = None
+        conn.set_progress_handler(None, 0)
+
+    def _check(self):
+        """Progress handler: a non-zero return aborts the statement"""
+        self.steps += PROGRESS_HANDLER_INTERVAL
+        if self._cancelled.is_set():
+            self.reason = "cancelled"
+        elif self._deadline is not None and time.monotonic() > self._deadline:
+            self.reason = "timeout"
+        elif self.max_steps > 0 and self.steps > self.max_steps:
+            self.reason = "steps"
+        return 1 if self.reason else 0
+
+    @property
+    def stopped(self):
+        """Whether a limit or cancel() aborted the query"""
+        return self.reason is not None or self._cancelled.is_set()
+
+    def cancel(self):
+        """Abort the query as soon as possible"""
+        self._cancelled.set()
+        with self._lock:
+            if self._conn is not None:
+                self._conn.interrupt()
+
+    def error_message(self):
+        """User-facing explanation of why the query was stopped"""
+        if self.reason == "timeout":
+            return f"Query stopped: exceeded the {self.timeout}s time limit"
+        if self.reason == "steps":
+            return (f"Query stopped: exceeded the budget of {self.max_steps:,} SQLite VM steps "
+                    "(check for a missing JOIN condition)")
+        return "Query cancelled"
+
+
+class PoolTimeout(RuntimeError):
+    """Raised when no pooled connection frees up within the pool timeout"""
+
+
+class ConnectionPool:
+    """
+    Bounded pool of read-only SQLite connections shared by every session in the process
+    Connections are opened with mode=ro and PRAGMA query_only, tuned once
+    (page cache, mmap, in-memory temp store) and handed out LIFO so the most
+    recently used - and therefore warmest - connection is reused first.
+    """
+
+    def __init__(self, db_path, size=DEFAULT_POOL_SIZE, timeout=DEFAULT_POOL_TIMEOUT,
+                 cache_size_kb=DEFAULT_CACHE_SIZE_KB, mmap_size=DEFAULT_MMAP_SIZE):
+        self.db_path = Path(db_path)
+        # Identify the file generation this pool serves so a swapped-in rebuild is noticed
+        self.file_id = self.db_path.stat().st_ino
+        self.generation = loader.get_swap_generation()
+        self.size = max(1, size)
+        self.timeout = timeout
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self._idle = queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._created = 0
+        self._in_use = 0
+        self._acquisitions = 0
+        self._waits = 0
+        self._total_wait = 0.0
+        self._max_wait = 0.0
+        self._closed = False
+        self._data_version = None
+
+    def _connect(self):
+        """Open and tune a new read-only connection"""
+        conn = sqlite3.connect(f"{self.db_path.resolve().as_uri()}?mode=ro", uri=True, check_same_thread=False)
+        conn.execute("PRAGMA query_only = ON")
+        conn.execute(f"PRAGMA cache_size = -{int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size = {int(self.mmap_size)}")
+        conn.execute("PRAGMA temp_store = MEMORY")
+        return conn
+
+    def open_connection(self):
+        """A tuned read-only connection outside the pool, owned (and closed) by the caller"""
+        return self._connect()
+
+    def acquire(self):
+        """Take a connection from the pool, opening one if under the size limit"""
+        start = time.perf_counter()
+        conn = None
+        with self._lock:
+            if self._idle.empty() and self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+
+        if create:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+        else:
+            try:
+                conn = self._idle.get(timeout=self.timeout)
+            except queue.Empty:
+                raise PoolTimeout(f"No database connection available after {self.timeout}s "
+                                  f"(pool size {self.size})")
+
+        waited = time.perf_counter() - start
+        with self._lock:
+            self._in_use += 1
+            self._acquisitions += 1
+            self._total_wait += waited
+            self._max_wait = max(self._max_wait, waited)
+            if not create and waited > 0.001:
+                self._waits += 1
+        return conn
+
+    def release(self, conn):
+        """Return a connection to the pool"""
+        if conn.in_transaction:
+            conn.rollback()
+        with self._lock:
+            self._in_use -= 1
+            if self._closed:
+                self._created -= 1
+        if self._closed:
+            conn.close()
+        else:
+            self._idle.put(conn)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection for the duration of a with-block"""
+        conn = self.acquire()
+        try:
+            yield conn
+        finally:
+            self.release(conn)
+
+    @property
+    def data_version(self):
+        """
+        Token identifying the data this pool serves
+        Derived from the CSV fingerprints the loader recorded, so it changes when a
+        reload brings new data but survives rebuilds that load identical files.
+        """
+        if self._data_version is None:
+            with self.connection() as conn:
+                try:
+                    rows = conn.execute(
+                        f"SELECT table_name, sha256, ddl_hash FROM {loader.STATE_TABLE} ORDER BY table_name"
+                    ).fetchall()
+                except sqlite3.OperationalError:
+                    rows = [("file", str(self.file_id), str(self.db_path.stat().st_mtime_ns))]
+            self._data_version = hashlib.sha256(repr(rows).encode()).hexdigest()[:16]
+        return self._data_version
+
+    def stats(self):
+        """Pool size, utilisation and wait-time counters"""
+        with self._lock:
+            return {
+                "size": self.size,
+                "open": self._created,
+                "in_use": self._in_use,
+                "acquisitions": self._acquisitions,
+                "waits": self._waits,
+                "avg_wait_ms": (self._total_wait / self._acquisitions * 1000) if self._acquisitions else 0.0,
+                "max_wait_ms": self._max_wait * 1000
+            }
+
+    def close(self):
+        """Close idle connections; borrowed ones are closed as they are released"""
+        self._closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+            with self._lock:
+                self._created -= 1
+
+
+_pool = None
+_pool_lock = threading.Lock()
+_last_refresh_check = 0.0
+
+
+def _pool_is_stale(db_path):
+    """Whether the pool serves another path or a database file that has since been swapped"""
+    if _pool is None or _pool.db_path != db_path:
+        return True
+    return _pool.generation != loader.get_swap_generation()
+
+
+def check_for_updates(db_path):
+    """
+    Periodically look for changed CSVs (refreshed in the background) and for a
+    database swapped in by another process; cheap between checks
+    """
+    global _last_refresh_check, _pool
+    interval = get_int_setting("DB_REFRESH_INTERVAL", DEFAULT_REFRESH_INTERVAL)
+    now = time.monotonic()
+    if interval <= 0 or now - _last_refresh_check < interval:
+        return
+    _last_refresh_check = now
+
+    loader.schedule_refresh(db_path)
+    with _pool_lock:
+        if _pool is not None and _pool.db_path == db_path and db_path.stat().st_ino != _pool.file_id:
+            _pool.close()
+            _pool = None
+
+
+def get_connection_pool():
+    """Process-wide connection pool, building the database on first use"""
+    global _pool
+    db_path = get_database_path()
+    check_for_updates(db_path)
+    if _pool_is_stale(db_path):
+        with _pool_lock:
+            if _pool_is_stale(db_path):
+                if not db_path.exists():
+                    loader.refresh_database(db_path)
+                if _pool is not None:
+                    _pool.close()
+                _pool = ConnectionPool(
+                    db_path,
+                    size=get_int_setting("DB_POOL_SIZE", DEFAULT_POOL_SIZE),
+                    timeout=get_int_setting("DB_POOL_TIMEOUT", DEFAULT_POOL_TIMEOUT),
+                    cache_size_kb=get_int_setting("SQLITE_CACHE_SIZE_KB", DEFAULT_CACHE_SIZE_KB),
+                    mmap_size=get_int_setting("SQLITE_MMAP_SIZE", DEFAULT_MMAP_SIZE)
+                )
+    return _pool
+
+
+def get_pool_stats():
+    """Stats of the process-wide pool, or None before the first query"""
+    return _pool.stats() if _pool is not None else None
+
+
+def get_data_version():
+    """Data-version token of the live database (changes when the CSVs are reloaded)"""
+    return get_connection_pool().data_version
+
+
+def pooled_connection():
+    """Borrow a read-only connection from the process-wide pool"""
+    return get_connection_pool().connection()
+
+
+def load_database(db_path):
+    """Build the SQLite database from the CSV files (full rebuild, swapped in atomically)"""
+    loader.refresh_database(db_path, force=True)
+
+
+def introspect_schema():
+    """
+    Read table and column information from the database (uncached - see schema_cache)
+    Columns carry "pk" (primary key flag) and "fk" ("table.column" or None) alongside name and type.
+    """
+    with pooled_connection() as conn:
+        cursor = conn.cursor()
+
+        # Get all tables (skipping SQLite internals and _-prefixed bookkeeping tables)
+        cursor.execute("SELECT name FROM sqlite_master WHERE type='table' "
+                       "AND name NOT LIKE 'sqlite_%' AND name NOT LIKE '\\_%' ESCAPE '\\';")
+        tables = cursor.fetchall()
+
+        schema_info = {}
+        for table in tables:
+            table_name = table[0]
+            cursor.execute(f"PRAGMA table_info({table_name});")
+            columns = cursor.fetchall()
+            cursor.execute(f"PRAGMA foreign_key_list({table_name});")
+            foreign_keys = {fk[3]: f"{fk[2]}.{fk[4]}" for fk in cursor.fetchall()}
+            schema_info[table_name] = [
+                {"name": col[1], "type": col[2], "pk": col[5] > 0, "fk": foreign_keys.get(col[1])}
+                for col in columns
+            ]
+
+    return schema_info
+
+
+def validate_sql_syntax(sql_query):
+    """Validate SQL syntax"""
+    try:
+        with pooled_connection() as conn:
+            conn.execute(f"EXPLAIN QUERY PLAN {sql_query}")
+        tracing.annotate(valid=True)
+        return True, "SQL syntax is valid"
+    except Exception as e:
+        tracing.annotate(valid=False)
+        return False, str(e)
+
+
+def fetch_dataframe(conn, sql_query, max_rows):
+    """
+    Run a query and build a DataFrame of at most max_rows rows
+    df.attrs["truncated"] is True when the result had more rows than that.
+    """
+    cursor = conn.execute(sql_query)
+    try:
+        columns = [col[0] for col in cursor.description or []]
+        rows = cursor.fetchmany(max_rows + 1) if max_rows > 0 else cursor.fetchall()
+    finally:
+        cursor.close()
+    truncated = max_rows > 0 and len(rows) > max_rows
+    df = pd.DataFrame.from_records(rows[:max_rows] if truncated else rows, columns=columns, coerce_float=True)
+    df.attrs["truncated"] = truncated
+    df.attrs["max_rows"] = max_rows
+    return df
+
+
+def _run_logged(sql_query, start_time, execute):
+    """
+    Run a statement the way every execution path does
+    execute(sql) runs the SQL actually executed - the rollup rewrite of sql_query
+    when a rollup answers it - and returns its result. The execution is timed
+    from start_time and logged to the workload under the original SQL.
+    Returns (execute's result, execution_time).
+    """
+    run_sql, _ = rollups.rewrite(sql_query)
+    value = execute(run_sql)
+    execution_time = time.time() - start_time
+    workload.record(sql_query, execution_time)
+    return value, execution_time
+
+
+def execute_sql_query(sql_query, use_cache=True, guard=None):
+    """
+    Execute SQL query and return results with timing
+    Execution is bounded by a QueryGuard (QUERY_TIMEOUT, QUERY_MAX_VM_STEPS; pass
+    one to cancel() the query from another thread) and QUERY_MAX_ROWS, with
+    df.attrs["truncated"] set when rows were dropped. Results are served from the
+    result cache when the same query already ran against the same data;
+    result_cache.last_hit() tells whether that happened. Aggregates a sales
+    rollup answers exactly read the rollup instead (rollups.last_rewrite()).
+    """
+    result_cache.set_last_hit(None)
+    guard = guard if guard is not None else QueryGuard()
+    max_rows = get_int_setting("QUERY_MAX_ROWS", DEFAULT_QUERY_MAX_ROWS)
+    start_time = time.time()
+    try:
+        cache = result_cache.get_result_cache() if use_cache else None
+        if cache is not None:
+            canonical_sql = result_cache.canonicalize_sql(sql_query)
+            if result_cache.is_cacheable(canonical_sql):
+                data_version = get_data_version()
+                # The row cap is part of the key: a truncated result must not answer an uncapped query
+                cache_key = f"{canonical_sql}\n-- max_rows={max_rows}"
+                cached = cache.get(data_version, cache_key)
+                if cached is not None:
+                    df, _, kind = cached
+                    result_cache.set_last_hit(kind)
+                    tracing.annotate(rows=len(df), truncated=bool(df.attrs.get("truncated")))
+                    return df, None, time.time() - start_time
+            else:
+                cache = None
+
+        def fetch(run_sql):
+            with pooled_connection() as conn:
+                guard.attach(conn)
+                try:
+                    return fetch_dataframe(conn, run_sql, max_rows)
+                finally:
+                    guard.detach(conn)
+
+        df, execution_time = _run_logged(sql_query, start_time, fetch)
+        if cache is not None:
+            cache.put(data_version, cache_key, df, execution_time)
+        tracing.annotate(rows=len(df), truncated=df.attrs["truncated"])
+        return df, None, execution_time
+    except sqlite3.OperationalError as e:
+        if guard.stopped:
+            return None, guard.error_message(), time.time() - start_time
+        return None, str(e), time.time() - start_time
+    except Exception as e:
+        return None, str(e), time.time() - start_time
+
+
+class PagedResult:
+    """
+    Query result fetched a page at a time
+    The statement runs on its own read-only connection (so a result being paged
+    through does not hold a pool slot) and rows are pulled with fetchmany only
+    as pages are requested; the connection is closed once the cursor is drained
+    or close() is called. Each fetch is bounded by the query's QueryGuard and the
+    whole result by max_rows. A result small enough to be drained goes into the
+    result cache, and cache hits come back as an already-drained PagedResult.
+    """
+
+    def __init__(self, columns, rows=(), cursor=None, conn=None, guard=None,
+                 page_size=DEFAULT_PAGE_SIZE, max_rows=DEFAULT_QUERY_MAX_ROWS, on_complete=None):
+        self.columns = list(columns)
+        self.page_size = max(1, page_size)
+        self.max_rows = max_rows
+        self.truncated = False
+        self.result_id = uuid.uuid4().hex
+        self._rows = list(rows)
+        self._cursor = cursor
+        self._conn = conn
+        self._guard = guard
+        self._on_complete = on_complete
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_dataframe(cls, df, page_size=DEFAULT_PAGE_SIZE):
+        """Already-drained result over a DataFrame (e.g. a result-cache hit)"""
+        result = cls(df.columns, df.itertuples(index=False, name=None), page_size=page_size,
+                     max_rows=df.attrs.get("max_rows", 0))
+        result.truncated = bool(df.attrs.get("truncated"))
+        return result
+
+    @property
+    def exhausted(self):
+        """Whether every row has been fetched"""
+        return self._cursor is None
+
+    @property
+    def fetched_rows(self):
+        return len(self._rows)
+
+    @property
+    def total_rows(self):
+        """Row count, or None while rows remain to be fetched"""
+        return len(self._rows) if self.exhausted else None
+
+    @property
+    def page_count(self):
+        """Number of pages, or None while rows remain to be fetched"""
+        if not self.exhausted:
+            return None
+        return max(1, -(-len(self._rows) // self.page_size))
+
+    def _fetch_until(self, count):
+        """Pull rows from the cursor until count are held or it is drained"""
+        while self._cursor is not None and len(self._rows) < count:
+            size = max(self.page_size, count - len(self._rows))
+            if self.max_rows > 0:
+                # One row past the cap tells a truncated result from an exact fit
+                size = min(size, self.max_rows + 1 - len(self._rows))
+            self._guard.attach(self._conn)
+            try:
+                batch = self._cursor.fetchmany(size)
+            finally:
+                self._guard.detach(self._conn)
+            self._rows.extend(batch)
+            if self.max_rows > 0 and len(self._rows) > self.max_rows:
+                del self._rows[self.max_rows:]
+                self.truncated = True
+                self._finish()
+            elif len(batch) < size:
+                self._finish()
+
+    def _finish(self):
+        """Close the cursor and its connection, handing a complete result to on_complete"""
+        cursor, conn = self._cursor, self._conn
+        self._cursor = self._conn = None
+        cursor.close()
+        conn.close()
+        if self._on_complete is not None and not self.truncated:
+            self._on_complete(self._frame(self._rows))
+
+    def _frame(self, rows):
+        df = pd.DataFrame.from_records(rows, columns=self.columns, coerce_float=True)
+        df.attrs["truncated"] = self.truncated
+        df.attrs["max_rows"] = self.max_rows
+        return df
+
+    def page(self, number):
+        """DataFrame of the given page (0-based), fetching it first if needed"""
+        start = number * self.page_size
+        with self._lock:
+            # One extra row so the last page is known to be the last
+            self._fetch_until(start + self.page_size + 1)
+            return self._frame(self._rows[start:start + self.page_size])
+
+    def fetched_dataframe(self):
+        """DataFrame of the rows fetched so far (no further fetching)"""
+        with self._lock:
+            return self._frame(self._rows)
+
+    def to_dataframe(self):
+        """The complete result, draining the cursor"""
+        with self._lock:
+            self._fetch_until(float("inf"))
+            return self._frame(self._rows)
+
+    def iter_frames(self, chunk_rows=None):
+        """
+        DataFrames of chunk_rows rows covering the whole result (for export and charts)
+        Rows are fetched as the frames are consumed and kept like paged rows, so the
+        result ends up holding all of them (at most max_rows).
+        """
+        chunk_rows = max(1, chunk_rows or self.page_size)
+        start = 0
+        while True:
+            with self._lock:
+                self._fetch_until(start + chunk_rows)
+                rows = self._rows[start:start + chunk_rows]
+            # An empty result still yields one (empty) frame so exports get their header
+            if rows or start == 0:
+                yield self._frame(rows)
+            if len(rows) < chunk_rows:
+                break
+            start += len(rows)
+
+    def close(self):
+        """Release the cursor and connection without fetching the rest"""
+        with self._lock:
+            if self._cursor is not None:
+                self._on_complete = None
+                self._finish()
+
+
+def open_paged_result(sql_query, page_size=None, guard=None, use_cache=True):
+    """
+    Execute a query and fetch only its first page
+    Returns (PagedResult, error, execution_time) like execute_sql_query; further
+    pages are fetched on demand with PagedResult.page().
+    """
+    result_cache.set_last_hit(None)
+    guard = guard if guard is not None else QueryGuard()
+    page_size = page_size or get_int_setting("RESULT_PAGE_SIZE", DEFAULT_PAGE_SIZE)
+    max_rows = get_int_setting("QUERY_MAX_ROWS", DEFAULT_QUERY_MAX_ROWS)
+    start_time = time.time()
+    try:
+        on_complete = None
+        cache = result_cache.get_result_cache() if use_cache else None
+        if cache is not None:
+            canonical_sql = result_cache.canonicalize_sql(sql_query)
+            if result_cache.is_cacheable(canonical_sql):
+                data_version = get_data_version()
+                cache_key = f"{canonical_sql}\n-- max_rows={max_rows}"
+                cached = cache.get(data_version, cache_key)
+                if cached is not None:
+                    df, _, kind = cached
+                    result_cache.set_last_hit(kind)
+                    tracing.annotate(rows=len(df))
+                    return PagedResult.from_dataframe(df, page_size), None, time.time() - start_time
+
+                def on_complete(df):
+                    cache.put(data_version, cache_key, df, time.time() - start_time)
+
+        def open_result(run_sql):
+            conn = get_connection_pool().open_connection()
+            try:
+                guard.attach(conn)
+                try:
+                    cursor = conn.execute(run_sql)
+                finally:
+                    guard.detach(conn)
+            except BaseException:
+                conn.close()
+                raise
+            # The result owns the connection from here on
+            result = PagedResult([col[0] for col in cursor.description or []], cursor=cursor, conn=conn,
+                                 guard=guard, page_size=page_size, max_rows=max_rows, on_complete=on_complete)
+            try:
+                result.page(0)
+            except BaseException:
+                # A failed first fetch (timeout, interrupt) must not leak the connection
+                result.close()
+                raise
+            return result
+
+        result, execution_time = _run_logged(sql_query, start_time, open_result)
+        # Rows fetched for the first page; the rest are only counted if paged through
+        tracing.annotate(rows=result.fetched_rows)
+        return result, None, execution_time
+    except sqlite3.OperationalError as e:
+        if guard.stopped:
+            return None, guard.error_message(), time.time() - start_time
+        return None, str(e), time.time() - start_time
+    except Exception as e:
+        return None, str(e), time.time() - start_time
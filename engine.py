@@ -0,0 +1,532 @@
+"""
+Headless NL→SQL pipeline
+Runs schema lookup → embedding → retrieval / answer-cache lookup → generation →
+validation → cost estimate → execution for one question without Streamlit, recording per-stage
+timings. The pipeline is asyncio-based: independent stages overlap (the schema
+lookup, question embedding, vector search and answer-cache lookup run
+concurrently) and blocking work (SQLite, the embedding model, the LLM SDK) runs
+on a shared worker pool. Every session and batch shares one event loop running
+in a background thread; the synchronous functions are thin wrappers over it.
+"""
+
+import asyncio
+import json
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+
+import answer_cache
+import database
+import generation
+import query_cost
+import result_cache
+import retrieval
+import schema_cache
+import tracing
+from config import get_int_setting
+
+logger = logging.getLogger(__name__)
+
+STAGES = ("schema", "embedding", "retrieval", "cache", "prompt", "generation", "validation", "repair", "cost",
+          "execution", "total")
+
+# Worker threads for blocking stages, shared by every in-flight question
+DEFAULT_ENGINE_THREADS = 32
+
+# Regenerations after EXPLAIN QUERY PLAN rejects the SQL, each fed the SQLite error
+DEFAULT_REPAIR_MAX_ATTEMPTS = 2
+
+_loop = None
+_loop_lock = threading.Lock()
+
+
+def get_event_loop():
+    """Process-wide event loop running in a daemon thread (started on first use)"""
+    global _loop
+    if _loop is None:
+        with _loop_lock:
+            if _loop is None:
+                loop = asyncio.new_event_loop()
+                loop.set_default_executor(ThreadPoolExecutor(
+                    max_workers=get_int_setting("ENGINE_THREADS", DEFAULT_ENGINE_THREADS),
+                    thread_name_prefix="engine"
+                ))
+                threading.Thread(target=loop.run_forever, name="engine-loop", daemon=True).start()
+                _loop = loop
+    return _loop
+
+
+async def _traced(parent, coro):
+    with tracing.use_span(parent):
+        return await coro
+
+
+def submit(coro):
+    """Schedule a coroutine on the shared loop; the returned Future supports cancel()"""
+    # Spans opened by the coroutine nest under the caller's current span
+    parent = tracing.current_span()
+    if parent is not None:
+        coro = _traced(parent, coro)
+    return asyncio.run_coroutine_threadsafe(coro, get_event_loop())
+
+
+def run(coro, timeout=None):
+    """Run a coroutine on the shared loop and wait for its result, cancelling it if the wait is abandoned"""
+    future = submit(coro)
+    try:
+        return future.result(timeout)
+    except BaseException:
+        future.cancel()
+        raise
+
+
+async def run_stage(timings, stage, fn, *args, **kwargs):
+    """Run a blocking call on the worker pool, timing it as stage (and tracing it as a span)"""
+    with tracing.span(stage):
+        start = time.perf_counter()
+        try:
+            return await asyncio.to_thread(fn, *args, **kwargs)
+        finally:
+            timings[stage] = round((time.perf_counter() - start) * 1000, 3)
+
+
+def _cancel_pending(*tasks):
+    for task in tasks:
+        if task is not None and not task.done():
+            task.cancel()
+
+
+async def prepare_async(question, schema_info=None, mode="basic", top_k=3, timings=None):
+    """
+    Everything before generation, overlapped
+    The schema lookup, question embedding, vector search and answer-cache lookup
+    run concurrently; a cache hit cancels the vector search. Returns
+    {"schema_info", "hit", "matches", "retrieval_error"}.
+    """
+    timings = {} if timings is None else timings
+    schema_task = embed_task = search_task = cache_task = None
+
+    async def search():
+        try:
+            vector = await embed_task
+            return await run_stage(timings, "retrieval", retrieval.search_by_embedding, vector, top_k), None
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            # Continue with full schema if vector search fails
+            logger.warning("Vector search unavailable: %s", e)
+            return None, str(e)
+
+    async def cache_lookup():
+        schema = await schema_task if schema_task is not None else schema_info
+        try:
+            vector = await embed_task
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            vector = None
+        return await run_stage(timings, "cache", answer_cache.lookup, question, mode, schema, vector)
+
+    try:
+        if schema_info is None:
+            schema_task = asyncio.ensure_future(run_stage(timings, "schema", schema_cache.get_database_schema))
+        embed_task = asyncio.ensure_future(run_stage(timings, "embedding", retrieval.embed_query, question))
+        search_task = asyncio.ensure_future(search())
+        cache_task = asyncio.ensure_future(cache_lookup())
+
+        if schema_task is not None:
+            schema_info = await schema_task
+        hit = await cache_task
+        if hit is not None:
+            _cancel_pending(search_task)
+            matches, retrieval_error = None, None
+        else:
+            matches, retrieval_error = await search_task
+    finally:
+        _cancel_pending(schema_task, embed_task, search_task, cache_task)
+
+    return {"schema_info": schema_info, "hit": hit, "matches": matches, "retrieval_error": retrieval_error}
+
+
+def _split_response(response, mode):
+    """(sql, metadata) of a generation response"""
+    if mode == "advanced":
+        metadata = dict(response)
+        return metadata.pop("sql"), metadata
+    return response, None
+
+
+def _generated(prepared, response, mode):
+    """Result dict shared by generate_async and generate_stream"""
+    sql, metadata = _split_response(response, mode)
+    hit = prepared["hit"]
+    return {
+        "sql": sql,
+        "metadata": metadata,
+        "response": response,
+        "cache": hit.kind if hit is not None else None,
+        "matches": prepared["matches"],
+        "retrieval_error": prepared["retrieval_error"],
+        "schema_info": prepared["schema_info"]
+    }
+
+
+async def generate_async(question, schema_info=None, mode="basic", top_k=3, timings=None):
+    """
+    Retrieval and generation stages for one question
+    Returns {"sql", "metadata", "response", "cache", "matches", "retrieval_error",
+    "schema_info"}; "response" is what the generation function returned and
+    "cache" the answer-cache hit kind ("exact" / "semantic") or None.
+    """
+    timings = {} if timings is None else timings
+    prepared = await prepare_async(question, schema_info, mode, top_k, timings)
+    if prepared["hit"] is not None:
+        response = prepared["hit"].response
+    else:
+        prompt = await run_stage(timings, "prompt", generation.build_prompt, question,
+                                 prepared["schema_info"], prepared["matches"], mode)
+        reply = await run_stage(timings, "generation", generation.complete, prompt, json_mode=(mode == "advanced"))
+        response = generation.parse_response(reply, mode)
+    return _generated(prepared, response, mode)
+
+
+def _first_attempt(generated, timings, valid, message):
+    """Attempt record of the initial generation (or answer-cache hit)"""
+    return {
+        "attempt": 1,
+        "kind": "cache" if generated["cache"] else "generate",
+        "sql": generated["sql"],
+        "valid": valid,
+        "error": None if valid else message,
+        "generation_ms": timings.get("generation"),
+        "validation_ms": timings.get("validation")
+    }
+
+
+def _repair_attempt(question, generated, mode, failed_sql, error, attempt):
+    """
+    One repair round trip (runs on a worker thread): regenerate with the failed SQL
+    and its SQLite error in the prompt, then validate the new SQL
+    Returns (response, attempt record).
+    """
+    prompt = generation.build_prompt(question, generated["schema_info"], generated["matches"], mode,
+                                     repair=(failed_sql, error))
+    start = time.perf_counter()
+    reply = generation.complete(prompt, json_mode=(mode == "advanced"))
+    generation_ms = round((time.perf_counter() - start) * 1000, 3)
+    response = generation.parse_response(reply, mode)
+    sql = _split_response(response, mode)[0]
+    start = time.perf_counter()
+    valid, message = database.validate_sql_syntax(sql)
+    return response, {
+        "attempt": attempt,
+        "kind": "repair",
+        "sql": sql,
+        "valid": valid,
+        "error": None if valid else message,
+        "generation_ms": generation_ms,
+        "validation_ms": round((time.perf_counter() - start) * 1000, 3)
+    }
+
+
+def max_repair_attempts():
+    """REPAIR_MAX_ATTEMPTS setting (0 disables automatic repair)"""
+    return max(0, get_int_setting("REPAIR_MAX_ATTEMPTS", DEFAULT_REPAIR_MAX_ATTEMPTS))
+
+
+async def _repair_step(question, generated, mode, timings, attempts):
+    """One repair attempt, appended to attempts and applied to generated (None if the model call failed)"""
+    step_timings = {}
+    try:
+        response, attempt = await run_stage(step_timings, "repair", _repair_attempt, question, generated, mode,
+                                            attempts[-1]["sql"], attempts[-1]["error"], len(attempts) + 1)
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        # The model being unreachable ends the repair loop, not the question
+        logger.warning("SQL repair failed: %s", e)
+        return None
+    finally:
+        if "repair" in step_timings:
+            timings["repair"] = round(timings.get("repair", 0.0) + step_timings["repair"], 3)
+    attempts.append(attempt)
+    generated["response"] = response
+    generated["sql"], generated["metadata"] = _split_response(response, mode)
+    return attempt
+
+
+def _needs_repair(attempts):
+    return not attempts[-1]["valid"] and len(attempts) <= max_repair_attempts()
+
+
+def _final_validation(attempts):
+    """(valid, message) of the last attempt"""
+    last = attempts[-1]
+    return last["valid"], last["error"] or "SQL syntax is valid"
+
+
+async def repair_async(question, generated, mode, timings, attempts):
+    """
+    Regenerate while EXPLAIN QUERY PLAN rejects the SQL, at most REPAIR_MAX_ATTEMPTS times
+    attempts must already hold the first attempt; each repair is appended to it,
+    the total repair time goes to timings["repair"] and generated is updated in
+    place with the last response. Returns (valid, message).
+    """
+    while _needs_repair(attempts):
+        if await _repair_step(question, generated, mode, timings, attempts) is None:
+            break
+    return _final_validation(attempts)
+
+
+def generate_stream(question, schema_info=None, mode="basic", top_k=3):
+    """
+    Streaming variant of generate() for the apps, yielding (event, payload) pairs:
+    ("sql", SQL received so far) as tokens arrive, ("validated", (valid, message))
+    once EXPLAIN QUERY PLAN has checked the statement - started as soon as the
+    statement is complete, while the metadata fields are still streaming - and
+    finally ("done", generate() result plus "valid", "validation_message", "attempts",
+    "cost", "timings"); "cost" is the query_cost estimate of valid SQL as a dict.
+    When the SQL is rejected, ("repair", {"attempt", "error"}) announces each
+    automatic repair round trip, followed by its "sql" and "validated" events.
+    """
+    with tracing.span("question", mode=mode):
+        yield from _generate_stream(question, schema_info, mode, top_k)
+
+
+def _generate_stream(question, schema_info, mode, top_k):
+    timings = {}
+    prepared = run(prepare_async(question, schema_info, mode, top_k, timings))
+    validation = None
+    validated_sql = None
+    reported = False
+
+    def validate(sql_query):
+        return submit(run_stage(timings, "validation", database.validate_sql_syntax, sql_query))
+
+    try:
+        if prepared["hit"] is not None:
+            response = prepared["hit"].response
+        else:
+            parser = generation.StreamingSqlParser(mode)
+            with tracing.span("prompt") as prompt_span:
+                prompt = generation.build_prompt(question, prepared["schema_info"], prepared["matches"], mode)
+            timings["prompt"] = prompt_span.duration_ms
+            with tracing.span("generation") as generation_span:
+                for delta in generation.stream_complete(prompt, json_mode=(mode == "advanced")):
+                    parser.feed(delta)
+                    yield "sql", parser.sql
+                    if validation is None and parser.sql_complete:
+                        validated_sql = parser.sql
+                        validation = validate(validated_sql)
+                    if validation is not None and not reported and validation.done():
+                        reported = True
+                        yield "validated", validation.result()
+                parser.finish()
+            timings["generation"] = generation_span.duration_ms
+            response = parser.result()
+
+        result = _generated(prepared, response, mode)
+        yield "sql", result["sql"]
+
+        if validation is None or validated_sql != result["sql"]:
+            # Early check covered a different text (e.g. the reply carried on past the ';')
+            if validation is not None:
+                validation.cancel()
+            validation = validate(result["sql"])
+            reported = False
+        result["valid"], result["validation_message"] = validation.result()
+        if not reported:
+            yield "validated", (result["valid"], result["validation_message"])
+
+        attempts = result["attempts"] = [
+            _first_attempt(result, timings, result["valid"], result["validation_message"])]
+        while _needs_repair(attempts):
+            yield "repair", {"attempt": len(attempts) + 1, "error": attempts[-1]["error"]}
+            if run(_repair_step(question, result, mode, timings, attempts)) is None:
+                break
+            yield "sql", result["sql"]
+            yield "validated", _final_validation(attempts)
+        result["valid"], result["validation_message"] = _final_validation(attempts)
+        result["cost"] = None
+        if result["valid"]:
+            estimate, _ = run(run_stage(timings, "cost", query_cost.estimate_query_cost, result["sql"]))
+            result["cost"] = estimate._asdict() if estimate is not None else None
+
+        if result["valid"] and (result["cache"] is None or len(attempts) > 1):
+            submit(asyncio.to_thread(answer_cache.store, question, mode, result["schema_info"],
+                                     result["response"], result["sql"]))
+        result["timings"] = timings
+        yield "done", result
+    finally:
+        if validation is not None and not validation.done():
+            validation.cancel()
+
+
+def _execute(sql, guard, paged=False):
+    """execute_sql_query (or open_paged_result) plus where the result came from (runs on a worker thread)"""
+    run_query = database.open_paged_result if paged else database.execute_sql_query
+    result, error, execution_time = run_query(sql, guard=guard)
+    return result, error, execution_time, result_cache.last_hit()
+
+
+def execute_with_cancel(sql, on_wait=None, poll_interval=0.2, paged=False):
+    """
+    Execute a query on the worker pool while the calling thread keeps polling
+    on_wait(elapsed seconds) is called every poll_interval while the query runs.
+    If the caller is interrupted meanwhile - e.g. a Streamlit rerun triggered by a
+    Cancel button raises out of on_wait - the query is aborted with interrupt()
+    instead of running on unobserved. Returns (df, error, execution_time, cache_hit);
+    with paged=True the first item is a database.PagedResult holding the first page.
+    """
+    guard = database.QueryGuard()
+    future = submit(run_stage({}, "execution", _execute, sql, guard, paged))
+    start = time.perf_counter()
+    try:
+        while True:
+            try:
+                return future.result(timeout=poll_interval)
+            except FutureTimeout:
+                if on_wait is not None:
+                    on_wait(time.perf_counter() - start)
+    except BaseException:
+        guard.cancel()
+        future.cancel()
+        raise
+
+
+async def answer_question_async(question, schema_info=None, mode="basic", execute=True, max_rows=100, top_k=3,
+                                allow_expensive=False):
+    """
+    Answer one natural language question end to end
+    mode="basic" asks for SQL only, mode="advanced" also asks for complexity metadata.
+    Returns a JSON-serializable dict; failures are reported in "error" rather than raised,
+    and "attempts" lists the generation and any automatic repairs with their latency.
+    "cost" holds the planner estimate; SQL over COST_CONFIRM_ROWS is not executed
+    (there is nobody to confirm it) unless allow_expensive is set.
+    Cancelling the task abandons the remaining stages.
+    """
+    with tracing.span("question", mode=mode):
+        return await _answer_question(question, schema_info, mode, execute, max_rows, top_k, allow_expensive)
+
+
+async def _answer_question(question, schema_info, mode, execute, max_rows, top_k, allow_expensive):
+    result = {
+        "question": question,
+        "sql": None,
+        "metadata": None,
+        "valid": None,
+        "validation_message": None,
+        "row_count": None,
+        "columns": None,
+        "rows": None,
+        "error": None,
+        "cache": None,
+        "result_cache": None,
+        "truncated": None,
+        "cost": None,
+        "attempts": [],
+        "timings": {}
+    }
+    timings = result["timings"]
+    start = time.perf_counter()
+
+    try:
+        generated = await generate_async(question, schema_info, mode, top_k, timings)
+        result["cache"] = generated["cache"]
+
+        valid, message = await run_stage(timings, "validation", database.validate_sql_syntax, generated["sql"])
+        attempts = result["attempts"]
+        attempts.append(_first_attempt(generated, timings, valid, message))
+        result["valid"], result["validation_message"] = await repair_async(question, generated, mode, timings, attempts)
+        result["sql"] = generated["sql"]
+        result["metadata"] = generated["metadata"]
+
+        store = None
+        if result["valid"] and (result["cache"] is None or len(attempts) > 1):
+            # Cache the fresh answer while the query runs
+            store = asyncio.ensure_future(asyncio.to_thread(
+                answer_cache.store, question, mode, generated["schema_info"], generated["response"], result["sql"]))
+
+        estimate = None
+        if result["valid"]:
+            estimate, _ = await run_stage(timings, "cost", query_cost.estimate_query_cost, result["sql"])
+            result["cost"] = estimate._asdict() if estimate is not None else None
+
+        if execute and result["valid"] and estimate is not None and estimate.needs_confirmation and not allow_expensive:
+            result["error"] = query_cost.held_message(estimate)
+        elif execute and result["valid"]:
+            guard = database.QueryGuard()
+            try:
+                df, error, _, result["result_cache"] = await run_stage(
+                    timings, "execution", _execute, result["sql"], guard)
+            except asyncio.CancelledError:
+                # The worker thread cannot be cancelled - stop the query itself
+                guard.cancel()
+                raise
+            if error:
+                result["error"] = error
+            else:
+                result["row_count"] = len(df)
+                result["truncated"] = bool(df.attrs.get("truncated"))
+                result["columns"] = [str(col) for col in df.columns]
+                sample = df if max_rows is None else df.head(max_rows)
+                # Round-trip through to_json so numpy/date values serialize cleanly
+                result["rows"] = json.loads(sample.to_json(orient="values", date_format="iso"))
+        elif not result["valid"]:
+            result["error"] = result["validation_message"]
+
+        if store is not None:
+            await store
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        result["error"] = str(e)
+    finally:
+        timings["total"] = round((time.perf_counter() - start) * 1000, 3)
+
+    return result
+
+
+def answer_question(question, schema_info=None, mode="basic", execute=True, max_rows=100, top_k=3,
+                    allow_expensive=False):
+    """Synchronous wrapper around answer_question_async"""
+    return run(answer_question_async(question, schema_info, mode, execute, max_rows, top_k, allow_expensive))
+
+
+def generate(question, schema_info=None, mode="basic", top_k=3):
+    """Synchronous wrapper around generate_async (used by the apps)"""
+    return run(generate_async(question, schema_info, mode, top_k))
+
+
+def run_batch(questions, workers=4, **kwargs):
+    """
+    Answer an iterable of questions concurrently, yielding results in input order
+    At most workers questions run at once and workers * 4 are scheduled, so
+    arbitrarily large inputs stream through in bounded memory. Extra kwargs are
+    passed to answer_question_async.
+    """
+    if kwargs.get("schema_info") is None:
+        # Load once up front - this also builds the database before questions race for it
+        kwargs["schema_info"] = schema_cache.get_database_schema()
+
+    semaphore = asyncio.Semaphore(max(1, workers))
+
+    async def bounded(question):
+        async with semaphore:
+            return await answer_question_async(question, **kwargs)
+
+    max_in_flight = max(1, workers) * 4
+    pending = deque()
+    try:
+        for question in questions:
+            pending.append(submit(bounded(question)))
+            if len(pending) >= max_in_flight:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        # Consumer stopped early (or failed): drop the questions still queued
+        for future in pending:
+            future.cancel()
@@ -0,0 +1,150 @@
+"""
+On-demand export of query results
+Nothing is serialized until a download is requested. Rows are then read
+from the paged result in EXPORT_CHUNK_ROWS chunks and written straight into
+the chosen format (CSV, gzip-compressed CSV or Parquet), so no full-size
+DataFrame or CSV string is built along the way. The paged result itself keeps
+every row it fetches (at most QUERY_MAX_ROWS) so its pages stay browsable, so
+exporting does hold the whole result in memory once. Finished files are cached
+per result id, which lets reruns and repeated downloads reuse them; the cache
+is bounded by EXPORT_CACHE_MAX_MB.
+"""
+
+import gzip
+import importlib.util
+import io
+import logging
+import sqlite3
+import threading
+from collections import OrderedDict, namedtuple
+
+from config import get_int_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_ROWS = 10_000
+DEFAULT_CACHE_MAX_MB = 128
+
+ExportFormat = namedtuple("ExportFormat", ["label", "extension", "mime"])
+
+FORMATS = OrderedDict([
+    ("csv", ExportFormat("CSV", ".csv", "text/csv")),
+    ("csv.gz", ExportFormat("CSV (gzip)", ".csv.gz", "application/gzip")),
+    ("parquet", ExportFormat("Parquet", ".parquet", "application/vnd.apache.parquet")),
+])
+
+_exports = OrderedDict()  # (result_id, format) -> bytes
+_exports_bytes = 0
+_exports_lock = threading.Lock()
+
+
+def parquet_available():
+    """Whether pyarrow is installed for Parquet export"""
+    return importlib.util.find_spec("pyarrow") is not None
+
+
+def available_formats():
+    """Export formats usable in this environment"""
+    return [fmt for fmt in FORMATS if fmt != "parquet" or parquet_available()]
+
+
+def _write_csv(frames, fileobj):
+    text = io.TextIOWrapper(fileobj, encoding="utf-8", newline="")
+    for i, frame in enumerate(frames):
+        frame.to_csv(text, index=False, header=(i == 0))
+    text.flush()
+    text.detach()
+
+
+def _write_parquet(frames, fileobj):
+    """One row group per chunk; every chunk must fit the first chunk's column types"""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    writer = None
+    try:
+        for frame in frames:
+            table = pa.Table.from_pandas(frame, preserve_index=False)
+            if writer is None:
+                # All-NULL columns in the first chunk would be typed null; widen them to string
+                schema = pa.schema([
+                    field.with_type(pa.string()) if pa.types.is_null(field.type) else field
+                    for field in table.schema
+                ])
+                writer = pq.ParquetWriter(fileobj, schema)
+            writer.write_table(table.cast(writer.schema))
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def _build(result, fmt, chunk_rows):
+    buffer = io.BytesIO()
+    frames = result.iter_frames(chunk_rows)
+    if fmt == "csv":
+        _write_csv(frames, buffer)
+    elif fmt == "csv.gz":
+        with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=6) as gz:
+            _write_csv(frames, gz)
+    else:
+        _write_parquet(frames, buffer)
+    return buffer.getvalue()
+
+
+def _cache_put(key, data):
+    global _exports_bytes
+    max_bytes = get_int_setting("EXPORT_CACHE_MAX_MB", DEFAULT_CACHE_MAX_MB) * 1024 * 1024
+    with _exports_lock:
+        old = _exports.pop(key, None)
+        if old is not None:
+            _exports_bytes -= len(old)
+        if len(data) > max_bytes:
+            return
+        _exports[key] = data
+        _exports_bytes += len(data)
+        while _exports_bytes > max_bytes and _exports:
+            _, evicted = _exports.popitem(last=False)
+            _exports_bytes -= len(evicted)
+
+
+def cached_export(result, fmt):
+    """Bytes of an export already built for this result, or None"""
+    with _exports_lock:
+        data = _exports.get((result.result_id, fmt))
+        if data is not None:
+            _exports.move_to_end((result.result_id, fmt))
+        return data
+
+
+def export_result(result, fmt):
+    """
+    Serialize a paged result in the given format
+    Returns (bytes, error); the export is cached under the result id.
+    """
+    if fmt not in FORMATS:
+        return None, f"Unknown export format: {fmt}"
+    if fmt == "parquet" and not parquet_available():
+        return None, "Parquet export requires pyarrow (pip install pyarrow)"
+
+    data = cached_export(result, fmt)
+    if data is not None:
+        return data, None
+
+    try:
+        data = _build(result, fmt, get_int_setting("EXPORT_CHUNK_ROWS", DEFAULT_CHUNK_ROWS))
+    except sqlite3.Error as e:
+        return None, f"Export failed while fetching rows: {e}"
+    except Exception as e:
+        logger.warning("Export of result %s as %s failed: %s", result.result_id, fmt, e)
+        return None, f"Export failed: {e}"
+
+    _cache_put((result.result_id, fmt), data)
+    return data, None
+
+
+def discard(result_id):
+    """Drop every cached export of a result"""
+    global _exports_bytes
+    with _exports_lock:
+        for key in [key for key in _exports if key[0] == result_id]:
+            _exports_bytes -= len(_exports.pop(key))
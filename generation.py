@@ -0,0 +1,372 @@
+"""
+SQL generation with Azure OpenAI GPT-4o-mini
+Prompt building, the LLM call and response parsing for both app flavours:
+plain SQL (basic app) and SQL plus complexity metadata (advanced app)
+"""
+
+import json
+import re
+
+import tracing
+from clients import build_http_client, call_with_retry, get_request_timeout, shared_client
+from config import ConfigurationError, get_setting
+from retrieval import relevant_table_names
+from schema_cache import render_prompt_schema
+
+LLM_MODEL = "gpt-4o-mini"
+AZURE_API_VERSION = "2024-02-15-preview"
+
+# Field headers of the advanced reply format, in the order they are requested
+FIELD_MARKERS = ("SQL:", "COMPLEXITY:", "ROWS_ESTIMATED:", "NOTES:")
+
+# Replacement for the Azure OpenAI call (prompt -> reply text), e.g. benchmark.RecordedLLM
+_llm_backend = None
+
+
+def get_llm_client():
+    """Shared Azure OpenAI client (created once per process, reused across sessions)"""
+    api_key = get_setting("AZURE_OPENAI_API_KEY")
+    endpoint = get_setting("AZURE_OPENAI_ENDPOINT")
+
+    if not api_key or not endpoint:
+        raise ConfigurationError(
+            "Azure OpenAI credentials not configured. Please set AZURE_OPENAI_API_KEY and "
+            "AZURE_OPENAI_ENDPOINT in .streamlit/secrets.toml or .env file"
+        )
+
+    def create():
+        from openai import AzureOpenAI
+        return AzureOpenAI(
+            api_key=api_key,
+            api_version=AZURE_API_VERSION,
+            azure_endpoint=endpoint,
+            timeout=get_request_timeout(),
+            # Retries are handled by call_with_retry so the policy is the same for every service
+            max_retries=0,
+            http_client=build_http_client()
+        )
+
+    return shared_client("azure_openai", (endpoint, api_key), create)
+
+
+def set_llm_backend(backend):
+    """Answer prompts with backend(prompt) instead of Azure OpenAI (None restores Azure OpenAI)"""
+    global _llm_backend
+    _llm_backend = backend
+
+
+def _response_format(json_mode):
+    # JSON mode makes the service return a syntactically valid JSON object
+    return {"response_format": {"type": "json_object"}} if json_mode else {}
+
+
+def complete(prompt, json_mode=False):
+    """Send a single-turn prompt to the model and return the reply text (json_mode: ask for a JSON object)"""
+    if _llm_backend is not None:
+        return _llm_backend(prompt).strip()
+    return azure_complete(prompt, json_mode)
+
+
+def azure_complete(prompt, json_mode=False):
+    """complete() against Azure OpenAI, regardless of any backend set with set_llm_backend"""
+    client = get_llm_client()
+    message = call_with_retry(
+        client.chat.completions.create,
+        model=LLM_MODEL,
+        messages=[
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.2,
+        max_tokens=512,
+        **_response_format(json_mode)
+    )
+    if message.usage is not None:
+        tracing.annotate(prompt_tokens=message.usage.prompt_tokens,
+                         completion_tokens=message.usage.completion_tokens)
+    return message.choices[0].message.content.strip()
+
+
+def stream_complete(prompt, json_mode=False):
+    """Send a single-turn prompt with streaming enabled, yielding reply text as it arrives"""
+    if _llm_backend is not None:
+        # Replacement backends are not streamed: the whole reply arrives as one chunk
+        yield _llm_backend(prompt)
+        return
+    client = get_llm_client()
+    # Only opening the stream is retried; a failure mid-reply propagates
+    stream = call_with_retry(
+        client.chat.completions.create,
+        model=LLM_MODEL,
+        messages=[
+            {"role": "user", "content": prompt}
+        ],
+        temperature=0.2,
+        max_tokens=512,
+        stream=True,
+        # Real token counts arrive in a final chunk with no choices
+        stream_options={"include_usage": True},
+        **_response_format(json_mode)
+    )
+    chunks = 0
+    usage = None
+    for chunk in stream:
+        usage = getattr(chunk, "usage", None) or usage
+        # Azure sends a leading chunk with no choices (content filter results)
+        if chunk.choices and chunk.choices[0].delta.content:
+            chunks += 1
+            yield chunk.choices[0].delta.content
+    if usage is not None:
+        tracing.annotate(prompt_tokens=usage.prompt_tokens, completion_tokens=usage.completion_tokens)
+    else:
+        # Fallback for endpoints that ignore include_usage: one content chunk per token,
+        # ~4 prompt characters per token
+        tracing.annotate(prompt_tokens=len(prompt) // 4, completion_tokens=chunks, tokens_estimated=True)
+
+
+def repair_section(repair):
+    """Prompt block feeding back a rejected query and its SQLite error (repair = (sql, error) or None)"""
+    if not repair:
+        return ""
+    failed_sql, error = repair
+    return f"""PREVIOUS ATTEMPT (rejected by SQLite):
+{failed_sql}
+
+SQLITE ERROR: {error}
+
+Fix the query so that it runs on SQLite, keeping the requested response format.
+
+"""
+
+
+def build_sql_prompt(user_query, schema_info, matches=None, repair=None):
+    """Prompt asking for the SQL query only"""
+    # Compact schema: full lines for the retrieved tables, names for the rest
+    schema_text = render_prompt_schema(schema_info, relevant_table_names(matches))
+
+    return f"""You are a SQL query expert. Convert the following natural language query into a valid SQLite SQL query.
+
+DATABASE SCHEMA (PK = primary key, FK→ = foreign key target):
+{schema_text}
+
+IMPORTANT RULES:
+1. Only use tables and columns that exist in the schema
+2. Return ONLY the SQL query, nothing else
+3. Use SQLite syntax
+4. Make sure the query is valid and will execute
+5. Include appropriate JOINs if needed
+6. Use meaningful aliases for clarity
+7. Do NOT include markdown formatting or code blocks
+8. Do NOT include explanations, only the SQL query
+
+{repair_section(repair)}USER QUERY: {user_query}
+
+RESPONSE (SQL QUERY ONLY):"""
+
+
+def build_prompt(user_query, schema_info, matches=None, mode="basic", repair=None):
+    """build_validation_prompt for mode="advanced", else build_sql_prompt"""
+    if mode == "advanced":
+        return build_validation_prompt(user_query, schema_info, matches, repair)
+    return build_sql_prompt(user_query, schema_info, matches, repair)
+
+
+def build_validation_prompt(user_query, schema_info, matches=None, repair=None):
+    """Prompt asking for a JSON reply: SQL plus complexity, row estimate and optimization notes"""
+    schema_text = render_prompt_schema(schema_info, relevant_table_names(matches))
+
+    return f"""You are an expert SQL query generator. Convert this natural language query to SQL.
+
+DATABASE SCHEMA (PK = primary key, FK→ = foreign key target):
+{schema_text}
+
+RULES:
+1. Only use existing tables and columns
+2. Put the complete SQL query in the "sql" field
+3. Use SQLite syntax
+4. Optimize for performance (use indexes, proper JOINs)
+5. No markdown formatting
+6. Make the query readable with proper formatting
+
+Also provide:
+- Query complexity (Simple/Medium/Complex)
+- Estimated rows affected
+- Suggested indexes (if any)
+
+Respond with a single JSON object and nothing else:
+{{"sql": "<your SQL query>", "complexity": "Simple|Medium|Complex", "estimated_rows": <approximate number>, "notes": "<any optimization notes>"}}
+
+{repair_section(repair)}USER QUERY: {user_query}"""
+
+
+def clean_sql(sql_query):
+    """Remove markdown code blocks if present (also a still-open fence while streaming)"""
+    sql_query = sql_query.strip()
+    if sql_query.startswith('```'):
+        sql_query = re.sub(r'^```(sql)?\n?', '', sql_query)
+        sql_query = re.sub(r'\n?`{1,3}$', '', sql_query)
+    return sql_query.strip()
+
+
+def statement_end(sql_query):
+    """Index just past the first ';' outside string literals, quoted names and comments, or -1"""
+    closers = {"'": "'", '"': '"', "`": "`", "--": "\n", "/*": "*/"}
+    i = 0
+    while i < len(sql_query):
+        opener = sql_query[i:i + 2] if sql_query[i:i + 2] in ("--", "/*") else sql_query[i]
+        if opener in closers:
+            # An unterminated literal or comment: the statement is not complete yet
+            close = sql_query.find(closers[opener], i + len(opener))
+            if close == -1:
+                return -1
+            i = close + len(closers[opener])
+        elif opener == ';':
+            return i + 1
+        else:
+            i += 1
+    return -1
+
+
+def split_fields(response_text):
+    """Split a FIELD: value reply into {field: value}; a value runs until the next field line"""
+    fields = {}
+    current = None
+    for line in response_text.split('\n'):
+        marker = next((m for m in FIELD_MARKERS if line.startswith(m)), None)
+        if marker:
+            current = marker[:-1]
+            fields[current] = line[len(marker):]
+        elif current:
+            fields[current] += '\n' + line
+    return {field: value.strip() for field, value in fields.items()}
+
+
+def parse_json_response(response_text):
+    """The JSON object in a reply (code fences or stray text around it are ignored), or None"""
+    start, end = response_text.find('{'), response_text.rfind('}')
+    if start < 0 or end < start:
+        return None
+    try:
+        data = json.loads(response_text[start:end + 1], strict=False)
+    except ValueError:
+        return None
+    return data if isinstance(data, dict) else None
+
+
+def json_string_prefix(response_text, key):
+    """
+    Value of a string field in a JSON reply that may still be streaming
+    Returns (text decoded so far, whether its closing quote has arrived).
+    """
+    match = re.search(r'"%s"\s*:\s*"' % re.escape(key), response_text)
+    if not match:
+        return "", False
+    start = i = match.end()
+    while i < len(response_text):
+        char = response_text[i]
+        if char == '\\':
+            step = 6 if response_text[i + 1:i + 2] == 'u' else 2
+            if i + step > len(response_text):
+                break  # escape sequence not fully received yet
+            i += step
+        elif char == '"':
+            return json.loads(response_text[start - 1:i + 1], strict=False), True
+        else:
+            i += 1
+    return json.loads('"' + response_text[start:i] + '"', strict=False), False
+
+
+def parse_validation_response(response_text):
+    """Parse the JSON reply, or the older SQL: / COMPLEXITY: / ROWS_ESTIMATED: / NOTES: format (the SQL may span lines)"""
+    parsed = {
+        'sql': '',
+        'complexity': 'Unknown',
+        'estimated_rows': 0,
+        'notes': ''
+    }
+
+    data = parse_json_response(response_text)
+    if data is not None:
+        parsed['sql'] = clean_sql(str(data.get('sql') or ''))
+        if data.get('complexity'):
+            parsed['complexity'] = str(data['complexity']).strip()
+        try:
+            parsed['estimated_rows'] = int(data.get('estimated_rows') or 0)
+        except (TypeError, ValueError):
+            pass
+        notes = data.get('notes') or ''
+        parsed['notes'] = '\n'.join(str(note) for note in notes) if isinstance(notes, list) else str(notes)
+        return parsed
+
+    fields = split_fields(response_text)
+    parsed['sql'] = clean_sql(fields.get('SQL', ''))
+    if fields.get('COMPLEXITY'):
+        parsed['complexity'] = fields['COMPLEXITY'].split('\n')[0].strip()
+    try:
+        parsed['estimated_rows'] = int(fields.get('ROWS_ESTIMATED', '').split('\n')[0].strip())
+    except ValueError:
+        pass
+    parsed['notes'] = fields.get('NOTES', '')
+
+    return parsed
+
+
+def parse_response(response_text, mode="basic"):
+    """parse_validation_response for mode="advanced", else the cleaned SQL"""
+    if mode == "advanced":
+        return parse_validation_response(response_text)
+    return clean_sql(response_text)
+
+
+class StreamingSqlParser:
+    """
+    Incremental parser for a streamed reply
+    In basic mode the whole reply is the SQL; in advanced mode it is the "sql"
+    string of the JSON object (or the SQL: field of the older format). The
+    statement counts as complete at its terminating ';', when its JSON string
+    closes / the next field starts, or when the stream ends - whichever comes
+    first - so it can be validated while the rest of the reply is still arriving.
+    """
+
+    def __init__(self, mode="basic"):
+        self.mode = mode
+        self.text = ""
+        self.finished = False
+
+    def feed(self, delta):
+        self.text += delta
+
+    def finish(self):
+        self.finished = True
+
+    def _is_json(self):
+        return self.mode == "advanced" and self.text.lstrip().startswith(('{', '```'))
+
+    def _sql_text(self):
+        if self._is_json():
+            return json_string_prefix(self.text, 'sql')[0]
+        if self.mode == "advanced":
+            return split_fields(self.text).get('SQL', '')
+        return self.text
+
+    @property
+    def sql(self):
+        """SQL received so far (up to the terminating ';' once there is one)"""
+        sql_query = clean_sql(self._sql_text())
+        end = statement_end(sql_query)
+        return sql_query[:end] if end >= 0 else sql_query
+
+    @property
+    def sql_complete(self):
+        """Whether the SQL statement has been fully received"""
+        if self.finished or statement_end(clean_sql(self._sql_text())) >= 0:
+            return True
+        if self._is_json():
+            return json_string_prefix(self.text, 'sql')[1]
+        if self.mode == "advanced":
+            fields = split_fields(self.text)
+            return 'SQL' in fields and len(fields) > 1
+        return False
+
+    def result(self):
+        """Final parse: the SQL string (basic) or the parse_validation_response dict (advanced)"""
+        return parse_response(self.text, self.mode)
@@ -0,0 +1,438 @@
+"""
+Workload-driven index advisor
+Replays the heaviest executed queries (workload.py, or a batch_runner results
+file) and looks at their plans for full table scans, automatic indexes and
+temp B-tree sorts. For the tables involved it proposes composite and covering
+indexes built from the columns those queries actually filter, join, group and
+sort on. Every candidate is measured on a scratch copy of the database: create
+it, ANALYZE it, replay the queries that touch its table and compare against
+the baseline. Candidates the planner uses and that save at least
+ADVISOR_MIN_GAIN of the affected queries' time are recommended, best first.
+Queries are replayed as they are executed, i.e. after the rollup rewrite
+(rollups.py); the rollup and other _-prefixed tables get no candidates.
+
+Applying recommendations records them in ADVISED_INDEXES_FILE (see schema.py);
+their tables' DDL hash changes, so the loader rebuilds them with the new
+indexes and swaps the database in as it does for CSV changes.
+
+Usage:
+    python index_advisor.py                      # analyse the workload log
+    python index_advisor.py results.jsonl --apply
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import sys
+import tempfile
+import time
+from collections import Counter, namedtuple
+from contextlib import contextmanager
+from pathlib import Path
+
+import database
+import loader
+import query_cost
+import result_cache
+import rollups
+import schema
+import workload
+from config import get_float_setting, get_int_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_QUERIES = 50
+DEFAULT_REPEAT = 3
+DEFAULT_MAX_INDEXES = 3
+DEFAULT_MIN_GAIN = 0.1
+MAX_INDEX_COLUMNS = 5
+
+Finding = namedtuple("Finding", ["table", "kind", "detail"])
+Candidate = namedtuple("Candidate", ["table", "columns", "reasons"])
+Recommendation = namedtuple("Recommendation", [
+    "table", "columns", "sql", "reasons", "queries", "baseline_ms", "indexed_ms", "benefit_ms", "gain", "size_kb"
+])
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+COLUMN_REF = re.compile(r"\b(?:(\w+)\.)?(\w+)\b")
+PREDICATE = re.compile(
+    r"(?:(\w+)\.)?(\w+)\s*(<>|!=|==|=|<=|>=|<|>|\bIN\b|\bBETWEEN\b)\s*(?:(\w+)\.)?(\w+)?", re.IGNORECASE)
+SORT_CLAUSE = re.compile(
+    r"\b(GROUP|ORDER)\s+BY\s+(.+?)(?=\bHAVING\b|\bORDER\s+BY\b|\bLIMIT\b|\bUNION\b|\bWINDOW\b|\)|;|$)",
+    re.IGNORECASE | re.DOTALL)
+AUTOMATIC_INDEX = re.compile(r"^SEARCH (\S+) USING AUTOMATIC (?:PARTIAL )?(?:COVERING )?INDEX \((.*)\)")
+EQUALITY_OPERATORS = {"=", "==", "in"}
+RANGE_OPERATORS = {"<", ">", "<=", ">=", "between"}
+
+
+def load_workload(path=None, limit=DEFAULT_MAX_QUERIES):
+    """
+    [(sql, executions)] of the heaviest queries
+    From the workload log by default, or from a JSONL file with a "sql" field per
+    line (e.g. batch_runner output; lines with an "error" are skipped).
+    """
+    if path is None:
+        return [(query.sql, query.executions) for query in workload.top_queries(limit)]
+    counts, samples = Counter(), {}
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if not record.get("sql") or record.get("error"):
+                continue
+            key = result_cache.canonicalize_sql(record["sql"])
+            counts[key] += 1
+            samples.setdefault(key, record["sql"])
+    return [(samples[key], count) for key, count in counts.most_common(limit)]
+
+
+def _table_columns(conn):
+    """{table: [column, ...]} plus {table: rowid alias column or None}"""
+    columns, rowid = {}, {}
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' "
+        "AND name NOT LIKE 'sqlite_%' AND name NOT LIKE '\\_%' ESCAPE '\\'")]
+    for table in tables:
+        info = conn.execute(f'PRAGMA table_info("{table}")').fetchall()
+        columns[table.lower()] = [row[1].lower() for row in info]
+        pk = [row for row in info if row[5]]
+        rowid[table.lower()] = pk[0][1].lower() if len(pk) == 1 and pk[0][2].upper() == "INTEGER" else None
+    return columns, rowid
+
+
+def _existing_indexes(conn, table):
+    """Column lists of the table's current indexes (including primary key / unique autoindexes)"""
+    indexes = []
+    for row in conn.execute(f'PRAGMA index_list("{table}")').fetchall():
+        indexes.append([col[2].lower() for col in conn.execute(f'PRAGMA index_info("{row[1]}")').fetchall()])
+    return indexes
+
+
+def column_refs(sql, aliases, columns):
+    """
+    How the statement uses each table's columns
+    Returns {table: {"eq": [...], "range": [...], "sort": [...], "used": [...]}};
+    bare column names count for every table of the statement that has them.
+    """
+    text = STRING_LITERAL.sub("?", sql)
+    tables = sorted(set(aliases.values()))
+    refs = {table: {"eq": [], "range": [], "sort": [], "used": []} for table in tables}
+
+    def resolve(qualifier, name):
+        name = name.lower()
+        if qualifier:
+            table = aliases.get(qualifier.lower())
+            return [table] if table and name in columns.get(table, []) else []
+        return [table for table in tables if name in columns.get(table, [])]
+
+    def add(kind, qualifier, name):
+        for table in resolve(qualifier, name):
+            if name.lower() not in refs[table][kind]:
+                refs[table][kind].append(name.lower())
+
+    for qualifier, name in COLUMN_REF.findall(text):
+        add("used", qualifier, name)
+    for left_q, left, operator, right_q, right in PREDICATE.findall(text):
+        operator = operator.lower()
+        kind = "eq" if operator in EQUALITY_OPERATORS else "range" if operator in RANGE_OPERATORS else None
+        if kind is None:
+            continue
+        add(kind, left_q, left)
+        if right:
+            add(kind, right_q, right)  # join key or reversed comparison
+    for _, clause in SORT_CLAUSE.findall(text):
+        for qualifier, name in COLUMN_REF.findall(clause):
+            add("sort", qualifier, name)
+    return refs
+
+
+def plan_findings(conn, sql, aliases):
+    """Full scans, automatic indexes and temp B-trees in the statement's plan"""
+    findings = []
+    for _, _, _, detail in conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall():
+        loop = query_cost.LOOP.match(detail)
+        automatic = AUTOMATIC_INDEX.match(detail)
+        if automatic and automatic.group(1).lower() in aliases:
+            findings.append(Finding(aliases[automatic.group(1).lower()], "automatic index", detail))
+        elif loop and loop.group(1) == "SCAN" and loop.group(2).lower() in aliases:
+            findings.append(Finding(aliases[loop.group(2).lower()], "full scan", detail))
+        elif query_cost.TEMP_BTREE.match(detail):
+            findings.append(Finding(None, "temp b-tree", detail))
+    return findings
+
+
+def _candidate_columns(refs, automatic_columns):
+    """(columns, reason) index shapes for one table of one statement"""
+    eq, sort = refs["eq"], refs["sort"]
+    ranges = [col for col in refs["range"] if col not in eq]
+    shapes = []
+    if automatic_columns:
+        shapes.append((automatic_columns, "join key SQLite indexes on the fly"))
+    if eq:
+        shapes.append((eq + ranges[:1], "filter / join columns"))
+    elif ranges:
+        shapes.append((ranges[:1], "range filter"))
+    if sort:
+        leading = eq if eq else []
+        shapes.append((leading + [col for col in sort if col not in leading], "grouping / sort order"))
+    for columns, reason in list(shapes):
+        rest = [col for col in refs["used"] if col not in columns]
+        if rest and len(columns) + len(rest) <= MAX_INDEX_COLUMNS:
+            shapes.append((columns + rest, f"covering ({reason})"))
+    return [(columns[:MAX_INDEX_COLUMNS], reason) for columns, reason in shapes if columns]
+
+
+def find_candidates(conn, queries):
+    """
+    Candidate indexes for a workload of (sql, executions)
+    Returns (candidates, findings, affected) where findings counts (table, kind)
+    weighted by executions and affected maps each table to the queries reading it.
+    """
+    columns, rowid = _table_columns(conn)
+    table_rows = {table: 1 for table in columns}
+    candidates, findings, affected = {}, Counter(), {}
+    existing = {table: _existing_indexes(conn, table) for table in columns}
+
+    for sql, executions in queries:
+        aliases = query_cost.resolve_aliases(sql, table_rows)
+        try:
+            query_findings = plan_findings(conn, sql, aliases)
+        except sqlite3.Error as e:
+            logger.info("Skipping workload query that no longer compiles: %s", e)
+            continue
+        for table in set(aliases.values()):
+            affected.setdefault(table, []).append((sql, executions))
+        for finding in query_findings:
+            findings[(finding.table, finding.kind)] += executions
+
+        flagged = {finding.table for finding in query_findings if finding.table}
+        sorts = any(finding.kind == "temp b-tree" for finding in query_findings)
+        refs = column_refs(sql, aliases, columns)
+        for table, table_refs in refs.items():
+            if table not in flagged and not (sorts and table_refs["sort"]):
+                continue
+            automatic_columns = []
+            for finding in query_findings:
+                match = AUTOMATIC_INDEX.match(finding.detail)
+                if finding.table == table and match:
+                    automatic_columns = [term.split("=")[0].lower() for term in match.group(2).split(" AND ")]
+            for shape, reason in _candidate_columns(table_refs, automatic_columns):
+                if shape[0] == rowid[table]:
+                    continue  # already the rowid
+                if any(index[:len(shape)] == shape for index in existing[table]):
+                    continue  # an existing index already starts with these columns
+                key = (table, tuple(shape))
+                if key not in candidates:
+                    candidates[key] = Candidate(table, shape, [])
+                if reason not in candidates[key].reasons:
+                    candidates[key].reasons.append(reason)
+    return list(candidates.values()), findings, affected
+
+
+@contextmanager
+def scratch_database(db_path=None):
+    """Connection to a throwaway copy of the database (deleted afterwards)"""
+    db_path = Path(db_path or database.get_database_path())
+    fd, scratch_path = tempfile.mkstemp(prefix=f"{db_path.name}.", suffix=".advisor", dir=db_path.parent)
+    os.close(fd)
+    try:
+        live = sqlite3.connect(f"{db_path.resolve().as_uri()}?mode=ro", uri=True)
+        scratch = sqlite3.connect(scratch_path, isolation_level=None, check_same_thread=False)
+        try:
+            live.backup(scratch)
+        finally:
+            live.close()
+        try:
+            yield scratch
+        finally:
+            scratch.close()
+    finally:
+        os.remove(scratch_path)
+
+
+def replay(conn, sql, repeat=DEFAULT_REPEAT):
+    """Fastest of repeat runs of the statement, in milliseconds (rows are fetched and discarded)"""
+    best = None
+    for _ in range(max(1, repeat)):
+        guard = database.QueryGuard()
+        guard.attach(conn)
+        start = time.perf_counter()
+        try:
+            cursor = conn.execute(sql)
+            while cursor.fetchmany(1000):
+                pass
+        except sqlite3.OperationalError:
+            if not guard.stopped:
+                raise
+        finally:
+            guard.detach(conn)
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def _used_bytes(conn):
+    """Bytes in use by the database (pages freed by dropped candidates are reused, not counted)"""
+    pages = conn.execute("PRAGMA page_count").fetchone()[0] - conn.execute("PRAGMA freelist_count").fetchone()[0]
+    return pages * conn.execute("PRAGMA page_size").fetchone()[0]
+
+
+def _create(conn, table, columns):
+    name = schema.index_name(table, columns)
+    conn.execute(f"CREATE INDEX {name} ON {table} ({', '.join(columns)})")
+    conn.execute(f"ANALYZE {name}")
+    return name
+
+
+def _uses_index(conn, queries, name):
+    return any(name in detail for sql, _ in queries
+               for _, _, _, detail in conn.execute(f"EXPLAIN QUERY PLAN {sql}").fetchall())
+
+
+def evaluate(conn, candidate, queries, baseline, repeat=DEFAULT_REPEAT):
+    """Recommendation for one candidate measured against the baseline times, or None if the planner ignores it"""
+    size_before = _used_bytes(conn)
+    name = _create(conn, candidate.table, candidate.columns)
+    try:
+        size_kb = max(0, _used_bytes(conn) - size_before) // 1024
+        if not _uses_index(conn, queries, name):
+            return None
+        before = sum(baseline[sql] * executions for sql, executions in queries)
+        after = sum(replay(conn, sql, repeat) * executions for sql, executions in queries)
+    finally:
+        conn.execute(f"DROP INDEX {name}")
+    return Recommendation(
+        table=candidate.table,
+        columns=candidate.columns,
+        sql=f"CREATE INDEX {name} ON {candidate.table} ({', '.join(candidate.columns)})",
+        reasons=candidate.reasons,
+        queries=len(queries),
+        baseline_ms=round(before, 3),
+        indexed_ms=round(after, 3),
+        benefit_ms=round(before - after, 3),
+        gain=(before - after) / before if before else 0.0,
+        size_kb=size_kb
+    )
+
+
+def _overlaps(a, b):
+    return a.table == b.table and (a.columns[:len(b.columns)] == b.columns or b.columns[:len(a.columns)] == a.columns)
+
+
+def advise(queries=None, repeat=None, max_indexes=None, min_gain=None, db_path=None):
+    """
+    Recommend indexes for a workload of (sql, executions) (default: the workload log)
+    Returns (recommendations, summary); summary holds the findings, the number of
+    candidates tried and the workload time before and after the recommendations.
+    """
+    queries = load_workload() if queries is None else queries
+    # Measure what execution actually runs: aggregates a rollup answers read the rollup
+    queries = [(rollups.rewrite(sql)[0], executions) for sql, executions in queries]
+    repeat = repeat or get_int_setting("ADVISOR_REPEAT", DEFAULT_REPEAT)
+    max_indexes = max_indexes if max_indexes is not None else get_int_setting("ADVISOR_MAX_INDEXES",
+                                                                              DEFAULT_MAX_INDEXES)
+    min_gain = min_gain if min_gain is not None else get_float_setting("ADVISOR_MIN_GAIN", DEFAULT_MIN_GAIN)
+    summary = {"queries": len(queries), "findings": {}, "candidates": 0, "baseline_ms": 0.0, "advised_ms": 0.0}
+    if not queries:
+        return [], summary
+
+    with scratch_database(db_path) as conn:
+        candidates, findings, affected = find_candidates(conn, queries)
+        summary["findings"] = {f"{table or '-'}: {kind}": count for (table, kind), count in findings.most_common()}
+        summary["candidates"] = len(candidates)
+        replayable = {sql for table_queries in affected.values() for sql, _ in table_queries}
+        workload_queries = [(sql, executions) for sql, executions in queries if sql in replayable]
+        baseline = {sql: replay(conn, sql, repeat) for sql, _ in workload_queries}
+
+        def worthwhile(recommendation):
+            return recommendation is not None and recommendation.benefit_ms > 0 and recommendation.gain >= min_gain
+
+        evaluated = [recommendation for recommendation in
+                     (evaluate(conn, candidate, affected[candidate.table], baseline, repeat) for candidate in candidates)
+                     if worthwhile(recommendation)]
+
+        # Greedy: best first, each later one on the same table judged with the earlier ones in place
+        recommendations = []
+        for recommendation in sorted(evaluated, key=lambda r: r.benefit_ms, reverse=True):
+            if len(recommendations) >= max_indexes:
+                break
+            if any(_overlaps(recommendation, chosen) for chosen in recommendations):
+                continue
+            if any(chosen.table == recommendation.table for chosen in recommendations):
+                table_queries = affected[recommendation.table]
+                current = {sql: replay(conn, sql, repeat) for sql, _ in table_queries}
+                recommendation = evaluate(conn, Candidate(recommendation.table, recommendation.columns,
+                                                          recommendation.reasons), table_queries, current, repeat)
+                if not worthwhile(recommendation):
+                    continue
+            recommendations.append(recommendation)
+            _create(conn, recommendation.table, recommendation.columns)
+
+        summary["baseline_ms"] = round(sum(baseline[sql] * executions for sql, executions in workload_queries), 3)
+        summary["advised_ms"] = round(sum(replay(conn, sql, repeat) * executions
+                                          for sql, executions in workload_queries), 3)
+    return recommendations, summary
+
+
+def apply_recommendations(recommendations, db_path=None):
+    """
+    Add the recommended indexes to ADVISED_INDEXES_FILE and rebuild their tables
+    Returns (rebuilt tables, error).
+    """
+    advised = schema.load_advised_indexes()
+    for recommendation in recommendations:
+        table_indexes = advised.setdefault(recommendation.table, [])
+        if recommendation.columns not in table_indexes:
+            table_indexes.append(list(recommendation.columns))
+    try:
+        schema.save_advised_indexes(advised)
+        rebuilt = loader.refresh_database(Path(db_path or database.get_database_path()))
+    except (OSError, sqlite3.Error) as e:
+        return [], str(e)
+    return rebuilt, None
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Recommend indexes for the executed query workload")
+    parser.add_argument("workload", nargs="?", help="JSONL file with a \"sql\" field per line (default: workload log)")
+    parser.add_argument("--limit", type=int, default=DEFAULT_MAX_QUERIES, help="heaviest queries to replay")
+    parser.add_argument("--repeat", type=int, help=f"timed runs per query (default: {DEFAULT_REPEAT})")
+    parser.add_argument("--max-indexes", type=int, help=f"indexes to recommend (default: {DEFAULT_MAX_INDEXES})")
+    parser.add_argument("--apply", action="store_true", help="add the recommendations and rebuild their tables")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, format="%(levelname)s %(name)s: %(message)s")
+    queries = load_workload(args.workload, args.limit)
+    if not queries:
+        print("No executed queries to analyse", file=sys.stderr)
+        return 1
+
+    recommendations, summary = advise(queries, repeat=args.repeat, max_indexes=args.max_indexes)
+    print(f"✓ Replayed {summary['queries']} queries, tried {summary['candidates']} candidate indexes")
+    for finding, count in summary["findings"].items():
+        print(f"  {finding:<32} {count:>6} executions")
+    if not recommendations:
+        print("No index worth adding")
+        return 0
+    for recommendation in recommendations:
+        print(f"\n{recommendation.sql}")
+        print(f"  {recommendation.gain:.0%} faster on {recommendation.queries} queries "
+              f"({recommendation.baseline_ms:.1f} → {recommendation.indexed_ms:.1f} ms), "
+              f"{recommendation.size_kb} KB; {'; '.join(recommendation.reasons)}")
+    print(f"\nWorkload: {summary['baseline_ms']:.1f} → {summary['advised_ms']:.1f} ms with all recommendations")
+
+    if args.apply:
+        rebuilt, error = apply_recommendations(recommendations)
+        if error:
+            print(f"❌ Could not apply: {error}", file=sys.stderr)
+            return 1
+        print(f"✓ Applied; rebuilt {', '.join(rebuilt) or 'nothing'}")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
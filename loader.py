@@ -0,0 +1,321 @@
+"""
+Builds and refreshes the SQLite database from the CSV exports
+Each source CSV is fingerprinted (size, mtime, SHA-256) and the fingerprints
+are stored alongside the data. A refresh rebuilds only the tables whose CSV
+or declared schema changed into a staging copy of the database, then swaps
+the staging file in with an atomic rename so readers never see a half-built
+database and are never blocked by the load. The sales rollups (rollups.py) are
+rebuilt in the same staging copy whenever their source tables change.
+
+Usage:
+    python loader.py            # rebuild changed tables
+    python loader.py --force    # rebuild everything
+"""
+
+import argparse
+import csv
+import hashlib
+import logging
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+from datetime import datetime
+from itertools import islice
+from pathlib import Path
+
+import rollups
+from schema import NULL_VALUES, TABLES, column_names, create_index_sql, create_table_sql, insert_sql
+
+logger = logging.getLogger(__name__)
+
+BASE_DIR = Path(__file__).parent
+
+# Bookkeeping table holding the fingerprint each table was last loaded from
+STATE_TABLE = "_source_files"
+
+# Rows per executemany call; bounds loader memory regardless of CSV size
+DEFAULT_BATCH_SIZE = 50_000
+
+_refresh_lock = threading.Lock()
+_refresh_thread = None
+_refresh_thread_lock = threading.Lock()
+_hash_cache = {}
+_swap_generation = 0
+
+
+def get_swap_generation():
+    """Counter bumped each time this process swaps in a rebuilt database"""
+    return _swap_generation
+
+
+def file_sha256(path, size, mtime_ns):
+    """SHA-256 of a file, cached per (path, size, mtime) so unchanged files are hashed once"""
+    key = (str(path), size, mtime_ns)
+    if key not in _hash_cache:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+        _hash_cache[key] = digest.hexdigest()
+    return _hash_cache[key]
+
+
+def ddl_hash(table_name):
+    """Hash of a table's declared DDL so schema.py edits trigger a rebuild too"""
+    ddl = "\n".join([create_table_sql(table_name)] + create_index_sql(table_name))
+    return hashlib.sha256(ddl.encode()).hexdigest()
+
+
+def fingerprint_sources(csv_dir=BASE_DIR):
+    """Current fingerprint of every table's CSV (None for missing files)"""
+    fingerprints = {}
+    for table_name, table in TABLES.items():
+        csv_path = Path(csv_dir) / table['csv']
+        if not csv_path.exists():
+            fingerprints[table_name] = None
+            continue
+        stat = csv_path.stat()
+        fingerprints[table_name] = {
+            'csv': table['csv'],
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha256': file_sha256(csv_path, stat.st_size, stat.st_mtime_ns),
+            'ddl_hash': ddl_hash(table_name)
+        }
+    return fingerprints
+
+
+def read_load_state(db_path):
+    """Fingerprints recorded in an existing database ({} if none)"""
+    db_path = Path(db_path)
+    if not db_path.exists():
+        return {}
+
+    conn = sqlite3.connect(f"{db_path.resolve().as_uri()}?mode=ro", uri=True)
+    try:
+        rows = conn.execute(f"SELECT table_name, csv, size, mtime_ns, sha256, ddl_hash FROM {STATE_TABLE}").fetchall()
+    except sqlite3.OperationalError:
+        return {}  # Database built before fingerprinting - treat every table as stale
+    finally:
+        conn.close()
+
+    return {
+        row[0]: {'csv': row[1], 'size': row[2], 'mtime_ns': row[3], 'sha256': row[4], 'ddl_hash': row[5]}
+        for row in rows
+    }
+
+
+def plan_refresh(db_path, csv_dir=BASE_DIR):
+    """Return (changed table names, current fingerprints)"""
+    current = fingerprint_sources(csv_dir)
+    loaded = read_load_state(db_path)
+
+    changed = []
+    for table_name, fingerprint in current.items():
+        previous = loaded.get(table_name)
+        if fingerprint is None:
+            # No CSV: build the empty table on first load, otherwise keep what was loaded
+            if table_name not in loaded:
+                changed.append(table_name)
+            continue
+        if (previous is None
+                or previous['sha256'] != fingerprint['sha256']
+                or previous['ddl_hash'] != fingerprint['ddl_hash']):
+            changed.append(table_name)
+    return changed, current
+
+
+def read_csv_rows(csv_path, table_name):
+    """Stream a CSV as tuples in schema column order, mapping NULL markers to None"""
+    with open(csv_path, newline='', encoding='utf-8-sig') as f:
+        reader = csv.reader(f)
+        header = [name.strip() for name in next(reader, [])]
+        missing = [name for name in column_names(table_name) if name not in header]
+        if missing:
+            raise ValueError(f"{csv_path}: missing column(s) {', '.join(missing)}")
+        positions = [header.index(name) for name in column_names(table_name)]
+        for row in reader:
+            if not row:
+                continue
+            # Values stay text; the declared column affinity does the typing
+            yield tuple(None if row[i] in NULL_VALUES else row[i] for i in positions)
+
+
+def load_table(conn, table_name, csv_path, batch_size=DEFAULT_BATCH_SIZE):
+    """Bulk-insert a CSV in fixed-size batches inside one transaction, returning the row count"""
+    rows = read_csv_rows(csv_path, table_name)
+    statement = insert_sql(table_name)
+    total = 0
+    conn.execute("BEGIN")
+    try:
+        while True:
+            batch = list(islice(rows, batch_size))
+            if not batch:
+                break
+            conn.executemany(statement, batch)
+            total += len(batch)
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return total
+
+
+def build_tables(conn, table_names, csv_dir=BASE_DIR, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    (Re)create the given tables from their CSVs with types, keys and indexes
+    Returns {table: {"rows", "seconds", "rows_per_sec"}} load statistics.
+    """
+    stats = {}
+    for table_name in table_names:
+        table = TABLES[table_name]
+        start = time.perf_counter()
+        conn.execute(f"DROP TABLE IF EXISTS {table_name}")
+        conn.execute(create_table_sql(table_name))
+
+        csv_path = Path(csv_dir) / table['csv']
+        row_count = load_table(conn, table_name, csv_path, batch_size) if csv_path.exists() else 0
+
+        # Build indexes after the bulk insert - cheaper than maintaining them row by row
+        for statement in create_index_sql(table_name):
+            conn.execute(statement)
+
+        seconds = time.perf_counter() - start
+        stats[table_name] = {
+            'rows': row_count,
+            'seconds': round(seconds, 3),
+            'rows_per_sec': round(row_count / seconds) if seconds else 0
+        }
+        logger.info("Loaded %s: %d rows in %.2fs (%d rows/s)",
+                    table_name, row_count, seconds, stats[table_name]['rows_per_sec'])
+    return stats
+
+
+def write_load_state(conn, fingerprints, table_names):
+    """Record the fingerprints the given tables were built from"""
+    conn.execute(f"""CREATE TABLE IF NOT EXISTS {STATE_TABLE} (
+    table_name TEXT PRIMARY KEY,
+    csv TEXT,
+    size INTEGER,
+    mtime_ns INTEGER,
+    sha256 TEXT,
+    ddl_hash TEXT,
+    loaded_at TEXT
+)""")
+    loaded_at = datetime.now().isoformat(timespec='seconds')
+    for table_name in table_names:
+        fingerprint = fingerprints.get(table_name) or {}
+        conn.execute(
+            f"INSERT OR REPLACE INTO {STATE_TABLE} VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (table_name, fingerprint.get('csv'), fingerprint.get('size'), fingerprint.get('mtime_ns'),
+             fingerprint.get('sha256'), fingerprint.get('ddl_hash') or ddl_hash(table_name), loaded_at)
+        )
+
+
+def refresh_database(db_path, force=False, csv_dir=BASE_DIR, batch_size=DEFAULT_BATCH_SIZE):
+    """
+    Rebuild changed tables into a staging database and atomically swap it in
+    Unchanged tables are copied from the live database with the SQLite backup
+    API, which only takes shared locks, so readers carry on during the load.
+    Returns the list of rebuilt tables and rollups (empty when everything is current).
+    """
+    global _swap_generation
+    db_path = Path(db_path)
+
+    with _refresh_lock:
+        changed, fingerprints = plan_refresh(db_path, csv_dir)
+        if force:
+            changed = list(TABLES)
+        stale = list(rollups.ROLLUPS) if force else rollups.stale_rollups(db_path, changed)
+        if not changed and not stale:
+            return []
+
+        full_rebuild = len(changed) == len(TABLES) or not db_path.exists()
+        fd, staging_path = tempfile.mkstemp(prefix=f"{db_path.name}.", suffix=".staging", dir=db_path.parent)
+        os.close(fd)
+        try:
+            if db_path.exists():
+                shutil.copymode(db_path, staging_path)
+            else:
+                os.chmod(staging_path, 0o644)
+
+            staging = sqlite3.connect(staging_path)
+            try:
+                if not full_rebuild:
+                    live = sqlite3.connect(f"{db_path.resolve().as_uri()}?mode=ro", uri=True)
+                    try:
+                        live.backup(staging)
+                    finally:
+                        live.close()
+
+                # The staging file is disposable until it is swapped in, so skip
+                # journaling and fsyncs for the bulk load
+                staging.isolation_level = None
+                staging.execute("PRAGMA journal_mode = OFF")
+                staging.execute("PRAGMA synchronous = OFF")
+                staging.execute("PRAGMA temp_store = MEMORY")
+                staging.execute(f"PRAGMA cache_size = -{256 * 1024}")
+
+                build_tables(staging, changed, csv_dir, batch_size)
+                write_load_state(staging, fingerprints, changed)
+                rollups.build_rollups(staging, stale)
+
+                # Planner statistics so JOINs pick index lookups over scans
+                staging.execute("ANALYZE")
+            finally:
+                staging.close()
+
+            # synchronous=OFF skipped every fsync - flush once before the swap
+            with open(staging_path, 'rb+') as f:
+                os.fsync(f.fileno())
+
+            # Atomic on POSIX and Windows: new connections see the new file,
+            # open ones finish on the old one
+            os.replace(staging_path, db_path)
+        except Exception:
+            if os.path.exists(staging_path):
+                os.remove(staging_path)
+            raise
+
+        _swap_generation += 1
+        logger.info("Rebuilt %s into %s", ", ".join(changed + stale), db_path)
+        return changed + stale
+
+
+def schedule_refresh(db_path, csv_dir=BASE_DIR):
+    """Run refresh_database in a background thread unless one is already running"""
+    global _refresh_thread
+
+    def run():
+        try:
+            refresh_database(db_path, csv_dir=csv_dir)
+        except Exception:
+            logger.exception("Background database refresh failed")
+
+    with _refresh_thread_lock:
+        if _refresh_thread is not None and _refresh_thread.is_alive():
+            return False
+        _refresh_thread = threading.Thread(target=run, name="db-refresh", daemon=True)
+        _refresh_thread.start()
+    return True
+
+
+def main(argv=None):
+    from database import get_database_path
+
+    parser = argparse.ArgumentParser(description="Rebuild bike_shop.db tables whose CSV changed")
+    parser.add_argument("--db", help="database path (default: DATABASE_PATH setting or ./bike_shop.db)")
+    parser.add_argument("--force", action="store_true", help="rebuild every table")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO, format="%(levelname)s %(name)s: %(message)s")
+    db_path = Path(args.db) if args.db else get_database_path()
+    changed = refresh_database(db_path, force=args.force)
+    print(f"✓ Rebuilt: {', '.join(changed)}" if changed else "✓ Database is up to date")
+
+
+if __name__ == "__main__":
+    main()
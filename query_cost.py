@@ -0,0 +1,279 @@
+"""
+Planner-based cost estimation for SQL before it runs
+Walks the EXPLAIN QUERY PLAN tree with a nested-loop model: each SCAN visits
+every row of its table, each SEARCH visits the rows one index lookup matches
+(from the sqlite_stat1 statistics the loader's ANALYZE leaves behind), and a
+loop runs once per row produced by the loops outside it. Correlated subqueries
+run once per outer row. The result is an estimate of rows visited, the tables
+scanned in full, the temp B-trees (sorts, DISTINCT, GROUP BY) and automatic
+indexes SQLite has to build, and a cost class:
+- Low / Medium: below COST_WARN_ROWS rows scanned
+- High: flagged in the apps
+- Very high: COST_CONFIRM_ROWS or more, held until the user confirms (0 disables)
+Table and index statistics are cached per data version.
+"""
+
+import re
+import sqlite3
+import threading
+from collections import namedtuple
+
+import database
+import rollups
+import tracing
+from config import get_int_setting
+
+DEFAULT_WARN_ROWS = 1_000_000
+DEFAULT_CONFIRM_ROWS = 10_000_000
+
+# Rows one equality lookup matches when the index has no statistics
+DEFAULT_ROWS_PER_KEY = 10
+# Fraction of the rows a range bound (x>?, x<?) keeps, as SQLite's planner assumes
+RANGE_SELECTIVITY = 0.25
+
+COST_CLASSES = ("Low", "Medium", "High", "Very high")
+
+CostEstimate = namedtuple("CostEstimate", [
+    "rows_scanned", "full_scans", "temp_btrees", "automatic_indexes", "cost_class", "needs_confirmation", "plan"
+])
+PlanStats = namedtuple("PlanStats", ["version", "table_rows", "indexes"])
+IndexStats = namedtuple("IndexStats", ["table", "unique", "columns", "stat"])
+
+LOOP = re.compile(r"^(SCAN|SEARCH) (\S+)(?: USING (.*))?$")
+USING_INDEX = re.compile(r"^(?:COVERING )?INDEX (\S+)")
+TERMS = re.compile(r"\((.*)\)\s*$")
+DERIVED = re.compile(r"^(?:MATERIALIZE|CO-ROUTINE) (.+)$")
+TEMP_BTREE = re.compile(r"^USE TEMP B-TREE FOR (.+)$")
+
+# FROM / JOIN / comma followed by a table name and optional alias
+TABLE_REF = re.compile(r"""(?:\bFROM|\bJOIN|,)\s+["`\[]?(\w+)["`\]]?(?:\s+(?:AS\s+)?["`\[]?(\w+)["`\]]?)?""",
+                       re.IGNORECASE)
+NOT_ALIASES = {
+    "on", "using", "where", "group", "order", "limit", "having", "join", "inner", "left", "right", "full",
+    "cross", "natural", "outer", "union", "except", "intersect", "window", "as", "indexed", "not", "select"
+}
+
+_stats = None
+_stats_lock = threading.Lock()
+
+
+def _load_stats(conn, version):
+    tables = [row[0] for row in conn.execute(
+        "SELECT name FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%'")]
+    try:
+        stat_rows = conn.execute("SELECT tbl, idx, stat FROM sqlite_stat1").fetchall()
+    except sqlite3.OperationalError:
+        stat_rows = []  # ANALYZE never ran
+
+    table_rows, index_stat = {}, {}
+    for table, index, stat in stat_rows:
+        numbers = [int(part) for part in str(stat).split() if part.isdigit()]
+        if not numbers:
+            continue
+        table_rows[table.lower()] = numbers[0]
+        if index:
+            index_stat[index.lower()] = numbers
+
+    indexes = {}
+    for table in tables:
+        if table.lower() not in table_rows:
+            table_rows[table.lower()] = conn.execute(f'SELECT COUNT(*) FROM "{table}"').fetchone()[0]
+        for _, index, unique, *_ in conn.execute(f"PRAGMA index_list(\"{table}\")").fetchall():
+            columns = len(conn.execute(f"PRAGMA index_info(\"{index}\")").fetchall())
+            indexes[index.lower()] = IndexStats(table.lower(), bool(unique), columns, index_stat.get(index.lower()))
+    return PlanStats(version, table_rows, indexes)
+
+
+def get_plan_stats():
+    """Row counts and index statistics of the current data (cached per data version)"""
+    global _stats
+    version = database.get_data_version()
+    stats = _stats
+    if stats is not None and stats.version == version:
+        return stats
+    with _stats_lock:
+        if _stats is None or _stats.version != version:
+            with database.pooled_connection() as conn:
+                _stats = _load_stats(conn, version)
+        return _stats
+
+
+def resolve_aliases(sql_query, table_rows):
+    """{alias or table name (lower case): table} for the tables the statement reads"""
+    aliases = {}
+    for table, alias in TABLE_REF.findall(sql_query):
+        table = table.lower()
+        if table not in table_rows:
+            continue
+        aliases.setdefault(table, table)
+        if alias and alias.lower() not in NOT_ALIASES:
+            aliases.setdefault(alias.lower(), table)
+    return aliases
+
+
+def _lookup_rows(table_rows, using, stats):
+    """Rows one SEARCH lookup visits in a table of table_rows rows"""
+    match = TERMS.search(using)
+    terms = match.group(1).split(" AND ") if match else []
+    skipped = [i for i, term in enumerate(terms) if term.startswith("ANY(")]  # skip-scan over leading columns
+    equalities = sum(1 for term in terms if term.endswith("=?")) + len(skipped)
+    ranges = len(terms) - equalities
+
+    if using.startswith(("INTEGER PRIMARY KEY", "PRIMARY KEY")) and equalities:
+        rows = 1
+    else:
+        index = USING_INDEX.match(using)
+        index = stats.indexes.get(index.group(1).lower()) if index else None
+        if not equalities:
+            rows = table_rows
+        elif index is not None and index.unique and equalities >= index.columns and not skipped:
+            rows = 1
+        elif index is not None and index.stat and len(index.stat) > equalities:
+            rows = index.stat[equalities]
+            for i in skipped:
+                # One lookup per distinct value of the skipped column
+                rows *= index.stat[i] / max(1, index.stat[i + 1])
+        else:
+            rows = min(table_rows, DEFAULT_ROWS_PER_KEY * (len(skipped) + 1))
+    return max(1.0, rows * RANGE_SELECTIVITY ** min(ranges, 2))
+
+
+class _PlanWalk:
+    """Accumulates one estimate over the plan tree"""
+
+    def __init__(self, plan, stats, aliases):
+        self.children = {}
+        for node_id, parent, _, detail in plan:
+            self.children.setdefault(parent, []).append((node_id, detail))
+        self.stats = stats
+        self.aliases = aliases
+        self.derived = {}  # CTE / subquery name -> rows it produces
+        self.full_scans = []
+        self.temp_btrees = []
+        self.automatic_indexes = []
+
+    def _loop(self, kind, name, using):
+        """(rows visited once per statement, rows visited per pass of this loop, rows it hands on)"""
+        table = self.aliases.get(name.lower(), name.lower())
+        if table not in self.stats.table_rows:
+            rows = self.derived.get(name, 1.0)  # CTE, subquery or CONSTANT ROW
+            return 0, rows, rows
+        table_rows = self.stats.table_rows[table]
+        if kind == "SCAN":
+            self.full_scans.append(table)
+            return 0, table_rows, table_rows
+        if using.startswith("AUTOMATIC"):
+            # Built once per statement (a full pass), then probed like any index
+            self.automatic_indexes.append(table)
+            rows = min(table_rows, DEFAULT_ROWS_PER_KEY)
+            return table_rows, rows, rows
+        rows = _lookup_rows(table_rows, using, self.stats)
+        return 0, rows, rows
+
+    def nest(self, parent):
+        """(rows visited, rows produced) by one run of the loops under parent"""
+        scanned, rows, produced, looped = 0.0, 1.0, 0.0, False
+        for node_id, detail in self.children.get(parent, []):
+            loop = LOOP.match(detail)
+            if loop:
+                kind, name, using = loop.group(1), loop.group(2), loop.group(3) or ""
+                once, visited, out = self._loop(kind, name, using)
+                scanned += once + rows * visited
+                rows *= out
+                looped = True
+            elif detail == "MULTI-INDEX OR":
+                visited = out = 0.0
+                for child_id, _ in self.children.get(node_id, []):
+                    child_scanned, child_rows = self.nest(child_id)
+                    visited += child_scanned
+                    out += child_rows
+                scanned += rows * visited
+                rows *= max(1.0, out)
+                looped = True
+            elif TEMP_BTREE.match(detail):
+                self.temp_btrees.append(TEMP_BTREE.match(detail).group(1))
+            else:
+                child_scanned, child_rows = self.nest(node_id)
+                derived = DERIVED.match(detail)
+                if derived:
+                    self.derived[derived.group(1)] = child_rows
+                if detail.startswith("CORRELATED"):
+                    child_scanned *= rows
+                elif not derived:
+                    produced += child_rows  # parts of a compound SELECT
+                scanned += child_scanned
+                if detail.startswith("UNION USING TEMP B-TREE") or detail.startswith(("EXCEPT", "INTERSECT")):
+                    self.temp_btrees.append(detail.split(" USING")[0])
+        return scanned, rows if looped else max(1.0, produced)
+
+
+def classify(rows_scanned):
+    """Cost class of an estimated number of rows scanned"""
+    warn_rows = max(1, get_int_setting("COST_WARN_ROWS", DEFAULT_WARN_ROWS))
+    confirm_rows = get_int_setting("COST_CONFIRM_ROWS", DEFAULT_CONFIRM_ROWS)
+    if confirm_rows > 0 and rows_scanned >= confirm_rows:
+        return COST_CLASSES[3]
+    if rows_scanned >= warn_rows:
+        return COST_CLASSES[2]
+    if rows_scanned >= warn_rows / 100:
+        return COST_CLASSES[1]
+    return COST_CLASSES[0]
+
+
+def estimate_plan(sql_query, plan, stats):
+    """CostEstimate from EXPLAIN QUERY PLAN rows (id, parent, notused, detail)"""
+    walk = _PlanWalk(plan, stats, resolve_aliases(sql_query, stats.table_rows))
+    rows_scanned = int(round(walk.nest(0)[0]))
+    cost_class = classify(rows_scanned)
+
+    depth = {0: -1}
+    lines = []
+    for node_id, parent, _, detail in plan:
+        depth[node_id] = depth.get(parent, -1) + 1
+        lines.append("  " * depth[node_id] + detail)
+    return CostEstimate(
+        rows_scanned=rows_scanned,
+        full_scans=sorted(set(walk.full_scans)),
+        temp_btrees=walk.temp_btrees,
+        automatic_indexes=sorted(set(walk.automatic_indexes)),
+        cost_class=cost_class,
+        needs_confirmation=cost_class == COST_CLASSES[3],
+        plan=lines
+    )
+
+
+def estimate_query_cost(sql_query):
+    """
+    Estimate what a statement will cost before running it
+    Returns (CostEstimate, error); the plan comes from the same pooled
+    connections execution uses, so it reflects the indexes actually present,
+    and is the plan of the rollup rewrite when one applies.
+    """
+    try:
+        sql_query, _ = rollups.rewrite(sql_query)
+        stats = get_plan_stats()
+        with database.pooled_connection() as conn:
+            plan = conn.execute(f"EXPLAIN QUERY PLAN {sql_query}").fetchall()
+    except Exception as e:
+        return None, str(e)
+    estimate = estimate_plan(sql_query, plan, stats)
+    tracing.annotate(rows_estimated=estimate.rows_scanned, cost_class=estimate.cost_class)
+    return estimate, None
+
+
+def describe(estimate):
+    """One-line summary of an estimate, e.g. for a warning"""
+    parts = [f"~{estimate.rows_scanned:,} rows scanned"]
+    if estimate.full_scans:
+        parts.append("full scan of " + ", ".join(estimate.full_scans))
+    if estimate.temp_btrees:
+        parts.append("temp B-tree for " + ", ".join(estimate.temp_btrees))
+    if estimate.automatic_indexes:
+        parts.append("automatic index on " + ", ".join(estimate.automatic_indexes))
+    return "; ".join(parts)
+
+
+def held_message(estimate):
+    """Error reported for SQL held back because of its estimated cost"""
+    return (f"Query held: estimated cost is {estimate.cost_class} ({describe(estimate)}); "
+            f"it needs confirmation before it runs")
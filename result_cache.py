@@ -0,0 +1,233 @@
+"""
+Result-set cache for executed SQL
+DataFrames are cached under (data version, canonical SQL): the same query
+against the same loaded data is answered from memory, while a CSV reload
+changes the data version and so misses every old entry. Memory use is bounded
+by RESULT_CACHE_MAX_MB with LRU eviction; when RESULT_CACHE_SPILL_DIR is set,
+evicted results are pickled there (up to RESULT_CACHE_SPILL_MAX_MB) and
+promoted back to memory on their next hit.
+"""
+
+import hashlib
+import logging
+import os
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+import pandas as pd
+
+import tracing
+from config import get_int_setting, get_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MAX_MB = 256
+DEFAULT_SPILL_MAX_MB = 1024
+
+# Results of these are not repeatable, so they are never cached
+NON_DETERMINISTIC = re.compile(
+    r"\b(random|randomblob|changes|last_insert_rowid|total_changes)\s*\(|'now'|"
+    r"\bcurrent_(date|time|timestamp)\b",
+    re.IGNORECASE
+)
+
+# String literals and quoted identifiers, or a run of whitespace and comments
+SQL_TOKENS = re.compile(
+    r"""('(?:[^']|'')*'|"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])|((?:\s|--[^\n]*|/\*.*?\*/)+)""",
+    re.DOTALL
+)
+
+_cache = None
+_cache_lock = threading.Lock()
+_last = threading.local()
+
+
+def canonicalize_sql(sql):
+    """SQL with comments removed, whitespace collapsed and trailing semicolons dropped (literals untouched)"""
+    def replace(match):
+        if match.group(1):
+            return match.group(1)
+        return " "
+
+    return SQL_TOKENS.sub(replace, sql).strip().rstrip(";").strip()
+
+
+def is_cacheable(canonical_sql):
+    """Whether a query's result depends only on the data (no random(), 'now', ...)"""
+    return not NON_DETERMINISTIC.search(canonical_sql)
+
+
+def frame_size(df):
+    """Approximate in-memory size of a DataFrame in bytes"""
+    return int(df.memory_usage(index=True, deep=True).sum())
+
+
+class ResultCache:
+    """Memory-bounded LRU of query results with optional spill to disk"""
+
+    def __init__(self, max_bytes, spill_dir=None, spill_max_bytes=0):
+        self.max_bytes = max_bytes
+        self.spill_dir = Path(spill_dir) if spill_dir else None
+        self.spill_max_bytes = spill_max_bytes
+        self._entries = OrderedDict()  # key -> (df, execution_time, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._data_version = None
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if self.spill_dir is not None:
+            self.spill_dir.mkdir(parents=True, exist_ok=True)
+
+    def _spill_path(self, key):
+        data_version, sql = key
+        return self.spill_dir / f"{data_version}_{hashlib.sha256(sql.encode()).hexdigest()[:24]}.pkl"
+
+    def _check_version(self, data_version):
+        """Drop every entry (and spilled file) of an older data version"""
+        if data_version == self._data_version:
+            return
+        self._entries.clear()
+        self._bytes = 0
+        if self.spill_dir is not None:
+            for path in self.spill_dir.glob("*.pkl"):
+                if not path.name.startswith(f"{data_version}_"):
+                    path.unlink(missing_ok=True)
+        self._data_version = data_version
+
+    def get(self, data_version, sql):
+        """(DataFrame, original execution time, "memory" / "disk") or None"""
+        key = (data_version, sql)
+        with self._lock:
+            self._check_version(data_version)
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[0].copy(deep=False), entry[1], "memory"
+
+        if self.spill_dir is not None:
+            path = self._spill_path(key)
+            if path.exists():
+                try:
+                    df, execution_time = pd.read_pickle(path)
+                except Exception as e:
+                    logger.warning("Dropping unreadable spilled result %s: %s", path, e)
+                    path.unlink(missing_ok=True)
+                else:
+                    path.unlink(missing_ok=True)
+                    self.put(data_version, sql, df, execution_time)
+                    with self._lock:
+                        self.disk_hits += 1
+                    return df.copy(deep=False), execution_time, "disk"
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, data_version, sql, df, execution_time):
+        """Cache a result, evicting (or spilling) least recently used entries over the memory limit"""
+        size = frame_size(df)
+        key = (data_version, sql)
+        evicted = []
+        with self._lock:
+            self._check_version(data_version)
+            # A single result that would take over a quarter of the budget is not kept in memory
+            if size > self.max_bytes // 4:
+                evicted.append((key, (df, execution_time, size)))
+            else:
+                old = self._entries.pop(key, None)
+                if old is not None:
+                    self._bytes -= old[2]
+                self._entries[key] = (df, execution_time, size)
+                self._bytes += size
+                while self._bytes > self.max_bytes and self._entries:
+                    old_key, old_entry = self._entries.popitem(last=False)
+                    self._bytes -= old_entry[2]
+                    evicted.append((old_key, old_entry))
+        for old_key, (old_df, old_time, _) in evicted:
+            self._spill(old_key, old_df, old_time)
+
+    def _spill(self, key, df, execution_time):
+        """Write an evicted result to the spill directory, trimming the oldest files over its limit"""
+        if self.spill_dir is None or self.spill_max_bytes <= 0:
+            return
+        path = self._spill_path(key)
+        tmp_path = path.with_name(path.name + ".tmp")
+        try:
+            pd.to_pickle((df, execution_time), tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            logger.warning("Could not spill result to %s: %s", path, e)
+            tmp_path.unlink(missing_ok=True)
+            return
+
+        files = sorted(self.spill_dir.glob("*.pkl"), key=lambda p: p.stat().st_mtime)
+        total = sum(p.stat().st_size for p in files)
+        for old in files:
+            if total <= self.spill_max_bytes:
+                break
+            total -= old.stat().st_size
+            old.unlink(missing_ok=True)
+
+    def clear(self):
+        """Drop every cached result, in memory and on disk"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            if self.spill_dir is not None:
+                for path in self.spill_dir.glob("*.pkl"):
+                    path.unlink(missing_ok=True)
+
+    def stats(self):
+        """Entry count, memory use and hit / miss counters"""
+        with self._lock:
+            hits = self.memory_hits + self.disk_hits
+            lookups = hits + self.misses
+            spilled = len(list(self.spill_dir.glob("*.pkl"))) if self.spill_dir is not None else 0
+            return {
+                "entries": len(self._entries),
+                "spilled": spilled,
+                "memory_mb": self._bytes / (1024 * 1024),
+                "max_memory_mb": self.max_bytes / (1024 * 1024),
+                "memory_hits": self.memory_hits,
+                "disk_hits": self.disk_hits,
+                "misses": self.misses,
+                "hit_rate": hits / lookups if lookups else 0.0
+            }
+
+
+def get_result_cache():
+    """Process-wide result cache, or None when RESULT_CACHE_MAX_MB is 0"""
+    global _cache
+    max_mb = get_int_setting("RESULT_CACHE_MAX_MB", DEFAULT_MAX_MB)
+    if max_mb <= 0:
+        return None
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = ResultCache(
+                    max_bytes=max_mb * 1024 * 1024,
+                    spill_dir=get_setting("RESULT_CACHE_SPILL_DIR"),
+                    spill_max_bytes=get_int_setting("RESULT_CACHE_SPILL_MAX_MB", DEFAULT_SPILL_MAX_MB) * 1024 * 1024
+                )
+    return _cache
+
+
+def set_last_hit(kind):
+    """Record where this thread's latest query result came from (None = executed), also on the current span"""
+    _last.hit = kind
+    tracing.annotate(result_cache=kind or "miss")
+
+
+def last_hit():
+    """"memory" / "disk" when this thread's latest query was served from cache, else None"""
+    return getattr(_last, "hit", None)
+
+
+def get_stats():
+    """Result cache statistics, or None when disabled"""
+    cache = get_result_cache()
+    return cache.stats() if cache is not None else None
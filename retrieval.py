@@ -0,0 +1,602 @@
+"""
+Semantic schema retrieval for the Text-to-SQL engine
+Embeds table descriptions and example queries and searches them in a vector
+index: an in-process NumPy index (default) or Pinecone. Both backends expose
+the same upsert / query interface and return plain match dicts.
+"""
+
+import atexit
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+import numpy as np
+
+import tracing
+from clients import call_with_retry, get_request_timeout, shared_client
+from config import ConfigurationError, get_int_setting, get_setting
+from schema_cache import get_database_schema, get_table_documents
+
+EMBEDDING_MODEL_NAME = "all-MiniLM-L6-v2"
+EMBEDDING_DIMENSION = 384
+
+# Example queries for better semantic understanding
+EXAMPLE_QUERIES = [
+    "Show me top selling products",
+    "List customers by order count",
+    "Revenue by store",
+    "Products in stock by category",
+    "Customer purchase history",
+    "Staff sales performance",
+    "Orders by date range",
+    "Brand popularity analysis"
+]
+
+# VECTOR_BACKEND: "auto" picks the local index unless Pinecone is configured
+# and the corpus is larger than LOCAL_INDEX_MAX_DOCS
+DEFAULT_VECTOR_BACKEND = "auto"
+DEFAULT_LOCAL_INDEX_MAX_DOCS = 50_000
+
+# Documents per encode batch and per upsert / fetch / delete request
+DEFAULT_EMBED_BATCH_SIZE = 64
+DEFAULT_UPSERT_BATCH_SIZE = 100
+
+# Question-embedding cache: entries kept in memory, and new entries between disk saves
+DEFAULT_EMBEDDING_CACHE_SIZE = 10_000
+EMBEDDING_CACHE_SAVE_EVERY = 50
+
+logger = logging.getLogger(__name__)
+
+_embedding_model = None
+_embedding_model_lock = threading.Lock()
+_model_load_seconds = None
+_warmup_thread = None
+_warmup_lock = threading.Lock()
+_embedding_cache = None
+_embedding_cache_lock = threading.Lock()
+_local_index = None
+_local_index_lock = threading.Lock()
+
+
+def get_embedding_model():
+    """Load sentence transformer model for embeddings (once per process)"""
+    global _embedding_model, _model_load_seconds
+    if _embedding_model is None:
+        with _embedding_model_lock:
+            if _embedding_model is None:
+                start = time.perf_counter()
+                from sentence_transformers import SentenceTransformer
+                _embedding_model = SentenceTransformer(EMBEDDING_MODEL_NAME)
+                _model_load_seconds = time.perf_counter() - start
+    return _embedding_model
+
+
+def start_warmup():
+    """
+    Load the embedding model and run one encode in a background thread
+    Call at process start so the first question does not pay for the model
+    load; safe to call on every Streamlit rerun (only the first call starts it).
+    """
+    global _warmup_thread
+
+    def run():
+        try:
+            get_embedding_model().encode("warm up", normalize_embeddings=True)
+            get_embedding_cache()
+        except Exception as e:
+            logger.warning("Embedding model warm-up failed: %s", e)
+
+    with _warmup_lock:
+        if _warmup_thread is None:
+            _warmup_thread = threading.Thread(target=run, name="embedding-warmup", daemon=True)
+            _warmup_thread.start()
+    return _warmup_thread
+
+
+def normalize_question(text):
+    """Cache key for a question: lower-cased, whitespace collapsed, trailing punctuation dropped"""
+    return re.sub(r"\s+", " ", text.strip().lower()).rstrip("?!. ")
+
+
+class EmbeddingCache:
+    """
+    Size-bounded LRU map of normalized question text to its embedding
+    Optionally persisted to an .npz file (loaded on creation, saved every
+    EMBEDDING_CACHE_SAVE_EVERY new entries and at interpreter exit).
+    """
+
+    def __init__(self, max_entries=DEFAULT_EMBEDDING_CACHE_SIZE, path=None):
+        self.max_entries = max(1, max_entries)
+        self.path = Path(path) if path else None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._unsaved = 0
+        self.hits = 0
+        self.misses = 0
+        if self.path and self.path.exists():
+            self.load()
+
+    def get(self, key):
+        """Cached embedding for key, or None"""
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def put(self, key, vector):
+        """Store an embedding, evicting the least recently used entries past max_entries"""
+        with self._lock:
+            self._entries[key] = np.asarray(vector, dtype=np.float32)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            self._unsaved += 1
+            save_now = self.path is not None and self._unsaved >= EMBEDDING_CACHE_SAVE_EVERY
+        if save_now:
+            self.save()
+
+    def load(self):
+        """Load persisted entries (oldest first, so LRU order survives restarts)"""
+        try:
+            with np.load(self.path, allow_pickle=False) as data:
+                if str(data["model"]) != EMBEDDING_MODEL_NAME:
+                    return
+                keys, vectors = data["keys"], data["vectors"]
+        except Exception as e:
+            logger.warning("Ignoring unreadable embedding cache %s: %s", self.path, e)
+            return
+        with self._lock:
+            for key, vector in zip(keys[-self.max_entries:], vectors[-self.max_entries:]):
+                self._entries[str(key)] = vector
+
+    def save(self):
+        """Write entries to disk atomically"""
+        if self.path is None:
+            return
+        with self._lock:
+            keys = list(self._entries)
+            vectors = np.stack(list(self._entries.values())) if keys else np.zeros((0, EMBEDDING_DIMENSION), np.float32)
+            self._unsaved = 0
+        tmp_path = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp_path, "wb") as f:
+            np.savez(f, model=np.array(EMBEDDING_MODEL_NAME), keys=np.array(keys, dtype=str), vectors=vectors)
+        os.replace(tmp_path, self.path)
+
+    def stats(self):
+        """Entry count, hits, misses and hit rate"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "max_entries": self.max_entries,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0
+            }
+
+
+def get_embedding_cache():
+    """Process-wide question-embedding cache (EMBEDDING_CACHE_SIZE, EMBEDDING_CACHE_PATH)"""
+    global _embedding_cache
+    if _embedding_cache is None:
+        with _embedding_cache_lock:
+            if _embedding_cache is None:
+                cache = EmbeddingCache(
+                    max_entries=get_int_setting("EMBEDDING_CACHE_SIZE", DEFAULT_EMBEDDING_CACHE_SIZE),
+                    path=get_setting("EMBEDDING_CACHE_PATH")
+                )
+                if cache.path is not None:
+                    atexit.register(cache.save)
+                _embedding_cache = cache
+    return _embedding_cache
+
+
+def embed_query(text):
+    """Normalized embedding of a question, served from the LRU cache when seen before"""
+    cache = get_embedding_cache()
+    key = normalize_question(text)
+    vector = cache.get(key)
+    tracing.annotate(embedding_cache_hit=vector is not None)
+    if vector is None:
+        vector = get_embedding_model().encode(key, normalize_embeddings=True)
+        cache.put(key, vector)
+    return vector
+
+
+def get_embedding_stats():
+    """Model load time and question-embedding cache statistics"""
+    return {
+        "model_loaded": _embedding_model is not None,
+        "model_load_seconds": _model_load_seconds,
+        "cache": get_embedding_cache().stats()
+    }
+
+
+def get_pinecone_client():
+    """Shared Pinecone client and environment, or None when no API key is configured"""
+    api_key = get_setting("PINECONE_API_KEY")
+    env = get_setting("PINECONE_ENVIRONMENT", "us-east-1")
+
+    if not api_key:
+        return None
+
+    def create():
+        from pinecone import Pinecone
+        return Pinecone(api_key=api_key)
+
+    return shared_client("pinecone", api_key, create), env
+
+
+def get_index_name():
+    """Name of the Pinecone index holding the schema documents"""
+    return get_setting("PINECONE_INDEX", "text2sql-index")
+
+
+class LocalVectorIndex:
+    """
+    In-process cosine-similarity index
+    Vectors are L2-normalized float32 rows of one matrix, so a query is a single
+    matrix-vector product plus a partial sort. The matrix is persisted as .npy
+    (memory-mapped on load) with ids and metadata in a .json sidecar.
+    """
+
+    name = "local"
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._ids = []
+        self._metadata = []
+        self._matrix = np.zeros((0, EMBEDDING_DIMENSION), dtype=np.float32)
+
+    @property
+    def matrix_path(self):
+        return self.path.with_suffix(".npy")
+
+    @property
+    def metadata_path(self):
+        return self.path.with_suffix(".json")
+
+    def __len__(self):
+        return len(self._ids)
+
+    def exists(self):
+        """Whether the index has been persisted to disk"""
+        return self.matrix_path.exists() and self.metadata_path.exists()
+
+    def load(self):
+        """Load the persisted index (matrix memory-mapped read-only)"""
+        with open(self.metadata_path, encoding="utf-8") as f:
+            sidecar = json.load(f)
+        if sidecar.get("model") != EMBEDDING_MODEL_NAME:
+            return self  # Built with another embedding model - start empty and re-index
+        matrix = np.load(self.matrix_path, mmap_mode="r")
+        with self._lock:
+            self._ids = sidecar["ids"]
+            self._metadata = sidecar["metadata"]
+            self._matrix = matrix
+        return self
+
+    def save(self):
+        """Persist matrix and sidecar, each replaced atomically"""
+        with self._lock:
+            ids, metadata, matrix = list(self._ids), list(self._metadata), np.asarray(self._matrix)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+
+        tmp_matrix = self.matrix_path.with_name(self.matrix_path.name + ".tmp")
+        with open(tmp_matrix, "wb") as f:
+            np.save(f, matrix)
+        tmp_metadata = self.metadata_path.with_name(self.metadata_path.name + ".tmp")
+        with open(tmp_metadata, "w", encoding="utf-8") as f:
+            json.dump({"model": EMBEDDING_MODEL_NAME, "ids": ids, "metadata": metadata}, f)
+        os.replace(tmp_matrix, self.matrix_path)
+        os.replace(tmp_metadata, self.metadata_path)
+
+    def list_ids(self):
+        """Ids of every stored vector"""
+        return list(self._ids)
+
+    def fetch_hashes(self, ids):
+        """content_hash metadata of the given ids that are present"""
+        with self._lock:
+            stored = dict(zip(self._ids, self._metadata))
+        return {doc_id: stored[doc_id].get("content_hash") for doc_id in ids if doc_id in stored}
+
+    def delete(self, ids):
+        """Remove vectors by id and persist"""
+        ids = set(ids)
+        if not ids:
+            return
+        with self._lock:
+            keep = [i for i, doc_id in enumerate(self._ids) if doc_id not in ids]
+            self._ids = [self._ids[i] for i in keep]
+            self._metadata = [self._metadata[i] for i in keep]
+            self._matrix = np.asarray(self._matrix, dtype=np.float32)[np.array(keep, dtype=np.intp)]
+        self.save()
+
+    def upsert(self, vectors, batch_size=None):
+        """Insert or replace (id, values, metadata) tuples and persist (one write, batch_size unused)"""
+        with self._lock:
+            ids = list(self._ids)
+            metadata = list(self._metadata)
+            rows = np.array(self._matrix, dtype=np.float32)
+            positions = {doc_id: i for i, doc_id in enumerate(ids)}
+
+            new_rows = []
+            for doc_id, values, meta in vectors:
+                vector = _normalize(values)
+                if doc_id in positions:
+                    rows[positions[doc_id]] = vector
+                    metadata[positions[doc_id]] = meta
+                else:
+                    positions[doc_id] = len(ids)
+                    ids.append(doc_id)
+                    metadata.append(meta)
+                    new_rows.append(vector)
+            if new_rows:
+                rows = np.vstack([rows.reshape(-1, len(new_rows[0])), np.stack(new_rows)])
+
+            self._ids, self._metadata, self._matrix = ids, metadata, rows
+        self.save()
+
+    def query(self, vector, top_k=5):
+        """Top-k matches by cosine similarity"""
+        with self._lock:
+            ids, metadata, matrix = self._ids, self._metadata, self._matrix
+        if not ids:
+            return []
+
+        scores = matrix @ _normalize(vector)
+        k = min(top_k, len(ids))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [_match(ids[i], float(scores[i]), metadata[i]) for i in top]
+
+
+class PineconeVectorIndex:
+    """Pinecone serverless index behind the same interface as LocalVectorIndex"""
+
+    name = "pinecone"
+
+    def __init__(self, pc, env, index_name):
+        self.pc = pc
+        self.env = env
+        self.index_name = index_name
+        self._index = None
+
+    def ensure_index(self):
+        """Create the serverless index if it does not exist yet"""
+        indexes = call_with_retry(self.pc.list_indexes)
+        if self.index_name not in [idx.name for idx in indexes]:
+            from pinecone import ServerlessSpec
+            self.pc.create_index(
+                name=self.index_name,
+                dimension=EMBEDDING_DIMENSION,
+                metric="cosine",
+                spec=ServerlessSpec(
+                    cloud="aws",
+                    region=self.env
+                )
+            )
+
+    @property
+    def index(self):
+        if self._index is None:
+            # Index handles hold the data-plane connection pool, so share them too
+            self._index = shared_client(f"pinecone_index:{self.index_name}", self.pc, lambda: self.pc.Index(self.index_name))
+        return self._index
+
+    def _call(self, method, **kwargs):
+        """Data-plane request with the shared timeout and retry policy"""
+        return call_with_retry(getattr(self.index, method), _request_timeout=get_request_timeout(), **kwargs)
+
+    def list_ids(self):
+        """Ids of every stored vector (paginated listing, serverless indexes)"""
+        ids = []
+        for page in self.index.list():
+            ids.extend(page)
+        return ids
+
+    def fetch_hashes(self, ids, batch_size=DEFAULT_UPSERT_BATCH_SIZE):
+        """content_hash metadata of the given ids that are present"""
+        hashes = {}
+        for batch in _batches(list(ids), batch_size):
+            response = self._call("fetch", ids=batch)
+            for doc_id, vector in response.vectors.items():
+                hashes[doc_id] = (vector.metadata or {}).get("content_hash")
+        return hashes
+
+    def delete(self, ids, batch_size=DEFAULT_UPSERT_BATCH_SIZE):
+        """Remove vectors by id"""
+        for batch in _batches(list(ids), batch_size):
+            self._call("delete", ids=batch)
+
+    def upsert(self, vectors, batch_size=DEFAULT_UPSERT_BATCH_SIZE):
+        """Insert or replace (id, values, metadata) tuples, batch_size per request"""
+        for batch in _batches(list(vectors), batch_size):
+            self._call("upsert", vectors=[(doc_id, [float(v) for v in values], meta) for doc_id, values, meta in batch])
+
+    def query(self, vector, top_k=5):
+        """Top-k matches from Pinecone"""
+        results = self._call(
+            "query",
+            vector=[float(v) for v in vector],
+            top_k=top_k,
+            include_metadata=True
+        )
+        return [
+            _match(match.id, match.score, match.metadata)
+            for match in results.matches
+            if match.metadata and "text" in match.metadata
+        ]
+
+
+def _batches(items, size):
+    """Split a list into consecutive chunks of at most size items"""
+    size = max(1, size)
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def _normalize(values):
+    """Unit-length float32 copy of a vector"""
+    vector = np.asarray(values, dtype=np.float32).reshape(-1)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+def _match(doc_id, score, metadata):
+    """Backend-neutral search match"""
+    return {
+        "id": doc_id,
+        "score": score,
+        "text": metadata.get("text"),
+        "type": metadata.get("type")
+    }
+
+
+def get_local_index():
+    """Process-wide local index, loaded from disk when persisted"""
+    global _local_index
+    if _local_index is None:
+        with _local_index_lock:
+            if _local_index is None:
+                path = Path(get_setting("VECTOR_INDEX_PATH", Path(__file__).parent / "vector_index"))
+                index = LocalVectorIndex(path)
+                _local_index = index.load() if index.exists() else index
+    return _local_index
+
+
+def get_vector_index(document_count=None):
+    """
+    Vector index selected by VECTOR_BACKEND (auto / local / pinecone)
+    In auto mode Pinecone is used only when configured and the corpus
+    (document_count, or the size of the local index) exceeds LOCAL_INDEX_MAX_DOCS.
+    """
+    backend = str(get_setting("VECTOR_BACKEND", DEFAULT_VECTOR_BACKEND)).lower()
+    client = get_pinecone_client() if backend in ("auto", "pinecone") else None
+
+    if backend == "pinecone" and not client:
+        raise ConfigurationError("Pinecone API key not configured")
+
+    if backend == "auto" and client:
+        local = get_local_index()
+        size = document_count if document_count is not None else (len(local) if local.exists() else None)
+        max_local = get_int_setting("LOCAL_INDEX_MAX_DOCS", DEFAULT_LOCAL_INDEX_MAX_DOCS)
+        if size is None or size > max_local:
+            backend = "pinecone"
+
+    if backend == "pinecone":
+        pc, env = client
+        return PineconeVectorIndex(pc, env, get_index_name())
+    return get_local_index()
+
+
+def build_schema_documents(schema_info):
+    """Create retrieval documents from table schema and example queries"""
+    # Table descriptions (precomputed for the cached schema)
+    documents = list(get_table_documents(schema_info))
+
+    for i, example in enumerate(EXAMPLE_QUERIES):
+        documents.append({"id": f"example_{i}", "text": example, "type": "example"})
+
+    return documents
+
+
+def document_hash(doc):
+    """Content hash of a document (changes with its text, type or the embedding model)"""
+    content = f"{EMBEDDING_MODEL_NAME}\n{doc['type']}\n{doc['text']}"
+    return hashlib.sha256(content.encode()).hexdigest()[:16]
+
+
+def initialize_vector_db(schema_info):
+    """
+    Sync schema information and example queries into the vector index
+    Only documents whose content hash changed since the last sync are
+    embedded (in one batched encode call) and upserted (in batches); vectors
+    for documents that no longer exist, e.g. dropped tables, are deleted.
+    Returns {"documents", "upserted", "unchanged", "deleted"} counts.
+    """
+    documents = build_schema_documents(schema_info)
+    index = get_vector_index(document_count=len(documents))
+    if isinstance(index, PineconeVectorIndex):
+        index.ensure_index()
+
+    hashes = {doc["id"]: document_hash(doc) for doc in documents}
+    stored = index.fetch_hashes(hashes.keys())
+    changed = [doc for doc in documents if stored.get(doc["id"]) != hashes[doc["id"]]]
+
+    if changed:
+        embedding_model = get_embedding_model()
+        embeddings = embedding_model.encode(
+            [doc["text"] for doc in changed],
+            batch_size=get_int_setting("EMBED_BATCH_SIZE", DEFAULT_EMBED_BATCH_SIZE),
+            normalize_embeddings=True
+        )
+        index.upsert(
+            [
+                (doc["id"], embedding, {"text": doc["text"], "type": doc["type"], "content_hash": hashes[doc["id"]]})
+                for doc, embedding in zip(changed, embeddings)
+            ],
+            batch_size=get_int_setting("UPSERT_BATCH_SIZE", DEFAULT_UPSERT_BATCH_SIZE)
+        )
+
+    # Only prune ids in our own namespaces so foreign vectors in a shared index survive
+    stale = [
+        doc_id for doc_id in index.list_ids()
+        if doc_id not in hashes and doc_id.startswith(("table_", "example_"))
+    ]
+    index.delete(stale)
+
+    return {
+        "documents": len(documents),
+        "upserted": len(changed),
+        "unchanged": len(documents) - len(changed),
+        "deleted": len(stale)
+    }
+
+
+def search_relevant_schema(user_query, top_k=5):
+    """
+    Search for relevant schema using semantic search
+    Returns a list of {"id", "score", "text", "type"} matches. An empty local
+    index is built from the cached schema on first use.
+    """
+    # Embed user query (cached per normalized question)
+    return search_by_embedding(embed_query(user_query), top_k=top_k)
+
+
+def search_by_embedding(query_embedding, top_k=5):
+    """Vector search for an already-embedded question (see search_relevant_schema)"""
+    index = get_vector_index()
+    if isinstance(index, LocalVectorIndex) and not len(index):
+        with _local_index_lock:
+            if not len(index):
+                initialize_vector_db(get_database_schema())
+
+    matches = index.query(query_embedding, top_k=top_k)
+    tracing.annotate(backend=index.name, matches=len(matches))
+    return matches
+
+
+def get_backend_name():
+    """Name of the vector backend searches currently use"""
+    return get_vector_index().name
+
+
+def relevant_table_names(matches):
+    """Table names among search matches, best match first"""
+    return [
+        match["id"][len("table_"):]
+        for match in (matches or [])
+        if match.get("type") == "table" and match["id"].startswith("table_")
+    ]
@@ -0,0 +1,676 @@
+"""
+Materialized sales rollups with transparent query rewrite
+The loader keeps a few pre-aggregated copies of order_items ⨝ orders in the
+database file (revenue by store and day, by product, by product and day, by
+staff and day). It rebuilds them, in the same staging copy and swap as the data
+they summarise, whenever a source table or a rollup definition changes, so a
+rollup never lags the data version it sits next to.
+
+Before a query runs, rewrite() checks whether it is an aggregate over the fact
+tables that a rollup can answer exactly:
+- the facts are joined on order_id, every other table is joined on its own
+  primary key (so no row is duplicated or dropped differently)
+- fact columns outside aggregates are rollup dimensions
+- aggregates over fact columns are SUM / TOTAL / AVG of quantity, list_price,
+  discount, quantity * list_price or quantity * list_price * (1 - discount),
+  COUNT(*), COUNT(DISTINCT order_id) on order-level rollups, or MIN / MAX /
+  COUNT(DISTINCT) of dimensions
+If so the fact tables are replaced by the smallest matching rollup and the
+aggregates by sums of its pre-computed measures; anything else runs unchanged.
+ROLLUPS_ENABLED turns the rewrite off.
+"""
+
+import hashlib
+import logging
+import re
+import sqlite3
+import threading
+from collections import OrderedDict, namedtuple
+from datetime import datetime
+from pathlib import Path
+
+import tracing
+from config import get_setting
+from schema import TABLES
+
+logger = logging.getLogger(__name__)
+
+STATE_TABLE = "_rollup_state"
+REWRITE_CACHE_SIZE = 512
+
+Rollup = namedtuple("Rollup", ["facts", "dimensions", "order_grain"])
+
+# order_grain: every dimension is an attribute of the order, so each order falls
+# in exactly one rollup row and order counts add up across rows
+ROLLUPS = OrderedDict([
+    ("_rollup_sales_by_product", Rollup(("order_items",), ("product_id",), False)),
+    ("_rollup_sales_by_store_day", Rollup(("orders", "order_items"), ("store_id", "order_date"), True)),
+    ("_rollup_sales_by_product_day", Rollup(("orders", "order_items"), ("product_id", "order_date"), False)),
+    ("_rollup_sales_by_staff_day", Rollup(("orders", "order_items"), ("staff_id", "store_id", "order_date"), True)),
+])
+
+# Normalized SUM argument (sorted factors of a product) -> measure column
+MEASURES = {
+    ("quantity",): "quantity",
+    ("list_price",): "list_price",
+    ("discount",): "discount",
+    ("list_price", "quantity"): "gross_sales",
+    ("1-discount", "list_price", "quantity"): "revenue",
+}
+MEASURE_SQL = {
+    "quantity": "SUM(oi.quantity)",
+    "list_price": "SUM(oi.list_price)",
+    "discount": "SUM(oi.discount)",
+    "gross_sales": "SUM(oi.quantity * oi.list_price)",
+    "revenue": "SUM(oi.quantity * oi.list_price * (1 - oi.discount))",
+    "line_count": "COUNT(*)",
+    "order_count": "COUNT(DISTINCT oi.order_id)",
+}
+
+FACT_TABLES = ("orders", "order_items")
+FACT_KEY = "order_id"
+NOT_NULL_FACT_COLUMNS = {
+    table: {name for name, col_type in TABLES[table]['columns'] if "NOT NULL" in col_type} for table in FACT_TABLES
+}
+
+TOKEN = re.compile(r"""
+    (?P<string>'(?:[^']|'')*')
+  | (?P<quoted>"(?:[^"]|"")*"|`[^`]*`|\[[^\]]*\])
+  | (?P<comment>--[^\n]*|/\*.*?\*/)
+  | (?P<number>\d+(?:\.\d*)?(?:[eE][-+]?\d+)?|\.\d+)
+  | (?P<name>[A-Za-z_]\w*)
+  | (?P<op><=|>=|<>|!=|==|\|\||[-+*/%(),.;=<>])
+  | (?P<space>\s+)
+""", re.VERBOSE | re.DOTALL)
+
+CLAUSES = ("select", "from", "where", "group", "having", "order", "limit")
+UNSUPPORTED = {"with", "union", "intersect", "except", "over", "window", "using", "natural", "right", "full",
+               "cross", "recursive", "values", "indexed"}
+JOIN_WORDS = {"join", "inner", "left", "outer"}
+AGGREGATES = {"sum", "total", "avg", "count", "min", "max"}
+KEYWORDS = {
+    "select", "distinct", "all", "from", "where", "group", "by", "having", "order", "limit", "offset", "as", "on",
+    "join", "inner", "left", "outer", "and", "or", "not", "in", "is", "null", "like", "glob", "between", "case",
+    "when", "then", "else", "end", "asc", "desc", "exists", "collate", "escape", "cast", "true", "false", "nulls",
+    "first", "last"
+}
+
+_available = {}  # database file id -> {rollup name: row count}
+_rewrites = OrderedDict()  # (file id, sql) -> (rewritten sql, rollup) or None
+_lock = threading.Lock()
+_last = threading.local()
+
+
+class _NoRewrite(Exception):
+    """The statement is outside what a rollup answers exactly"""
+
+
+def definition_hash(name):
+    """Hash of a rollup's build SQL, so definition edits trigger a rebuild"""
+    return hashlib.sha256(rollup_select(name).encode()).hexdigest()
+
+
+def rollup_select(name):
+    """SELECT building a rollup table"""
+    rollup = ROLLUPS[name]
+    source = "orders o JOIN order_items oi ON oi.order_id = o.order_id" if "orders" in rollup.facts \
+        else "order_items oi"
+    dimensions = [f"{'oi' if dim in column_names('order_items') else 'o'}.{dim}" for dim in rollup.dimensions]
+    measures = [f"{sql} AS {measure}" for measure, sql in MEASURE_SQL.items()]
+    return (f"SELECT {', '.join(dimensions + measures)} FROM {source} "
+            f"GROUP BY {', '.join(dimensions)}")
+
+
+def column_names(table_name):
+    return [name for name, _ in TABLES[table_name]['columns']]
+
+
+def build_rollups(conn, names):
+    """(Re)build the given rollup tables on a writable connection; returns their row counts"""
+    conn.execute(f"""CREATE TABLE IF NOT EXISTS {STATE_TABLE} (
+    name TEXT PRIMARY KEY,
+    definition_hash TEXT,
+    rows INTEGER,
+    built_at TEXT
+)""")
+    built_at = datetime.now().isoformat(timespec='seconds')
+    counts = {}
+    for name in names:
+        conn.execute(f"DROP TABLE IF EXISTS {name}")
+        conn.execute(f"CREATE TABLE {name} AS {rollup_select(name)}")
+        counts[name] = conn.execute(f"SELECT COUNT(*) FROM {name}").fetchone()[0]
+        conn.execute(f"INSERT OR REPLACE INTO {STATE_TABLE} VALUES (?, ?, ?, ?)",
+                     (name, definition_hash(name), counts[name], built_at))
+        logger.info("Built rollup %s: %d rows", name, counts[name])
+    return counts
+
+
+def stale_rollups(db_path, changed_tables):
+    """Rollups to rebuild: missing, built from another definition, or over a changed table"""
+    built = {}
+    db_path = Path(db_path)
+    if db_path.exists():
+        conn = sqlite3.connect(f"{db_path.resolve().as_uri()}?mode=ro", uri=True)
+        try:
+            built = dict(conn.execute(f"SELECT name, definition_hash FROM {STATE_TABLE}").fetchall())
+        except sqlite3.OperationalError:
+            pass  # Built before rollups existed
+        finally:
+            conn.close()
+    return [
+        name for name, rollup in ROLLUPS.items()
+        if built.get(name) != definition_hash(name) or set(rollup.facts) & set(changed_tables)
+    ]
+
+
+def is_enabled():
+    """ROLLUPS_ENABLED setting (default on)"""
+    return str(get_setting("ROLLUPS_ENABLED", "true")).lower() not in ("0", "false", "no", "off")
+
+
+def _tokenize(sql):
+    """[[kind, text]] tokens of sql; comments become spaces"""
+    tokens, position = [], 0
+    for match in TOKEN.finditer(sql):
+        if match.start() != position:
+            raise _NoRewrite("unrecognized characters")
+        position = match.end()
+        kind = match.lastgroup
+        if kind == "quoted":
+            raise _NoRewrite("quoted identifier")
+        tokens.append(["space", " "] if kind == "comment" else [kind, match.group()])
+    if position != len(sql):
+        raise _NoRewrite("unrecognized characters")
+    return tokens
+
+
+def _significant(tokens, start=0, end=None):
+    """Indexes of the non-space tokens in tokens[start:end]"""
+    end = len(tokens) if end is None else end
+    return [i for i in range(start, end) if tokens[i][0] != "space"]
+
+
+def _word(tokens, i):
+    return tokens[i][1].lower() if tokens[i][0] == "name" else None
+
+
+def _closing(tokens, i):
+    """Index of the ')' matching the '(' at i"""
+    depth = 0
+    for j in range(i, len(tokens)):
+        if tokens[j][1] == "(":
+            depth += 1
+        elif tokens[j][1] == ")":
+            depth -= 1
+            if depth == 0:
+                return j
+    raise _NoRewrite("unbalanced parentheses")
+
+
+def _clauses(tokens, idx):
+    """{clause: (start, end)} token ranges of a single top-level SELECT"""
+    bounds, depth = [], 0
+    for pos, i in enumerate(idx):
+        text, word = tokens[i][1], _word(tokens, i)
+        if text == "(":
+            depth += 1
+        elif text == ")":
+            depth -= 1
+        elif word in UNSUPPORTED:
+            raise _NoRewrite(word)
+        elif word == "select" and (depth or bounds):
+            raise _NoRewrite("subquery")
+        elif text == ";" and pos != len(idx) - 1:
+            raise _NoRewrite("several statements")
+        elif depth == 0 and word in CLAUSES:
+            if word in ("group", "order"):
+                if pos + 1 >= len(idx) or _word(tokens, idx[pos + 1]) != "by":
+                    raise _NoRewrite("malformed clause")
+            if any(clause == word for clause, _ in bounds):
+                raise _NoRewrite("repeated clause")
+            bounds.append((word, i))
+    if not bounds or bounds[0][0] != "select" or "from" not in dict(bounds):
+        raise _NoRewrite("not a SELECT ... FROM")
+    end = idx[-1] if tokens[idx[-1]][1] == ";" else len(tokens)
+    return {clause: (start, bounds[n + 1][1] if n + 1 < len(bounds) else end)
+            for n, (clause, start) in enumerate(bounds)}
+
+
+def _parse_from(tokens, start, end):
+    """[{"join", "table", "alias", "span", "on"}] of a FROM clause (index ranges into tokens)"""
+    idx = _significant(tokens, start + 1, end)
+    items, pos = [], 0
+    while pos < len(idx):
+        join = []
+        while pos < len(idx) and _word(tokens, idx[pos]) in JOIN_WORDS:
+            join.append(_word(tokens, idx[pos]))
+            pos += 1
+        if tokens[idx[pos]][1] == ",":
+            raise _NoRewrite("comma join")
+        if items and "join" not in join or not items and join:
+            raise _NoRewrite("malformed join")
+        table_pos = pos
+        table = _word(tokens, idx[pos])
+        if table is None or table not in TABLES:
+            raise _NoRewrite("unknown table")
+        pos += 1
+        alias = table
+        if pos < len(idx) and _word(tokens, idx[pos]) == "as":
+            pos += 1
+        if pos < len(idx) and tokens[idx[pos]][0] == "name" and _word(tokens, idx[pos]) not in KEYWORDS:
+            alias = _word(tokens, idx[pos])
+            pos += 1
+        name_end = idx[pos - 1] + 1
+        on = None
+        if pos < len(idx) and _word(tokens, idx[pos]) == "on":
+            on_start = pos + 1
+            depth = 0
+            while pos < len(idx):
+                text = tokens[idx[pos]][1]
+                depth += text == "("
+                depth -= text == ")"
+                if depth == 0 and _word(tokens, idx[pos]) in JOIN_WORDS:
+                    break
+                pos += 1
+            on = idx[on_start:pos]
+        elif items:
+            raise _NoRewrite("join without ON")
+        items.append({
+            "join": " ".join(join) or None,
+            "table": table,
+            "alias": alias,
+            "name_span": (idx[table_pos], name_end),
+            "span": (idx[table_pos - len(join)] if join else idx[table_pos],
+                     (on[-1] + 1) if on else name_end),
+            "on": on
+        })
+    return items
+
+
+def _equality(tokens, on):
+    """((qualifier, column), (qualifier, column)) of an ON a.x = b.y condition"""
+    texts = [tokens[i][1].lower() for i in on]
+    if len(texts) != 7 or texts[1] != "." or texts[3] != "=" or texts[5] != ".":
+        raise _NoRewrite("join condition is not a single key equality")
+    return (texts[0], texts[2]), (texts[4], texts[6])
+
+
+def _factors(parts):
+    """
+    Sorted factors of a product, e.g. quantity*list_price*(1-discount)
+    A sum or difference must be parenthesized to count as one factor:
+    quantity*list_price*1-discount is (quantity*list_price*1)-discount.
+    """
+    while parts and parts[0] == "(" and parts[-1] == ")" and _balanced(parts[1:-1]):
+        parts = parts[1:-1]
+    factors, current, depth = [], [], 0
+    for part in parts:
+        depth += part == "("
+        depth -= part == ")"
+        if depth == 0 and part == "*":
+            factors.append(current)
+            current = []
+        else:
+            current.append(part)
+    factors.append(current)
+    if len(factors) == 1:
+        return ("".join(parts),)
+    for factor in factors:
+        depth = 0
+        for n, part in enumerate(factor):
+            depth += part == "("
+            depth -= part == ")"
+            if depth == 0 and n and part in ("+", "-"):
+                raise _NoRewrite("+ / - next to * without parentheses")
+    flat = []
+    for factor in factors:
+        flat.extend(_factors(factor))
+    return tuple(sorted(flat))
+
+
+def _balanced(parts):
+    depth = 0
+    for part in parts:
+        depth += part == "("
+        depth -= part == ")"
+        if depth < 0:
+            return False
+    return depth == 0
+
+
+def _normal_number(text):
+    value = float(text)
+    return str(int(value)) if value.is_integer() else repr(value)
+
+
+class _Statement:
+    """One SELECT being checked (and rewritten) against the rollups"""
+
+    def __init__(self, sql):
+        self.tokens = _tokenize(sql.strip())
+        self.idx = _significant(self.tokens)
+        self.clauses = _clauses(self.tokens, self.idx)
+        self.items = _parse_from(self.tokens, *self.clauses["from"])
+        self.tables = {item["alias"]: item["table"] for item in self.items}
+        if len(self.tables) != len(self.items):
+            raise _NoRewrite("duplicate alias")
+        self.facts = [item for item in self.items if item["table"] in FACT_TABLES]
+        if not self.facts or len({item["table"] for item in self.facts}) != len(self.facts):
+            raise _NoRewrite("no fact table, or a fact table joined twice")
+        self.fact_aliases = {item["alias"] for item in self.facts}
+        self.output_aliases = self._output_aliases()
+        if any(alias in column_names(table) for alias in self.output_aliases for table in self.tables.values()):
+            raise _NoRewrite("output alias shadows a column")
+        self.replacements = {}  # (start, end) -> text
+        self.dimensions = set()
+        self.needs_order_grain = False
+
+    def _output_aliases(self):
+        aliases = set()
+        start, end = self.clauses["select"]
+        idx = _significant(self.tokens, start + 1, end)
+        for n, i in enumerate(idx):
+            if self.tokens[i][0] != "name" or _word(self.tokens, i) in KEYWORDS:
+                continue
+            previous = self.tokens[idx[n - 1]] if n else None
+            following = self.tokens[idx[n + 1]][1] if n + 1 < len(idx) else ","
+            if previous and following == "," and (
+                    _word(self.tokens, idx[n - 1]) == "as" or previous[1] == ")" or previous[0] in ("name", "number")
+                    and _word(self.tokens, idx[n - 1]) not in KEYWORDS and self.tokens[idx[n - 2]][1] != "."):
+                aliases.add(_word(self.tokens, i))
+        return aliases
+
+    def _select_items(self):
+        """[(start, end, output alias or None)] of the select list"""
+        start, end = self.clauses["select"]
+        items, depth, item_start = [], 0, start + 1
+        for i in range(start + 1, end + 1):
+            text = self.tokens[i][1] if i < end else ","
+            depth += text == "("
+            depth -= text == ")"
+            if depth == 0 and text == ",":
+                idx = _significant(self.tokens, item_start, i)
+                last = _word(self.tokens, idx[-1]) if idx else None
+                items.append((item_start, i, last if last in self.output_aliases else None))
+                item_start = i + 1
+        return items
+
+    def _column(self, i):
+        """(alias, column, end index) when the token at i starts a column reference, else None"""
+        word = _word(self.tokens, i)
+        if word is None or word in KEYWORDS:
+            return None
+        sig = [j for j in range(i + 1, min(i + 4, len(self.tokens))) if self.tokens[j][0] != "space"]
+        if sig and self.tokens[sig[0]][1] == "(":
+            return None  # function call
+        if sig and self.tokens[sig[0]][1] == "." and len(sig) > 1:
+            column = _word(self.tokens, sig[1])
+            if word not in self.tables:
+                raise _NoRewrite("unknown qualifier")
+            if column == "*":
+                raise _NoRewrite("qualified *")
+            return word, column, sig[1] + 1
+        if word in self.output_aliases:
+            return None
+        owners = [alias for alias, table in self.tables.items() if word in column_names(table)]
+        if not owners:
+            return None
+        if len(owners) > 1:
+            raise _NoRewrite("ambiguous column")
+        return owners[0], word, i + 1
+
+    def _fact_refs(self, start, end):
+        """[(alias, column, first token, end)] of fact columns in tokens[start:end]"""
+        refs, i = [], start
+        while i < end:
+            if self.tokens[i][0] == "name" and (i == 0 or self.tokens[i - 1][1] != "."):
+                ref = self._column(i)
+                if ref is not None:
+                    if ref[0] in self.fact_aliases:
+                        refs.append((ref[0], ref[1], i, ref[2]))
+                    i = ref[2]
+                    continue
+            i += 1
+        return refs
+
+    def check_joins(self):
+        """Facts joined on order_id, everything else on its primary key; returns the fact-to-fact item"""
+        fact_join = None
+        for item in self.items:
+            if item["on"] is None:
+                continue
+            left, right = _equality(self.tokens, item["on"])
+            if left[0] not in self.tables or right[0] not in self.tables:
+                raise _NoRewrite("unknown qualifier in join")
+            if {left[0], right[0]} <= self.fact_aliases:
+                if left[1] != FACT_KEY or right[1] != FACT_KEY or item["join"] not in ("join", "inner join"):
+                    raise _NoRewrite("facts joined on something other than order_id")
+                fact_join = item
+                continue
+            if item["table"] in FACT_TABLES and item["join"] not in ("join", "inner join"):
+                raise _NoRewrite("outer join of a fact table")
+            if item["alias"] not in (left[0], right[0]) or left[0] == right[0]:
+                raise _NoRewrite("join condition does not link the joined table")
+            own, other = (left, right) if left[0] == item["alias"] else (right, left)
+            # Each fact row may match at most one row: a table joined onto the facts must be
+            # matched on its own primary key, and a fact joined onto an earlier table on that
+            # table's primary key (st.store_id = s.store_id repeats orders once per staff member)
+            alias, column = other if item["table"] in FACT_TABLES else own
+            if alias in self.fact_aliases or TABLES[self.tables[alias]]['primary_key'] != [column]:
+                raise _NoRewrite("join may duplicate rows")
+        if len(self.facts) == 2 and fact_join is None:
+            raise _NoRewrite("facts not joined")
+        return fact_join
+
+    def _aggregate(self, i):
+        """Replacement for the aggregate call starting at i over fact columns (None: no fact columns inside)"""
+        function = _word(self.tokens, i)
+        open_paren = next(j for j in range(i + 1, len(self.tokens)) if self.tokens[j][0] != "space")
+        close = _closing(self.tokens, open_paren)
+        inner = _significant(self.tokens, open_paren + 1, close)
+        refs = self._fact_refs(open_paren + 1, close)
+        distinct = bool(inner) and _word(self.tokens, inner[0]) == "distinct"
+        facts = {self.tables[alias] for alias in self.fact_aliases}
+        star = [self.tokens[j][1] for j in inner] == ["*"]
+
+        if function == "count" and (star or not distinct and refs and len(refs) == 1 and len(inner) in (1, 3)
+                                    and refs[0][1] in NOT_NULL_FACT_COLUMNS[self.tables[refs[0][0]]]):
+            if "order_items" not in facts:
+                raise _NoRewrite("COUNT over orders alone")
+            return close, "COALESCE(SUM({alias}.line_count), 0)"
+        if not refs:
+            if function in ("min", "max") or function == "count" and distinct:
+                return close, None
+            raise _NoRewrite(f"{function.upper()} depends on the number of fact rows")
+        if function == "count" and distinct and len(refs) == 1 and len(inner) in (2, 4) and refs[0][1] == FACT_KEY:
+            self.needs_order_grain = True
+            return close, "COALESCE(SUM({alias}.order_count), 0)"
+        if function in ("min", "max") or function == "count" and distinct:
+            # Insensitive to how many rows each value stands for
+            for alias, column, _, _ in refs:
+                self.dimensions.add(column)
+            return close, None
+        if distinct or function not in ("sum", "total", "avg"):
+            raise _NoRewrite(f"{function.upper()} over fact rows")
+
+        parts, j = [], open_paren + 1
+        while j < close:
+            if self.tokens[j][0] == "space":
+                j += 1
+                continue
+            ref = next((ref for ref in refs if ref[2] == j), None)
+            if ref is not None:
+                parts.append(ref[1])
+                j = ref[3]
+                continue
+            if self.tokens[j][0] == "name":
+                raise _NoRewrite("function or non-fact column in a measure")
+            kind, text = self.tokens[j]
+            parts.append(_normal_number(text) if kind == "number" else text)
+            j += 1
+        measure = MEASURES.get(_factors(parts))
+        if measure is None:
+            raise _NoRewrite("aggregate does not match a measure")
+        if function == "avg":
+            return close, f"(SUM({{alias}}.{measure}) * 1.0 / SUM({{alias}}.line_count))"
+        return close, f"{function.upper()}({{alias}}.{measure})"
+
+    def analyse(self):
+        """Collect the rewrite of every fact reference; raises _NoRewrite when one does not fit"""
+        fact_join = self.check_joins()
+        skip = set(fact_join["on"]) if fact_join else set()
+        grouped = set()
+        if "group" in self.clauses:
+            start, end = self.clauses["group"]
+            grouped = {ref[1] for ref in self._fact_refs(start, end)}
+            # GROUP BY month / GROUP BY 1 groups by a select item
+            items = self._select_items()
+            for i in _significant(self.tokens, start + 1, end):
+                word, text = _word(self.tokens, i), self.tokens[i][1]
+                for n, (item_start, item_end, alias) in enumerate(items):
+                    if word is not None and word == alias or text == str(n + 1):
+                        grouped |= {ref[1] for ref in self._fact_refs(item_start, item_end)}
+
+        aggregates = []  # (start, end) token spans of aggregate calls
+        for start, end in self.clauses.values():
+            i = start
+            while i < end:
+                following = _significant(self.tokens, i + 1, min(i + 3, len(self.tokens)))
+                if _word(self.tokens, i) in AGGREGATES and following and self.tokens[following[0]][1] == "(":
+                    close, text = self._aggregate(i)
+                    aggregates.append((i, close + 1))
+                    if text is not None:
+                        self.replacements[(i, close + 1)] = text
+                    i = close + 1
+                    continue
+                i += 1
+        if not aggregates and "group" not in self.clauses:
+            raise _NoRewrite("not an aggregate query")
+
+        def inside(position, spans):
+            return any(start <= position < end for start, end in spans)
+
+        for clause, (start, end) in self.clauses.items():
+            for alias, column, first, last in self._fact_refs(start, end):
+                if first in skip or inside(first, self.replacements):
+                    continue
+                if clause in ("select", "having", "order") and column not in grouped and \
+                        not inside(first, aggregates):
+                    raise _NoRewrite("ungrouped fact column")
+                self.dimensions.add(column)
+                self.replacements[(first, last)] = "{alias}." + column
+            if clause == "select":
+                idx = _significant(self.tokens, start, end)
+                if any(self.tokens[i][1] == "*" and self.tokens[idx[n - 1]][1].lower() in ("select", "distinct", ",")
+                       for n, i in enumerate(idx) if n):
+                    raise _NoRewrite("SELECT *")
+
+    def choose(self, row_counts):
+        """Smallest available rollup covering the statement, or None"""
+        facts = tuple(sorted(self.tables[alias] for alias in self.fact_aliases))
+        choices = [
+            name for name, rollup in ROLLUPS.items()
+            if name in row_counts and tuple(sorted(rollup.facts)) == facts
+            and self.dimensions <= set(rollup.dimensions) and (rollup.order_grain or not self.needs_order_grain)
+        ]
+        return min(choices, key=lambda name: row_counts[name]) if choices else None
+
+    def render(self, rollup):
+        """SQL with the fact tables replaced by the rollup"""
+        first, *rest = self.facts
+        alias = first["alias"]
+        replacements = {span: text.format(alias=alias) for span, text in self.replacements.items()}
+        replacements[first["name_span"]] = f"{rollup} AS {alias}"
+        for item in rest:
+            replacements[item["span"]] = ""
+        out, i = [], 0
+        for (start, end) in sorted(replacements):
+            if start < i:
+                continue  # nested in a replaced span
+            out.append("".join(text for _, text in self.tokens[i:start]))
+            out.append(replacements[(start, end)])
+            i = end
+        out.append("".join(text for _, text in self.tokens[i:]))
+        return re.sub(r"[ \t]+", " ", "".join(out)).strip()
+
+
+def rewrite_sql(sql, row_counts):
+    """(rewritten SQL, rollup) when a rollup answers the statement exactly, else (sql, None)"""
+    try:
+        statement = _Statement(sql)
+        statement.analyse()
+        rollup = statement.choose(row_counts)
+        if rollup is None:
+            return sql, None
+        return statement.render(rollup), rollup
+    except _NoRewrite as e:
+        logger.debug("No rollup rewrite (%s): %s", e, sql)
+        return sql, None
+    except (StopIteration, IndexError, KeyError):
+        return sql, None
+
+
+def available_rollups():
+    """{rollup: rows} built in the current database by the current definitions"""
+    import database
+
+    pool = database.get_connection_pool()
+    with _lock:
+        if pool.file_id in _available:
+            return _available[pool.file_id]
+    with database.pooled_connection() as conn:
+        try:
+            rows = conn.execute(f"SELECT name, definition_hash, rows FROM {STATE_TABLE}").fetchall()
+        except sqlite3.OperationalError:
+            rows = []
+    available = {name: count for name, digest, count in rows if name in ROLLUPS and digest == definition_hash(name)}
+    with _lock:
+        _available.clear()
+        _available[pool.file_id] = available
+    return available
+
+
+def rewrite(sql):
+    """
+    The SQL to execute for sql: rewritten onto a rollup when one answers it exactly
+    Returns (sql to run, rollup name or None); last_rewrite() tells the same.
+    """
+    _last.rollup = None
+    if not is_enabled() or not sql:
+        return sql, None
+    import database
+
+    available = available_rollups()
+    if not available:
+        return sql, None
+    key = (database.get_connection_pool().file_id, sql)
+    with _lock:
+        if key in _rewrites:
+            _rewrites.move_to_end(key)
+            cached = _rewrites[key]
+        else:
+            cached = False
+    if cached is False:
+        rewritten, rollup = rewrite_sql(sql, available)
+        cached = None
+        if rollup is not None:
+            try:
+                with database.pooled_connection() as conn:
+                    conn.execute(f"EXPLAIN QUERY PLAN {rewritten}")
+                cached = (rewritten, rollup)
+            except sqlite3.Error as e:
+                logger.warning("Discarding rollup rewrite that does not compile (%s): %s", e, rewritten)
+        with _lock:
+            _rewrites[key] = cached
+            while len(_rewrites) > REWRITE_CACHE_SIZE:
+                _rewrites.popitem(last=False)
+    if cached is None:
+        return sql, None
+    _last.rollup = cached[1]
+    tracing.annotate(rollup=cached[1])
+    return cached
+
+
+def last_rewrite():
+    """Rollup the latest rewrite() in this thread used (None if the SQL ran unchanged)"""
+    return getattr(_last, "rollup", None)
@@ -0,0 +1,237 @@
+"""
+Declarative schema for the bike shop database
+One entry per table: source CSV, typed columns, primary key, foreign keys and
+the secondary indexes used by common joins and filters. database.load_database
+builds the SQLite file from these definitions, plus any indexes the index
+advisor applied (ADVISED_INDEXES_FILE).
+"""
+
+import json
+import logging
+from pathlib import Path
+
+from config import get_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ADVISED_INDEXES_FILE = Path(__file__).parent / "advised_indexes.json"
+
+# Tables are listed parents-first so foreign keys always point at an earlier table
+TABLES = {
+    'stores': {
+        'csv': 'stores.csv',
+        'columns': [
+            ('store_id', 'INTEGER NOT NULL'),
+            ('store_name', 'TEXT NOT NULL'),
+            ('phone', 'TEXT'),
+            ('email', 'TEXT'),
+            ('street', 'TEXT'),
+            ('city', 'TEXT'),
+            ('state', 'TEXT'),
+            ('zip_code', 'INTEGER')
+        ],
+        'primary_key': ['store_id'],
+        'foreign_keys': [],
+        'indexes': []
+    },
+    'brands': {
+        'csv': 'brands.csv',
+        'columns': [
+            ('brand_id', 'INTEGER NOT NULL'),
+            ('brand_name', 'TEXT NOT NULL')
+        ],
+        'primary_key': ['brand_id'],
+        'foreign_keys': [],
+        'indexes': []
+    },
+    'categories': {
+        'csv': 'categories.csv',
+        'columns': [
+            ('category_id', 'INTEGER NOT NULL'),
+            ('category_name', 'TEXT NOT NULL')
+        ],
+        'primary_key': ['category_id'],
+        'foreign_keys': [],
+        'indexes': []
+    },
+    'products': {
+        'csv': 'products.csv',
+        'columns': [
+            ('product_id', 'INTEGER NOT NULL'),
+            ('product_name', 'TEXT NOT NULL'),
+            ('brand_id', 'INTEGER NOT NULL'),
+            ('category_id', 'INTEGER NOT NULL'),
+            ('model_year', 'INTEGER NOT NULL'),
+            ('list_price', 'DECIMAL(10, 2) NOT NULL')
+        ],
+        'primary_key': ['product_id'],
+        'foreign_keys': [
+            (['brand_id'], 'brands', ['brand_id']),
+            (['category_id'], 'categories', ['category_id'])
+        ],
+        'indexes': [['brand_id'], ['category_id']]
+    },
+    'customers': {
+        'csv': 'customers.csv',
+        'columns': [
+            ('customer_id', 'INTEGER NOT NULL'),
+            ('first_name', 'TEXT NOT NULL'),
+            ('last_name', 'TEXT NOT NULL'),
+            ('phone', 'TEXT'),
+            ('email', 'TEXT NOT NULL'),
+            ('street', 'TEXT'),
+            ('city', 'TEXT'),
+            ('state', 'TEXT'),
+            ('zip_code', 'INTEGER')
+        ],
+        'primary_key': ['customer_id'],
+        'foreign_keys': [],
+        'indexes': [['state', 'city']]
+    },
+    'staffs': {
+        'csv': 'staffs.csv',
+        'columns': [
+            ('staff_id', 'INTEGER NOT NULL'),
+            ('first_name', 'TEXT NOT NULL'),
+            ('last_name', 'TEXT NOT NULL'),
+            ('email', 'TEXT NOT NULL'),
+            ('phone', 'TEXT'),
+            ('active', 'INTEGER NOT NULL'),
+            ('store_id', 'INTEGER NOT NULL'),
+            ('manager_id', 'INTEGER')
+        ],
+        'primary_key': ['staff_id'],
+        'foreign_keys': [
+            (['store_id'], 'stores', ['store_id']),
+            (['manager_id'], 'staffs', ['staff_id'])
+        ],
+        'indexes': [['store_id'], ['manager_id']]
+    },
+    'orders': {
+        'csv': 'orders.csv',
+        'columns': [
+            ('order_id', 'INTEGER NOT NULL'),
+            ('customer_id', 'INTEGER'),
+            ('order_status', 'INTEGER NOT NULL'),
+            ('order_date', 'DATE NOT NULL'),
+            ('required_date', 'DATE NOT NULL'),
+            ('shipped_date', 'DATE'),
+            ('store_id', 'INTEGER NOT NULL'),
+            ('staff_id', 'INTEGER NOT NULL')
+        ],
+        'primary_key': ['order_id'],
+        'foreign_keys': [
+            (['customer_id'], 'customers', ['customer_id']),
+            (['store_id'], 'stores', ['store_id']),
+            (['staff_id'], 'staffs', ['staff_id'])
+        ],
+        'indexes': [['customer_id'], ['store_id', 'order_date'], ['staff_id'], ['order_date'], ['order_status']]
+    },
+    'order_items': {
+        'csv': 'order_items.csv',
+        'columns': [
+            ('order_id', 'INTEGER NOT NULL'),
+            ('item_id', 'INTEGER NOT NULL'),
+            ('product_id', 'INTEGER NOT NULL'),
+            ('quantity', 'INTEGER NOT NULL'),
+            ('list_price', 'DECIMAL(10, 2) NOT NULL'),
+            ('discount', 'DECIMAL(4, 2) NOT NULL DEFAULT 0')
+        ],
+        # The (order_id, item_id) key also serves order_id join lookups
+        'primary_key': ['order_id', 'item_id'],
+        'foreign_keys': [
+            (['order_id'], 'orders', ['order_id']),
+            (['product_id'], 'products', ['product_id'])
+        ],
+        'indexes': [['product_id']]
+    },
+    'stocks': {
+        'csv': 'stocks.csv',
+        'columns': [
+            ('store_id', 'INTEGER NOT NULL'),
+            ('product_id', 'INTEGER NOT NULL'),
+            ('quantity', 'INTEGER')
+        ],
+        'primary_key': ['store_id', 'product_id'],
+        'foreign_keys': [
+            (['store_id'], 'stores', ['store_id']),
+            (['product_id'], 'products', ['product_id'])
+        ],
+        'indexes': [['product_id']]
+    }
+}
+
+# Values in the CSV exports that mean SQL NULL
+NULL_VALUES = {'', 'NULL', 'null', 'NaN', 'nan'}
+
+
+def column_names(table_name):
+    """Column names of a table, in CSV/insert order"""
+    return [name for name, _ in TABLES[table_name]['columns']]
+
+
+def create_table_sql(table_name):
+    """CREATE TABLE statement with types, primary key and foreign keys"""
+    table = TABLES[table_name]
+    lines = [f"    {name} {col_type}" for name, col_type in table['columns']]
+    lines.append(f"    PRIMARY KEY ({', '.join(table['primary_key'])})")
+    for columns, parent, parent_columns in table['foreign_keys']:
+        lines.append(f"    FOREIGN KEY ({', '.join(columns)}) REFERENCES {parent} ({', '.join(parent_columns)})")
+    return f"CREATE TABLE {table_name} (\n" + ",\n".join(lines) + "\n)"
+
+
+def advised_indexes_path():
+    """File listing the indexes applied by the index advisor"""
+    return Path(get_setting("ADVISED_INDEXES_FILE", DEFAULT_ADVISED_INDEXES_FILE))
+
+
+def load_advised_indexes():
+    """{table: [[column, ...], ...]} applied by the index advisor; unknown tables / columns are ignored"""
+    path = advised_indexes_path()
+    if not path.exists():
+        return {}
+    try:
+        data = json.loads(path.read_text(encoding="utf-8"))
+    except (OSError, ValueError) as e:
+        logger.warning("Ignoring advised indexes in %s: %s", path, e)
+        return {}
+    advised = {}
+    for table_name, indexes in (data if isinstance(data, dict) else {}).items():
+        if table_name not in TABLES:
+            continue
+        known = set(column_names(table_name))
+        advised[table_name] = [list(columns) for columns in indexes
+                               if isinstance(columns, list) and columns and set(columns) <= known]
+    return advised
+
+
+def save_advised_indexes(advised):
+    """Write the advisor's indexes; tables whose index list changed are rebuilt on the next refresh"""
+    path = advised_indexes_path()
+    path.write_text(json.dumps(advised, indent=2, sort_keys=True) + "\n", encoding="utf-8")
+
+
+def index_columns(table_name):
+    """Column lists of a table's declared indexes followed by its advised ones"""
+    declared = TABLES[table_name]['indexes']
+    advised = load_advised_indexes().get(table_name, [])
+    return declared + [columns for columns in advised if columns not in declared]
+
+
+def index_name(table_name, columns):
+    """Name of the index on these columns, e.g. idx_orders_store_id_order_date"""
+    return f"idx_{table_name}_{'_'.join(columns)}"
+
+
+def create_index_sql(table_name):
+    """CREATE INDEX statements for a table's join and filter columns"""
+    return [
+        f"CREATE INDEX {index_name(table_name, columns)} ON {table_name} ({', '.join(columns)})"
+        for columns in index_columns(table_name)
+    ]
+
+
+def insert_sql(table_name):
+    """Parameterized INSERT covering every column of a table"""
+    names = column_names(table_name)
+    return f"INSERT INTO {table_name} ({', '.join(names)}) VALUES ({', '.join('?' for _ in names)})"
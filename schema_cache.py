@@ -0,0 +1,147 @@
+"""
+Process-wide cache of the introspected database schema
+Holds the structured schema, its compact per-table prompt lines and the
+per-table retrieval documents, keyed on the database file and PRAGMA
+schema_version so a rebuilt or altered database invalidates it
+automatically. Every question after the first reuses the same objects
+instead of re-running PRAGMA table_info and re-serializing the schema.
+"""
+
+import hashlib
+import json
+import threading
+from collections import namedtuple
+
+import database
+from config import get_int_setting
+
+SchemaSnapshot = namedtuple("SchemaSnapshot", ["version", "fingerprint", "schema", "table_lines", "table_documents"])
+
+# Default token budget for the schema section of the generation prompt
+DEFAULT_SCHEMA_TOKEN_BUDGET = 1500
+
+_snapshot = None
+_snapshot_lock = threading.Lock()
+
+
+def render_column(col):
+    """Compact column rendering: name, type, PK marker and FK target"""
+    text = f"{col['name']} {col['type']}".rstrip()
+    if col.get('pk'):
+        text += " PK"
+    if col.get('fk'):
+        text += f" FK→{col['fk']}"
+    return text
+
+
+def render_table_lines(schema_info):
+    """One DDL-like line per table, e.g. orders(order_id INTEGER PK, customer_id INTEGER FK→customers.customer_id, ...)"""
+    return {
+        table_name: f"{table_name}(" + ", ".join(render_column(col) for col in columns) + ")"
+        for table_name, columns in schema_info.items()
+    }
+
+
+def estimate_tokens(text):
+    """Rough token count (about four characters per token for schema text)"""
+    return len(text) // 4 + 1
+
+
+def render_prompt_schema(schema_info, focus_tables=None, token_budget=None):
+    """
+    Schema section of the generation prompt
+    Tables in focus_tables (e.g. the ones retrieval found) get a full line each,
+    in order, until token_budget is spent; every other table is listed by name
+    only. Without focus tables all tables are candidates for a full line.
+    """
+    if token_budget is None:
+        token_budget = get_int_setting("SCHEMA_TOKEN_BUDGET", DEFAULT_SCHEMA_TOKEN_BUDGET)
+
+    snapshot = _snapshot
+    if snapshot is not None and schema_info is snapshot.schema:
+        table_lines = snapshot.table_lines
+    else:
+        table_lines = render_table_lines(schema_info)
+
+    candidates = [t for t in (focus_tables or []) if t in table_lines] or list(table_lines)
+
+    detailed = []
+    used = 0
+    for table_name in candidates:
+        cost = estimate_tokens(table_lines[table_name])
+        # Always keep at least one table in full, even over budget
+        if detailed and used + cost > token_budget:
+            break
+        detailed.append(table_name)
+        used += cost
+
+    lines = [table_lines[t] for t in detailed]
+    others = [t for t in table_lines if t not in detailed]
+    if others:
+        lines.append("Other tables (columns omitted): " + ", ".join(others))
+    return "\n".join(lines)
+
+
+def build_table_documents(schema_info):
+    """One retrieval document per table describing its columns"""
+    documents = []
+    for table_name, columns in schema_info.items():
+        table_desc = f"Table: {table_name}. Columns: " + ", ".join([f"{col['name']} ({col['type']})" for col in columns])
+        documents.append({"id": f"table_{table_name}", "text": table_desc, "type": "table"})
+    return documents
+
+
+def schema_fingerprint(schema_info):
+    """Content hash of a schema: stable across rebuilds that leave the schema unchanged"""
+    snapshot = _snapshot
+    if snapshot is not None and schema_info is snapshot.schema:
+        return snapshot.fingerprint
+    return hashlib.sha256(json.dumps(schema_info, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def current_version():
+    """(database path, file inode, PRAGMA schema_version) of the live database"""
+    pool = database.get_connection_pool()
+    with pool.connection() as conn:
+        schema_version = conn.execute("PRAGMA schema_version").fetchone()[0]
+    return (str(pool.db_path), pool.file_id, schema_version)
+
+
+def get_schema_snapshot():
+    """Current schema snapshot, re-introspecting only when the version changed"""
+    global _snapshot
+    version = current_version()
+    snapshot = _snapshot
+    if snapshot is None or snapshot.version != version:
+        with _snapshot_lock:
+            if _snapshot is None or _snapshot.version != version:
+                schema_info = database.introspect_schema()
+                _snapshot = SchemaSnapshot(
+                    version=version,
+                    fingerprint=schema_fingerprint(schema_info),
+                    schema=schema_info,
+                    table_lines=render_table_lines(schema_info),
+                    table_documents=build_table_documents(schema_info)
+                )
+            snapshot = _snapshot
+    return snapshot
+
+
+def get_database_schema():
+    """Get schema information from the database (cached per schema version)"""
+    return get_schema_snapshot().schema
+
+
+def get_table_documents(schema_info):
+    """Retrieval documents for schema_info - precomputed when it is the cached schema"""
+    snapshot = _snapshot
+    if snapshot is not None and schema_info is snapshot.schema:
+        return snapshot.table_documents
+    return build_table_documents(schema_info)
+
+
+def invalidate():
+    """Drop the cached snapshot (the next lookup re-introspects)"""
+    global _snapshot
+    with _snapshot_lock:
+        _snapshot = None
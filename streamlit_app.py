@@ -1,17 +1,15 @@
 import streamlit as st
-import sqlite3
-import pandas as pd
-from pathlib import Path
-from openai import AzureOpenAI
-import json
-import re
-import os
-from dotenv import load_dotenv
-from pinecone import Pinecone, ServerlessSpec
-from sentence_transformers import SentenceTransformer
 
-# Load environment variables from .env for local development
-load_dotenv()
+import answer_cache
+import database
+import engine
+import query_cost
+import retrieval
+import tracing
+from app_ui import (confirm_cost, execute_sql_query, get_cost_estimate, render_export, render_result_page,
+                    row_count_label, set_last_result)
+from config import ConfigurationError
+from schema_cache import get_database_schema
 
 # Page configuration
 st.set_page_config(
@@ -39,6 +37,10 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+# Load the embedding model in the background (once per process, not per rerun)
+retrieval.start_warmup()
+tracing.start_metrics_server()
+
 # Initialize session state
 if 'db_loaded' not in st.session_state:
     st.session_state.db_loaded = False
@@ -47,259 +49,51 @@ if 'query_history' not in st.session_state:
 if 'vector_db_initialized' not in st.session_state:
     st.session_state.vector_db_initialized = False
 
-@st.cache_resource
-def get_embedding_model():
-    """Load sentence transformer model for embeddings"""
-    return SentenceTransformer('all-MiniLM-L6-v2')
-
-def get_pinecone_client():
-    """Initialize Pinecone client"""
-    try:
-        api_key = st.secrets["PINECONE_API_KEY"]
-        env = st.secrets.get("PINECONE_ENVIRONMENT", "us-east-1")
-    except (KeyError, FileNotFoundError):
-        api_key = os.getenv("PINECONE_API_KEY")
-        env = os.getenv("PINECONE_ENVIRONMENT", "us-east-1")
-    
-    if not api_key:
-        return None
-    
-    return Pinecone(api_key=api_key), env
-
 def initialize_vector_db(schema_info):
-    """Initialize Pinecone with schema information and example queries"""
-    pc, env = get_pinecone_client()
-    if not pc:
-        st.warning("⚠️ Pinecone API key not configured")
-        return False
-    
-    index_name = os.getenv("PINECONE_INDEX", st.secrets.get("PINECONE_INDEX", "text2sql-index"))
-    
+    """Index schema information and example queries in the vector DB (local or Pinecone)"""
     try:
-        # Check if index exists
-        indexes = pc.list_indexes()
-        if index_name not in [idx.name for idx in indexes]:
-            st.info(f"ℹ️ Creating Pinecone index: {index_name}")
-            env = os.getenv("PINECONE_ENVIRONMENT", st.secrets.get("PINECONE_ENVIRONMENT", "us-east-1"))
-            pc.create_index(
-                name=index_name,
-                dimension=384,
-                metric="cosine",
-                spec=ServerlessSpec(
-                    cloud="aws",
-                    region=env
-                )
-            )
-        
-        index = pc.Index(index_name)
-        embedding_model = get_embedding_model()
-        
-        # Create documents from schema
-        documents = []
-        
-        # Add table descriptions
-        for table_name, columns in schema_info.items():
-            table_desc = f"Table: {table_name}. Columns: " + ", ".join([f"{col['name']} ({col['type']})" for col in columns])
-            documents.append({"id": f"table_{table_name}", "text": table_desc, "type": "table"})
-        
-        # Add example queries for better semantic understanding
-        example_queries = [
-            "Show me top selling products",
-            "List customers by order count",
-            "Revenue by store",
-            "Products in stock by category",
-            "Customer purchase history",
-            "Staff sales performance",
-            "Orders by date range",
-            "Brand popularity analysis"
-        ]
-        
-        for i, example in enumerate(example_queries):
-            documents.append({"id": f"example_{i}", "text": example, "type": "example"})
-        
-        # Embed and upsert documents
-        for doc in documents:
-            embedding = embedding_model.encode(doc["text"]).tolist()
-            index.upsert(vectors=[(doc["id"], embedding, {"text": doc["text"], "type": doc["type"]})])
-        
-        st.success(f"✓ Vector database initialized with {len(documents)} documents")
-        return True
-    
+        stats = retrieval.initialize_vector_db(schema_info)
+    except ConfigurationError as e:
+        st.warning(f"⚠️ {str(e)}")
+        return False
     except Exception as e:
         st.error(f"❌ Error initializing vector DB: {str(e)}")
         return False
 
-def search_relevant_schema(user_query, top_k=5):
-    """Search for relevant schema using semantic search"""
-    pc, env = get_pinecone_client()
-    if not pc:
-        return None
-    
-    try:
-        index_name = os.getenv("PINECONE_INDEX", st.secrets.get("PINECONE_INDEX", "text2sql-index"))
-        index = pc.Index(index_name)
-        embedding_model = get_embedding_model()
-        
-        # Embed user query
-        query_embedding = embedding_model.encode(user_query).tolist()
-        
-        # Search Pinecone
-        results = index.query(
-            vector=query_embedding,
-            top_k=top_k,
-            include_metadata=True
-        )
-        
-        return results
-    except Exception as e:
-        st.warning(f"⚠️ Vector search unavailable: {str(e)}")
-        return None
-
-def get_database_connection():
-    """Create database connection (thread-safe, no caching)"""
-    current_dir = Path(__file__).parent
-    db_path = current_dir / "bike_shop.db"
-    
-    # Load database from CSV files if it doesn't exist
-    if not db_path.exists():
-        load_database(db_path)
-    
-    # Don't cache - create new connection per call for thread safety
-    conn = sqlite3.connect(str(db_path), check_same_thread=False)
-    return conn
-
-def load_database(db_path):
-    """Load CSV files into SQLite database"""
-    conn = sqlite3.connect(str(db_path))
-    cursor = conn.cursor()
-    
-    current_dir = Path(__file__).parent
-    csv_files = {
-        'stores': 'stores.csv',
-        'brands': 'brands.csv',
-        'categories': 'categories.csv',
-        'products': 'products.csv',
-        'customers': 'customers.csv',
-        'orders': 'orders.csv',
-        'order_items': 'order_items.csv',
-        'staffs': 'staffs.csv',
-        'stocks': 'stocks.csv'
-    }
-    
-    for table_name, csv_file in csv_files.items():
-        csv_path = current_dir / csv_file
-        if csv_path.exists():
-            df = pd.read_csv(csv_path)
-            df.to_sql(table_name, conn, if_exists='replace', index=False)
-    
-    conn.commit()
-    conn.close()
-
-def get_database_schema():
-    """Get schema information from the database"""
-    conn = get_database_connection()
-    cursor = conn.cursor()
-    
-    # Get all tables
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = cursor.fetchall()
-    
-    schema_info = {}
-    for table in tables:
-        table_name = table[0]
-        cursor.execute(f"PRAGMA table_info({table_name});")
-        columns = cursor.fetchall()
-        schema_info[table_name] = [
-            {"name": col[1], "type": col[2]} for col in columns
-        ]
-    
-    conn.close()
-    return schema_info
+    st.success(f"✓ Vector database ({retrieval.get_backend_name()}) synced: {stats['documents']} documents "
+               f"({stats['upserted']} updated, {stats['deleted']} removed)")
+    return True
 
 def generate_sql_with_claude(user_query, schema_info):
-    """Generate SQL query using Azure OpenAI GPT-4o-mini with vector search"""
-    
-    # Try to get from Streamlit secrets first (Streamlit Cloud), then fallback to environment variables
+    """Generate SQL query using Azure OpenAI GPT-4o-mini with vector search, showing it as it streams"""
+    # Vector search and the answer-cache lookup run concurrently in the engine
+    sql_placeholder = st.empty()
+    status_placeholder = st.empty()
+    result = None
     try:
-        api_key = st.secrets["AZURE_OPENAI_API_KEY"]
-        endpoint = st.secrets["AZURE_OPENAI_ENDPOINT"]
-    except (KeyError, FileNotFoundError):
-        api_key = os.getenv("AZURE_OPENAI_API_KEY")
-        endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-    
-    if not api_key or not endpoint:
-        st.error("❌ Azure OpenAI credentials not configured. Please set AZURE_OPENAI_API_KEY and AZURE_OPENAI_ENDPOINT in .streamlit/secrets.toml or .env file")
+        for event, payload in engine.generate_stream(user_query, schema_info, mode="basic", top_k=3):
+            if event == "sql":
+                sql_placeholder.code(payload, language="sql")
+            elif event == "repair":
+                status_placeholder.caption(f"🔧 Repairing SQL (attempt {payload['attempt']}): {payload['error']}")
+            elif event == "done":
+                result = payload
+    except ConfigurationError as e:
+        st.error(f"❌ {str(e)}")
         return None
-    
-    client = AzureOpenAI(
-        api_key=api_key,
-        api_version="2024-02-15-preview",
-        azure_endpoint=endpoint
-    )
-    
-    # Try to get relevant schema from vector DB
-    relevant_tables = "No specific tables found. Using full schema."
-    try:
-        search_results = search_relevant_schema(user_query, top_k=3)
-        if search_results and search_results.matches:
-            relevant_tables = "Relevant schema:\n"
-            for match in search_results.matches:
-                if match.metadata and "text" in match.metadata:
-                    relevant_tables += f"- {match.metadata['text']}\n"
-    except Exception as e:
-        pass  # Continue with full schema if vector search fails
-    
-    # Format schema information
-    schema_text = json.dumps(schema_info, indent=2)
-    
-    prompt = f"""You are a SQL query expert. Convert the following natural language query into a valid SQLite SQL query.
-
-{relevant_tables}
-
-FULL DATABASE SCHEMA:
-{schema_text}
-
-IMPORTANT RULES:
-1. Only use tables and columns that exist in the schema
-2. Return ONLY the SQL query, nothing else
-3. Use SQLite syntax
-4. Make sure the query is valid and will execute
-5. Include appropriate JOINs if needed
-6. Use meaningful aliases for clarity
-7. Do NOT include markdown formatting or code blocks
-8. Do NOT include explanations, only the SQL query
-
-USER QUERY: {user_query}
+    finally:
+        sql_placeholder.empty()
+        status_placeholder.empty()
 
-RESPONSE (SQL QUERY ONLY):"""
-
-    message = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0.2,
-        max_tokens=512
-    )
-    
-    sql_query = message.choices[0].message.content.strip()
-    
-    # Remove markdown code blocks if present
-    if sql_query.startswith('```'):
-        sql_query = re.sub(r'^```sql\n?', '', sql_query)
-        sql_query = re.sub(r'\n?```$', '', sql_query)
-    
-    return sql_query.strip()
-
-def execute_sql_query(sql_query):
-    """Execute SQL query and return results"""
-    try:
-        conn = get_database_connection()
-        df = pd.read_sql_query(sql_query, conn)
-        conn.close()
-        return df, None
-    except Exception as e:
-        return None, str(e)
+    if result['retrieval_error']:
+        st.warning(f"⚠️ Vector search unavailable: {result['retrieval_error']}")
+    if len(result['attempts']) > 1:
+        outcome = "fixed" if result['valid'] else "still invalid"
+        st.caption(f"🔧 SQL auto-repaired: {len(result['attempts']) - 1} repair attempt(s), {outcome}")
+    st.session_state.answer_cache_hit = result['cache']
+    st.session_state.validation = (result['sql'], result['valid'], result['validation_message'])
+    st.session_state.cost = (result['sql'], query_cost.CostEstimate(**result['cost']) if result['cost'] else None)
+    return result['sql']
 
 # Main UI
 st.title("🔍 Text-to-SQL Query Engine")
@@ -316,8 +110,13 @@ with st.sidebar:
             st.session_state.schema = schema
             st.success("✓ Schema loaded!")
     
+    pool_stats = database.get_pool_stats()
+    if pool_stats:
+        st.caption(f"🔌 Connection pool: {pool_stats['in_use']}/{pool_stats['size']} in use • "
+                   f"avg wait {pool_stats['avg_wait_ms']:.1f} ms • max {pool_stats['max_wait_ms']:.1f} ms")
+    
     st.subheader("Vector Database")
-    if st.button("Initialize Pinecone 🚀", use_container_width=True):
+    if st.button("Initialize Vector DB 🚀", use_container_width=True):
         with st.spinner("Initializing vector DB..."):
             if 'schema' not in st.session_state:
                 schema = get_database_schema()
@@ -329,7 +128,19 @@ with st.sidebar:
                 st.session_state.vector_db_initialized = False
     
     if st.session_state.vector_db_initialized:
-        st.success("✓ Pinecone initialized")
+        st.success("✓ Vector DB initialized")
+    
+    embedding_stats = retrieval.get_embedding_stats()
+    if embedding_stats['model_loaded']:
+        cache_stats = embedding_stats['cache']
+        st.caption(f"🧠 Embedding model loaded in {embedding_stats['model_load_seconds']:.1f}s • "
+                   f"cache hit rate {cache_stats['hit_rate']:.0%} ({cache_stats['entries']} entries)")
+    else:
+        st.caption("🧠 Embedding model loading...")
+    
+    answer_stats = answer_cache.get_stats()
+    if answer_stats:
+        st.caption(f"⚡ Answer cache: {answer_stats['hit_rate']:.0%} hit rate, {answer_stats['entries']} entries")
     
     if 'schema' in st.session_state:
         st.subheader("Database Tables")
@@ -366,9 +177,14 @@ with tab1:
                         st.session_state.schema = schema
                     
                     sql_query = generate_sql_with_claude(user_input, st.session_state.schema)
-                    st.session_state.generated_sql = sql_query
-                    
-                    st.success("✓ SQL generated successfully!")
+                    # None: a configuration error was already shown
+                    if sql_query is not None:
+                        st.session_state.generated_sql = sql_query
+
+                        if st.session_state.get('answer_cache_hit'):
+                            st.success(f"⚡ SQL served from answer cache ({st.session_state.answer_cache_hit} match)")
+                        else:
+                            st.success("✓ SQL generated successfully!")
                     
                 except Exception as e:
                     st.error(f"❌ Error generating SQL: {str(e)}")
@@ -382,42 +198,47 @@ with tab1:
         ```
         """)
         
+        estimate = get_cost_estimate(st.session_state.generated_sql)
+        if estimate:
+            st.caption(f"🧭 Estimated cost: {estimate.cost_class} ({query_cost.describe(estimate)})")
+        cost_ok = confirm_cost(st.session_state.generated_sql, estimate)
+        
         col1, col2 = st.columns(2)
         with col1:
-            execute_btn = st.button("▶️ Execute Query", use_container_width=True, type="primary")
+            execute_btn = st.button("▶️ Execute Query", use_container_width=True, type="primary", disabled=not cost_ok)
         with col2:
             if st.button("📋 Copy SQL", use_container_width=True):
                 st.info("SQL query copied to clipboard!")
         
+        if st.session_state.pop('query_cancelled', False):
+            st.warning("⏹️ Query cancelled")
+        
         if execute_btn:
             with st.spinner("⏳ Executing query..."):
-                df_result, error = execute_sql_query(st.session_state.generated_sql)
+                result, error, _ = execute_sql_query(st.session_state.generated_sql)
                 
                 if error:
                     st.error(f"❌ Query execution error: {error}")
                 else:
-                    st.session_state.last_result = df_result
+                    set_last_result(result)
                     st.session_state.query_history.append({
                         'query': user_input,
                         'sql': st.session_state.generated_sql,
-                        'rows': len(df_result)
+                        'rows': result.total_rows if result.exhausted else result.fetched_rows,
+                        'cache_hit': st.session_state.result_cache_hit
                     })
-                    st.success(f"✓ Query executed successfully! ({len(df_result)} rows)")
+                    if st.session_state.result_cache_hit:
+                        st.success(f"♻️ Served from result cache ({row_count_label(result)} rows)")
+                    else:
+                        st.success(f"✓ Query executed successfully! ({row_count_label(result)} rows)")
     
     # Display results
     if 'last_result' in st.session_state:
         st.subheader("Query Results")
-        st.dataframe(st.session_state.last_result, use_container_width=True)
+        render_result_page(st.session_state.last_result)
         
         # Download results
-        csv = st.session_state.last_result.to_csv(index=False)
-        st.download_button(
-            label="⬇️ Download Results as CSV",
-            data=csv,
-            file_name="query_results.csv",
-            mime="text/csv",
-            use_container_width=True
-        )
+        render_export(st.session_state.last_result, "query_results")
 
 with tab2:
     st.subheader("Query History")
@@ -431,6 +252,8 @@ with tab2:
                 ```
                 """)
                 st.info(f"Rows returned: {query['rows']}")
+                if query.get('cache_hit'):
+                    st.caption(f"♻️ Result served from cache ({query['cache_hit']})")
     else:
         st.info("📭 No queries executed yet")
 
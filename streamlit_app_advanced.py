@@ -10,20 +10,24 @@ Features:
 """
 
 import streamlit as st
-import sqlite3
-import pandas as pd
-from pathlib import Path
-from openai import AzureOpenAI
-import json
-import re
-import time
 from datetime import datetime
-import os
-from dotenv import load_dotenv
-from pinecone import Pinecone, ServerlessSpec
-from sentence_transformers import SentenceTransformer
 
-load_dotenv()
+import answer_cache
+import clients
+import database
+import engine
+import index_advisor
+import query_cost
+import result_cache
+import retrieval
+import tracing
+import visualization
+import workload
+from app_ui import (confirm_cost, execute_sql_query, get_cost_estimate, render_export, render_result_page,
+                    row_count_label, set_last_result)
+from config import ConfigurationError
+from database import validate_sql_syntax
+from schema_cache import get_database_schema
 
 # Page configuration
 st.set_page_config(
@@ -63,6 +67,10 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
+# Load the embedding model in the background (once per process, not per rerun)
+retrieval.start_warmup()
+tracing.start_metrics_server()
+
 # Initialize session state
 if 'db_loaded' not in st.session_state:
     st.session_state.db_loaded = False
@@ -73,311 +81,55 @@ if 'feedback_data' not in st.session_state:
 if 'vector_db_initialized' not in st.session_state:
     st.session_state.vector_db_initialized = False
 
-@st.cache_resource
-def get_embedding_model():
-    """Load sentence transformer model for embeddings"""
-    return SentenceTransformer('all-MiniLM-L6-v2')
-
-def get_pinecone_client():
-    """Initialize Pinecone client"""
-    try:
-        api_key = st.secrets["PINECONE_API_KEY"]
-        env = st.secrets.get("PINECONE_ENVIRONMENT", "us-east-1")
-    except (KeyError, FileNotFoundError):
-        api_key = os.getenv("PINECONE_API_KEY")
-        env = os.getenv("PINECONE_ENVIRONMENT", "us-east-1")
-    
-    if not api_key:
-        return None
-    
-    return Pinecone(api_key=api_key), env
-
 def initialize_vector_db(schema_info):
-    """Initialize Pinecone with schema information and example queries"""
-    pc, env = get_pinecone_client()
-    if not pc:
-        st.warning("⚠️ Pinecone API key not configured")
-        return False
-    
-    index_name = os.getenv("PINECONE_INDEX", st.secrets.get("PINECONE_INDEX", "text2sql-index"))
-    
+    """Index schema information and example queries in the vector DB (local or Pinecone)"""
     try:
-        # Check if index exists
-        indexes = pc.list_indexes()
-        if index_name not in [idx.name for idx in indexes]:
-            st.info(f"ℹ️ Creating Pinecone index: {index_name}")
-            env = os.getenv("PINECONE_ENVIRONMENT", st.secrets.get("PINECONE_ENVIRONMENT", "us-east-1"))
-            pc.create_index(
-                name=index_name,
-                dimension=384,
-                metric="cosine",
-                spec=ServerlessSpec(
-                    cloud="aws",
-                    region=env
-                )
-            )
-        
-        index = pc.Index(index_name)
-        embedding_model = get_embedding_model()
-        
-        # Create documents from schema
-        documents = []
-        
-        # Add table descriptions
-        for table_name, columns in schema_info.items():
-            table_desc = f"Table: {table_name}. Columns: " + ", ".join([f"{col['name']} ({col['type']})" for col in columns])
-            documents.append({"id": f"table_{table_name}", "text": table_desc, "type": "table"})
-        
-        # Add example queries
-        example_queries = [
-            "Show me top selling products",
-            "List customers by order count",
-            "Revenue by store",
-            "Products in stock by category",
-            "Customer purchase history",
-            "Staff sales performance",
-            "Orders by date range",
-            "Brand popularity analysis"
-        ]
-        
-        for i, example in enumerate(example_queries):
-            documents.append({"id": f"example_{i}", "text": example, "type": "example"})
-        
-        # Embed and upsert documents
-        for doc in documents:
-            embedding = embedding_model.encode(doc["text"]).tolist()
-            index.upsert(vectors=[(doc["id"], embedding, {"text": doc["text"], "type": doc["type"]})])
-        
-        st.success(f"✓ Vector database initialized with {len(documents)} documents")
-        return True
-    
+        stats = retrieval.initialize_vector_db(schema_info)
+    except ConfigurationError as e:
+        st.warning(f"⚠️ {str(e)}")
+        return False
     except Exception as e:
         st.error(f"❌ Error initializing vector DB: {str(e)}")
         return False
 
-def search_relevant_schema(user_query, top_k=5):
-    """Search for relevant schema using semantic search"""
-    pc, env = get_pinecone_client()
-    if not pc:
-        return None
-    
-    try:
-        index_name = os.getenv("PINECONE_INDEX", st.secrets.get("PINECONE_INDEX", "text2sql-index"))
-        index = pc.Index(index_name)
-        embedding_model = get_embedding_model()
-        
-        # Embed user query
-        query_embedding = embedding_model.encode(user_query).tolist()
-        
-        # Search Pinecone
-        results = index.query(
-            vector=query_embedding,
-            top_k=top_k,
-            include_metadata=True
-        )
-        
-        return results
-    except Exception as e:
-        st.warning(f"⚠️ Vector search unavailable: {str(e)}")
-        return None
-
-def get_database_connection():
-    """Create database connection (thread-safe, no caching)"""
-    current_dir = Path(__file__).parent
-    db_path = current_dir / "bike_shop.db"
-    
-    if not db_path.exists():
-        load_database(db_path)
-    
-    # Don't cache - create new connection per call for thread safety
-    conn = sqlite3.connect(str(db_path), check_same_thread=False)
-    return conn
-
-def load_database(db_path):
-    """Load CSV files into SQLite database"""
-    conn = sqlite3.connect(str(db_path))
-    cursor = conn.cursor()
-    
-    current_dir = Path(__file__).parent
-    csv_files = {
-        'stores': 'stores.csv',
-        'brands': 'brands.csv',
-        'categories': 'categories.csv',
-        'products': 'products.csv',
-        'customers': 'customers.csv',
-        'orders': 'orders.csv',
-        'order_items': 'order_items.csv',
-        'staffs': 'staffs.csv',
-        'stocks': 'stocks.csv'
-    }
-    
-    for table_name, csv_file in csv_files.items():
-        csv_path = current_dir / csv_file
-        if csv_path.exists():
-            df = pd.read_csv(csv_path)
-            df.to_sql(table_name, conn, if_exists='replace', index=False)
-    
-    conn.commit()
-    conn.close()
-
-def get_database_schema():
-    """Get schema information from the database"""
-    conn = get_database_connection()
-    cursor = conn.cursor()
-    
-    cursor.execute("SELECT name FROM sqlite_master WHERE type='table';")
-    tables = cursor.fetchall()
-    
-    schema_info = {}
-    for table in tables:
-        table_name = table[0]
-        cursor.execute(f"PRAGMA table_info({table_name});")
-        columns = cursor.fetchall()
-        schema_info[table_name] = [
-            {"name": col[1], "type": col[2]} for col in columns
-        ]
-    
-    conn.close()
-    return schema_info
+    st.success(f"✓ Vector database ({retrieval.get_backend_name()}) synced: {stats['documents']} documents "
+               f"({stats['upserted']} updated, {stats['deleted']} removed)")
+    return True
 
 def generate_sql_with_validation(user_query, schema_info):
     """Generate SQL query with validation, optimization suggestions, and vector search"""
-    
-    # Try to get from Streamlit secrets first (Streamlit Cloud), then fallback to environment variables
+    # Vector search and the answer-cache lookup run concurrently in the engine; the SQL
+    # is shown as it streams and validated while the metadata is still arriving
+    sql_placeholder = st.empty()
+    status_placeholder = st.empty()
+    result = None
     try:
-        api_key = st.secrets["AZURE_OPENAI_API_KEY"]
-        endpoint = st.secrets["AZURE_OPENAI_ENDPOINT"]
-    except (KeyError, FileNotFoundError):
-        api_key = os.getenv("AZURE_OPENAI_API_KEY")
-        endpoint = os.getenv("AZURE_OPENAI_ENDPOINT")
-    
-    if not api_key or not endpoint:
-        st.error("❌ Azure OpenAI credentials not configured. Please set AZURE_OPENAI_API_KEY and AZURE_OPENAI_ENDPOINT in .streamlit/secrets.toml or .env file")
+        for event, payload in engine.generate_stream(user_query, schema_info, mode="advanced", top_k=3):
+            if event == "sql":
+                sql_placeholder.code(payload, language="sql")
+            elif event == "validated":
+                is_valid, validation_msg = payload
+                status_placeholder.caption("✓ SQL syntax valid" if is_valid else f"❌ {validation_msg}")
+            elif event == "repair":
+                status_placeholder.caption(f"🔧 Repairing SQL (attempt {payload['attempt']}): {payload['error']}")
+            elif event == "done":
+                result = payload
+    except ConfigurationError as e:
+        st.error(f"❌ {str(e)}")
         return None
-    
-    client = AzureOpenAI(
-        api_key=api_key,
-        api_version="2024-02-15-preview",
-        azure_endpoint=endpoint
-    )
-    
-    # Try to get relevant schema from vector DB
-    relevant_tables = "No specific tables found. Using full schema."
-    try:
-        search_results = search_relevant_schema(user_query, top_k=3)
-        if search_results and search_results.matches:
-            relevant_tables = "Relevant schema:\n"
-            for match in search_results.matches:
-                if match.metadata and "text" in match.metadata:
-                    relevant_tables += f"- {match.metadata['text']}\n"
-    except Exception as e:
-        pass  # Continue with full schema if vector search fails
-    
-    schema_text = json.dumps(schema_info, indent=2)
-    
-    prompt = f"""You are an expert SQL query generator. Convert this natural language query to SQL.
-
-{relevant_tables}
-
-FULL DATABASE SCHEMA:
-{schema_text}
-
-RULES:
-1. Only use existing tables and columns
-2. Return ONLY the SQL query
-3. Use SQLite syntax
-4. Optimize for performance (use indexes, proper JOINs)
-5. No markdown formatting
-6. Make the query readable with proper formatting
-
-Also provide:
-- Query complexity (Simple/Medium/Complex)
-- Estimated rows affected
-- Suggested indexes (if any)
-
-Format your response as:
-SQL: [your-sql-query]
-COMPLEXITY: [Simple/Medium/Complex]
-ROWS_ESTIMATED: [approximate number]
-NOTES: [any optimization notes]
-
-USER QUERY: {user_query}"""
-
-    message = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {"role": "user", "content": prompt}
-        ],
-        temperature=0.2,
-        max_tokens=512
-    )
-    
-    response_text = message.choices[0].message.content.strip()
-    
-    # Parse the response
-    parsed = {
-        'sql': '',
-        'complexity': 'Unknown',
-        'estimated_rows': 0,
-        'notes': ''
-    }
-    
-    for line in response_text.split('\n'):
-        if line.startswith('SQL:'):
-            parsed['sql'] = line.replace('SQL:', '').strip()
-        elif line.startswith('COMPLEXITY:'):
-            parsed['complexity'] = line.replace('COMPLEXITY:', '').strip()
-        elif line.startswith('ROWS_ESTIMATED:'):
-            try:
-                parsed['estimated_rows'] = int(line.replace('ROWS_ESTIMATED:', '').strip())
-            except:
-                pass
-        elif line.startswith('NOTES:'):
-            parsed['notes'] = line.replace('NOTES:', '').strip()
-    
-    return parsed
-
-def validate_sql_syntax(sql_query):
-    """Validate SQL syntax"""
-    try:
-        conn = get_database_connection()
-        conn.execute(f"EXPLAIN QUERY PLAN {sql_query}")
-        conn.close()
-        return True, "SQL syntax is valid"
-    except Exception as e:
-        return False, str(e)
+    finally:
+        sql_placeholder.empty()
+        status_placeholder.empty()
 
-def execute_sql_query(sql_query):
-    """Execute SQL query and return results with timing"""
-    start_time = time.time()
-    try:
-        conn = get_database_connection()
-        df = pd.read_sql_query(sql_query, conn)
-        conn.close()
-        execution_time = time.time() - start_time
-        return df, None, execution_time
-    except Exception as e:
-        return None, str(e), 0
-
-def create_visualizations(df):
-    """Create automatic visualizations based on data"""
-    import matplotlib.pyplot as plt
-    
-    if df is None or len(df) == 0:
-        return None
-    
-    # Simple visualization for numerical columns
-    numeric_cols = df.select_dtypes(include=['int64', 'float64']).columns.tolist()
-    string_cols = df.select_dtypes(include=['object']).columns.tolist()
-    
-    if len(numeric_cols) > 0 and len(string_cols) > 0:
-        fig, ax = plt.subplots(figsize=(10, 5))
-        df.plot(x=string_cols[0], y=numeric_cols[0], kind='bar', ax=ax)
-        plt.title(f"{numeric_cols[0]} by {string_cols[0]}")
-        plt.tight_layout()
-        return fig
-    
-    return None
+    if result['retrieval_error']:
+        st.warning(f"⚠️ Vector search unavailable: {result['retrieval_error']}")
+    if len(result['attempts']) > 1:
+        outcome = "fixed" if result['valid'] else "still invalid"
+        st.caption(f"🔧 SQL auto-repaired: {len(result['attempts']) - 1} repair attempt(s), {outcome}")
+    st.session_state.answer_cache_hit = result['cache']
+    st.session_state.validation = (result['sql'], result['valid'], result['validation_message'])
+    st.session_state.cost = (result['sql'], query_cost.CostEstimate(**result['cost']) if result['cost'] else None)
+    return result['response']
 
 # Header
 st.title("🔍 Advanced Text-to-SQL Engine")
@@ -420,6 +172,85 @@ with st.sidebar:
         execution_times = [q.get('execution_time', 0) for q in st.session_state.query_history]
         avg_time = sum(execution_times) / len(execution_times) if execution_times else 0
         st.metric("Avg Execution Time", f"{avg_time:.3f}s")
+    
+    pool_stats = database.get_pool_stats()
+    if pool_stats:
+        st.metric("DB Connections", f"{pool_stats['in_use']}/{pool_stats['size']}",
+                  help=f"{pool_stats['open']} open, {pool_stats['waits']} waits")
+        st.metric("Avg Pool Wait", f"{pool_stats['avg_wait_ms']:.1f} ms")
+    
+    embedding_stats = retrieval.get_embedding_stats()
+    if embedding_stats['model_loaded']:
+        cache_stats = embedding_stats['cache']
+        st.metric("Embedding Cache Hit Rate", f"{cache_stats['hit_rate']:.0%}",
+                  help=f"{cache_stats['hits']} hits, {cache_stats['misses']} misses, {cache_stats['entries']} entries")
+        st.caption(f"🧠 Embedding model loaded in {embedding_stats['model_load_seconds']:.1f}s")
+    
+    answer_stats = answer_cache.get_stats()
+    if answer_stats:
+        st.metric("Answer Cache Hit Rate", f"{answer_stats['hit_rate']:.0%}",
+                  help=f"{answer_stats['exact_hits']} exact, {answer_stats['semantic_hits']} near-duplicate, "
+                       f"{answer_stats['misses']} misses, {answer_stats['entries']} entries")
+    
+    result_stats = result_cache.get_stats()
+    if result_stats and (result_stats['memory_hits'] + result_stats['disk_hits'] + result_stats['misses']):
+        st.metric("Result Cache Hit Rate", f"{result_stats['hit_rate']:.0%}",
+                  help=f"{result_stats['entries']} results, {result_stats['memory_mb']:.1f} / "
+                       f"{result_stats['max_memory_mb']:.0f} MB, {result_stats['spilled']} spilled to disk")
+    
+    client_stats = clients.get_client_stats()
+    if client_stats['calls']:
+        st.caption(f"🔌 Remote calls: {client_stats['calls']} ({client_stats['retries']} retries, "
+                   f"{client_stats['failures']} failed)")
+    
+    trace_summary = tracing.get_summary()
+    if trace_summary['stages']:
+        st.caption("⏱️ Stage latency (recent questions)")
+        stage_order = list(engine.STAGES) + ['question']
+        st.dataframe(
+            [
+                {'Stage': stage, 'p50 ms': round(stats['p50_ms'], 1), 'p95 ms': round(stats['p95_ms'], 1),
+                 'Runs': stats['count']}
+                for stage, stats in sorted(trace_summary['stages'].items(),
+                                           key=lambda item: stage_order.index(item[0]) if item[0] in stage_order else len(stage_order))
+            ],
+            hide_index=True,
+            use_container_width=True
+        )
+        totals = trace_summary['totals']
+        if totals.get('prompt_tokens') or totals.get('completion_tokens'):
+            st.caption(f"🔤 Tokens: {totals.get('prompt_tokens', 0):,} prompt + "
+                       f"{totals.get('completion_tokens', 0):,} completion")
+    
+    st.divider()
+    
+    st.subheader("🛠️ Index Advisor")
+    workload_stats = workload.get_stats()
+    if not workload_stats or not workload_stats['queries']:
+        st.info("Run some queries first - the advisor replays the executed workload")
+    else:
+        st.caption(f"{workload_stats['queries']} distinct queries, {workload_stats['executions']} executions logged")
+        if st.button("🔎 Analyze Workload", use_container_width=True):
+            with st.spinner("⏳ Replaying the workload on a scratch copy..."):
+                st.session_state.index_advice = index_advisor.advise()
+        if st.session_state.get('index_advice'):
+            recommendations, advice_summary = st.session_state.index_advice
+            if not recommendations:
+                st.success("✓ No index worth adding")
+            else:
+                for recommendation in recommendations:
+                    st.code(recommendation.sql, language="sql")
+                    st.caption(f"{recommendation.gain:.0%} faster on {recommendation.queries} queries, "
+                               f"{recommendation.size_kb} KB - {'; '.join(recommendation.reasons)}")
+                st.caption(f"Workload: {advice_summary['baseline_ms']:.1f} → {advice_summary['advised_ms']:.1f} ms")
+                if st.button("✅ Apply Indexes", use_container_width=True):
+                    with st.spinner("⏳ Rebuilding tables with the new indexes..."):
+                        rebuilt, error = index_advisor.apply_recommendations(recommendations)
+                    if error:
+                        st.error(f"❌ {error}")
+                    else:
+                        st.session_state.index_advice = None
+                        st.success(f"✓ Applied; rebuilt {', '.join(rebuilt) or 'nothing'}")
 
 # Main tabs
 tab1, tab2, tab3, tab4 = st.tabs(["🚀 Query Builder", "📊 Visualizations", "📝 History", "💬 Feedback"])
@@ -450,14 +281,17 @@ with tab1:
                     st.session_state.schema = schema
                 
                 result = generate_sql_with_validation(user_input, st.session_state.schema)
-                st.session_state.generated_sql = result['sql']
-                st.session_state.query_metadata = {
-                    'complexity': result['complexity'],
-                    'estimated_rows': result['estimated_rows'],
-                    'notes': result['notes']
-                }
-                
-                st.success("✓ SQL generated!")
+                # None: a configuration error was already shown
+                if result is not None:
+                    st.session_state.generated_sql = result['sql']
+                    st.session_state.query_metadata = {
+                        'notes': result['notes']
+                    }
+
+                    if st.session_state.get('answer_cache_hit'):
+                        st.success(f"⚡ SQL served from answer cache ({st.session_state.answer_cache_hit} match)")
+                    else:
+                        st.success("✓ SQL generated!")
                 
             except Exception as e:
                 st.error(f"❌ Error: {str(e)}")
@@ -466,21 +300,30 @@ with tab1:
     if 'generated_sql' in st.session_state:
         st.divider()
         
-        # Metadata cards
+        # Planner cost estimate (EXPLAIN QUERY PLAN + table statistics)
+        estimate = get_cost_estimate(st.session_state.generated_sql)
         col1, col2, col3 = st.columns(3)
         with col1:
-            st.metric("Complexity", st.session_state.query_metadata.get('complexity', 'Unknown'))
+            st.metric("Cost", estimate.cost_class if estimate else "Unknown")
         with col2:
-            st.metric("Est. Rows", st.session_state.query_metadata.get('estimated_rows', '?'))
+            st.metric("Est. Rows Scanned", f"{estimate.rows_scanned:,}" if estimate else "?")
         with col3:
-            st.metric("Status", "Ready")
+            st.metric("Full Scans", len(estimate.full_scans) if estimate else "?")
+        if estimate:
+            with st.expander("🧭 Query plan"):
+                st.code("\n".join(estimate.plan), language="text")
+                st.caption(query_cost.describe(estimate))
         
         # SQL Display
         st.subheader("Generated SQL")
         st.code(st.session_state.generated_sql, language="sql")
         
-        # Validation
-        is_valid, validation_msg = validate_sql_syntax(st.session_state.generated_sql)
+        # Validation (already done during generation unless the SQL changed since)
+        validation = st.session_state.get('validation')
+        if validation and validation[0] == st.session_state.generated_sql:
+            _, is_valid, validation_msg = validation
+        else:
+            is_valid, validation_msg = validate_sql_syntax(st.session_state.generated_sql)
         if is_valid:
             st.markdown('<div class="success-box">✓ SQL syntax valid</div>', unsafe_allow_html=True)
         else:
@@ -490,27 +333,35 @@ with tab1:
         if st.session_state.query_metadata.get('notes'):
             st.info(f"💡 {st.session_state.query_metadata['notes']}")
         
-        # Execute button
-        if st.button("▶️ Execute Query", use_container_width=True, type="primary"):
+        if st.session_state.pop('query_cancelled', False):
+            st.warning("⏹️ Query cancelled")
+        
+        # Execute button (held while an expensive query is unconfirmed)
+        cost_ok = confirm_cost(st.session_state.generated_sql, estimate)
+        if st.button("▶️ Execute Query", use_container_width=True, type="primary", disabled=not cost_ok):
             with st.spinner("⏳ Executing..."):
-                df_result, error, exec_time = execute_sql_query(st.session_state.generated_sql)
+                result, error, exec_time = execute_sql_query(st.session_state.generated_sql)
                 
                 if error:
                     st.error(f"❌ {error}")
                 else:
-                    st.session_state.last_result = df_result
+                    set_last_result(result)
                     st.session_state.last_exec_time = exec_time
                     
                     st.session_state.query_history.append({
                         'timestamp': datetime.now(),
                         'query': user_input,
                         'sql': st.session_state.generated_sql,
-                        'rows': len(df_result),
+                        'rows': result.total_rows if result.exhausted else result.fetched_rows,
                         'execution_time': exec_time,
-                        'complexity': st.session_state.query_metadata.get('complexity')
+                        'complexity': estimate.cost_class if estimate else None,
+                        'cache_hit': st.session_state.result_cache_hit
                     })
                     
-                    st.success(f"✓ Success ({len(df_result)} rows, {exec_time:.3f}s)")
+                    if st.session_state.result_cache_hit:
+                        st.success(f"♻️ Served from result cache ({row_count_label(result)} rows, {exec_time:.3f}s)")
+                    else:
+                        st.success(f"✓ Success ({row_count_label(result)} rows, {exec_time:.3f}s)")
         
         st.divider()
     
@@ -520,26 +371,24 @@ with tab1:
         
         result_col1, result_col2 = st.columns([3, 1])
         with result_col1:
-            st.dataframe(st.session_state.last_result, use_container_width=True)
+            render_result_page(st.session_state.last_result)
         
         with result_col2:
             st.write("")
-            csv = st.session_state.last_result.to_csv(index=False)
-            st.download_button(
-                label="⬇️ Download CSV",
-                data=csv,
-                file_name="results.csv",
-                mime="text/csv",
-                use_container_width=True
-            )
+            render_export(st.session_state.last_result, "results")
 
 with tab2:
     st.subheader("Query Results Visualization")
     
     if 'last_result' in st.session_state:
-        fig = create_visualizations(st.session_state.last_result)
+        result = st.session_state.last_result
+        fig, note = visualization.figure_for(result)
+        if result.truncated:
+            st.caption(f"📊 Charting the first {result.fetched_rows:,} rows (result truncated)")
         if fig:
             st.pyplot(fig)
+            if note:
+                st.caption(f"ℹ️ {note}")
         else:
             st.info("💡 Visualization unavailable for this data type")
     else:
@@ -560,6 +409,10 @@ with tab3:
             total_time = sum(q['execution_time'] for q in st.session_state.query_history)
             st.metric("Total Execution Time", f"{total_time:.2f}s")
         
+        cache_hits = sum(1 for q in st.session_state.query_history if q.get('cache_hit'))
+        if cache_hits:
+            st.caption(f"♻️ {cache_hits} of {len(st.session_state.query_history)} results served from the result cache")
+        
         st.divider()
         
         # Query details
@@ -567,7 +420,10 @@ with tab3:
             with st.expander(f"#{i} - {query['query'][:50]}..."):
                 col1, col2, col3 = st.columns(3)
                 with col1:
-                    st.caption(f"⏱️ {query['execution_time']:.3f}s")
+                    if query.get('cache_hit'):
+                        st.caption(f"⏱️ {query['execution_time']:.3f}s ♻️ cached")
+                    else:
+                        st.caption(f"⏱️ {query['execution_time']:.3f}s")
                 with col2:
                     st.caption(f"📊 {query['rows']} rows")
                 with col3:
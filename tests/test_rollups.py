@@ -0,0 +1,99 @@
+"""
+Rollup rewrites must return exactly what the original query returns
+Each rewritten statement runs next to its original on a database built from
+the bundled CSVs; statements a rollup cannot answer exactly must be left alone.
+"""
+
+import sqlite3
+
+import pytest
+
+import loader
+import rollups
+
+REWRITTEN = [
+    # Revenue by store
+    "SELECT s.store_name, SUM(oi.quantity * oi.list_price * (1 - oi.discount)) AS revenue "
+    "FROM orders o JOIN order_items oi ON o.order_id = oi.order_id JOIN stores s ON o.store_id = s.store_id "
+    "GROUP BY s.store_name ORDER BY revenue DESC",
+    # Top products
+    "SELECT p.product_name, SUM(oi.quantity) AS total_sold FROM order_items oi "
+    "JOIN products p ON oi.product_id = p.product_id GROUP BY p.product_name ORDER BY total_sold DESC, p.product_name",
+    # Sales by brand and category
+    "SELECT b.brand_name, SUM(oi.quantity * oi.list_price) AS sales FROM order_items oi "
+    "JOIN products p ON oi.product_id = p.product_id JOIN brands b ON p.brand_id = b.brand_id GROUP BY b.brand_name",
+    "SELECT c.category_name, ROUND(SUM(oi.list_price * oi.quantity * (1 - oi.discount)), 2) AS revenue, "
+    "COUNT(*) AS lines FROM order_items oi JOIN products p ON p.product_id = oi.product_id "
+    "JOIN categories c ON c.category_id = p.category_id GROUP BY c.category_name ORDER BY revenue DESC",
+    # Monthly revenue and order counts
+    "SELECT strftime('%Y-%m', o.order_date) AS month, SUM(oi.quantity * oi.list_price * (1 - oi.discount)) AS revenue, "
+    "COUNT(DISTINCT o.order_id) AS orders FROM orders o JOIN order_items oi ON o.order_id = oi.order_id "
+    "GROUP BY month ORDER BY month",
+    # Staff performance, facts joined onto the dimension
+    "SELECT st.first_name, st.last_name, COUNT(DISTINCT o.order_id) AS orders, "
+    "SUM(oi.quantity * oi.list_price * (1 - oi.discount)) AS revenue FROM staffs st "
+    "JOIN orders o ON o.staff_id = st.staff_id JOIN order_items oi ON oi.order_id = o.order_id "
+    "GROUP BY st.staff_id ORDER BY revenue DESC",
+    "SELECT SUM(quantity * list_price * (1 - discount)) FROM order_items",
+    "SELECT COUNT(*) FROM order_items",
+    "SELECT AVG(oi.discount) FROM order_items oi",
+    "SELECT p.product_name, SUM(oi.quantity) q FROM orders o JOIN order_items oi ON oi.order_id = o.order_id "
+    "JOIN products p ON p.product_id = oi.product_id WHERE o.order_date BETWEEN '2017-01-01' AND '2017-12-31' "
+    "GROUP BY p.product_name HAVING SUM(oi.quantity) > 10 ORDER BY q DESC, p.product_name",
+    "SELECT SUM(oi.quantity) * 1.0 / COUNT(DISTINCT o.order_id) AS avg_items FROM orders o "
+    "INNER JOIN order_items oi ON oi.order_id = o.order_id WHERE o.store_id = 2;",
+    "SELECT o.store_id, MIN(o.order_date), MAX(o.order_date), SUM(oi.list_price) / COUNT(*) FROM orders o "
+    "JOIN order_items oi ON oi.order_id = o.order_id GROUP BY 1",
+]
+
+UNCHANGED = [
+    # Joining staffs on store_id repeats every order once per staff member of the store
+    "SELECT s.store_name, COUNT(DISTINCT o.order_id) FROM orders o JOIN order_items oi ON oi.order_id = o.order_id "
+    "JOIN stores s ON s.store_id = o.store_id JOIN staffs st ON st.store_id = s.store_id GROUP BY s.store_name",
+    # Not the revenue measure: * binds tighter than -
+    "SELECT SUM(oi.quantity * oi.list_price * 1 - oi.discount) FROM order_items oi",
+    "SELECT s.store_name, SUM(oi.quantity) FROM stores s LEFT JOIN orders o ON o.store_id = s.store_id "
+    "JOIN order_items oi ON oi.order_id = o.order_id GROUP BY s.store_name",
+    "SELECT o.customer_id, SUM(oi.quantity) FROM orders o JOIN order_items oi ON oi.order_id = o.order_id "
+    "GROUP BY o.customer_id",
+    "SELECT oi.product_id, SUM(oi.quantity) FROM order_items oi JOIN stocks sk ON sk.product_id = oi.product_id "
+    "GROUP BY oi.product_id",
+    "SELECT SUM(oi.quantity), SUM(p.list_price) FROM order_items oi JOIN products p ON p.product_id = oi.product_id",
+    "SELECT SUM(oi.quantity) AS quantity FROM order_items oi ORDER BY quantity",
+    "SELECT SUM(oi.quantity) FROM order_items oi WHERE oi.product_id IN (SELECT product_id FROM products)",
+    "SELECT o.store_id, SUM(oi.quantity) FROM orders o JOIN order_items oi ON oi.order_id = o.order_id "
+    "WHERE o.order_status = 4 GROUP BY 1",
+    "SELECT * FROM order_items LIMIT 5",
+]
+
+
+@pytest.fixture(scope="module")
+def database(tmp_path_factory):
+    db_path = tmp_path_factory.mktemp("rollups") / "bike_shop.db"
+    loader.refresh_database(db_path)
+    conn = sqlite3.connect(db_path)
+    row_counts = dict(conn.execute(f"SELECT name, rows FROM {rollups.STATE_TABLE}").fetchall())
+    yield conn, row_counts
+    conn.close()
+
+
+def _rows(conn, sql, ordered):
+    rows = [tuple(round(value, 6) if isinstance(value, float) else value for value in row)
+            for row in conn.execute(sql).fetchall()]
+    return rows if ordered else sorted(rows, key=repr)
+
+
+@pytest.mark.parametrize("sql", REWRITTEN)
+def test_rewrite_returns_the_original_rows(database, sql):
+    conn, row_counts = database
+    rewritten, rollup = rollups.rewrite_sql(sql, row_counts)
+    assert rollup is not None, "expected a rollup rewrite"
+    assert rollup in rewritten
+    ordered = "ORDER BY" in sql
+    assert _rows(conn, rewritten, ordered) == _rows(conn, sql, ordered)
+
+
+@pytest.mark.parametrize("sql", UNCHANGED)
+def test_statement_a_rollup_cannot_answer_is_unchanged(database, sql):
+    conn, row_counts = database
+    assert rollups.rewrite_sql(sql, row_counts) == (sql, None)
@@ -0,0 +1,296 @@
+"""
+Per-stage tracing and metrics
+Every pipeline stage runs inside a span (engine.run_stage and the streaming path
+open them). Code running inside a stage adds facts with annotate(), such as
+token counts, cache hits and row counts, without needing to know which stage it
+is in; the current span follows the work into worker threads and asyncio tasks
+through contextvars.
+
+Finished spans go to three places:
+- in-memory stage statistics (get_summary, shown in the advanced app's sidebar)
+- a JSON-lines file, when TRACE_FILE is set
+- a Prometheus text endpoint at http://METRICS_HOST:METRICS_PORT/metrics, when
+  METRICS_PORT is set (start_metrics_server)
+"""
+
+import contextvars
+import json
+import logging
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+from config import get_int_setting, get_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_WINDOW = 1000
+DEFAULT_METRICS_HOST = "127.0.0.1"
+METRIC_PREFIX = "text2sql"
+
+# Upper bounds (seconds) of the Prometheus latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+# Numeric span attributes summed into counters
+COUNTED_ATTRIBUTES = ("prompt_tokens", "completion_tokens", "rows", "rows_estimated")
+# Span attributes whose values are counted (cache hit kinds, validation outcome, ...)
+FLAG_ATTRIBUTES = ("cache_hit", "embedding_cache_hit", "result_cache", "valid", "truncated", "cost_class",
+                   "rollup")
+
+_current = contextvars.ContextVar("tracing_span", default=None)
+
+_metrics = None
+_metrics_lock = threading.Lock()
+_trace_file = None
+_trace_file_lock = threading.Lock()
+_server = None
+_server_lock = threading.Lock()
+
+
+class Span:
+    """One timed stage; trace_id is shared by every span of the same question"""
+
+    def __init__(self, name, parent=None, attributes=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent is not None else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent is not None else None
+        self.attributes = dict(attributes or {})
+        self.start = time.time()
+        self.duration_ms = None
+        self.error = None
+
+    def to_dict(self):
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start": self.start,
+            "duration_ms": self.duration_ms,
+            "error": self.error,
+            "attributes": self.attributes
+        }
+
+
+class Metrics:
+    """Aggregates of finished spans: counts, latency histograms, recent samples and attribute totals"""
+
+    def __init__(self, window=DEFAULT_WINDOW):
+        self.window = max(1, window)
+        self._lock = threading.Lock()
+        self._recent = {}    # stage -> deque of recent durations (ms)
+        self._count = {}
+        self._errors = {}
+        self._sum_ms = {}
+        self._buckets = {}   # stage -> cumulative-able counts per LATENCY_BUCKETS bound
+        self._totals = {}    # (stage, attribute) -> sum
+        self._flags = {}     # (stage, attribute, value) -> count
+
+    def record(self, span):
+        name, ms = span.name, span.duration_ms
+        with self._lock:
+            if name not in self._count:
+                self._recent[name] = deque(maxlen=self.window)
+                self._count[name] = self._errors[name] = 0
+                self._sum_ms[name] = 0.0
+                self._buckets[name] = [0] * len(LATENCY_BUCKETS)
+            self._recent[name].append(ms)
+            self._count[name] += 1
+            self._sum_ms[name] += ms
+            if span.error:
+                self._errors[name] += 1
+            for i, bound in enumerate(LATENCY_BUCKETS):
+                if ms <= bound * 1000:
+                    self._buckets[name][i] += 1
+                    break
+            for attribute in COUNTED_ATTRIBUTES:
+                value = span.attributes.get(attribute)
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    self._totals[(name, attribute)] = self._totals.get((name, attribute), 0) + value
+            for attribute in FLAG_ATTRIBUTES:
+                if attribute in span.attributes:
+                    key = (name, attribute, _label(span.attributes[attribute]))
+                    self._flags[key] = self._flags.get(key, 0) + 1
+
+    def summary(self):
+        """{"stages": {stage: {"count", "errors", "p50_ms", "p95_ms", "mean_ms"}}, "totals", "flags"}"""
+        with self._lock:
+            stages = {}
+            for name, recent in self._recent.items():
+                values = np.asarray(recent, dtype=float)
+                stages[name] = {
+                    "count": self._count[name],
+                    "errors": self._errors[name],
+                    "p50_ms": float(np.percentile(values, 50)),
+                    "p95_ms": float(np.percentile(values, 95)),
+                    "mean_ms": self._sum_ms[name] / self._count[name]
+                }
+            totals = {}
+            for (name, attribute), value in self._totals.items():
+                totals[attribute] = totals.get(attribute, 0) + value
+            flags = {}
+            for (name, attribute, value), count in self._flags.items():
+                flags.setdefault(attribute, {})
+                flags[attribute][value] = flags[attribute].get(value, 0) + count
+            return {"stages": stages, "totals": totals, "flags": flags}
+
+    def prometheus(self):
+        """Metrics in the Prometheus text exposition format"""
+        lines = [
+            f"# HELP {METRIC_PREFIX}_stage_duration_seconds Pipeline stage latency",
+            f"# TYPE {METRIC_PREFIX}_stage_duration_seconds histogram"
+        ]
+        with self._lock:
+            for name in sorted(self._count):
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS, self._buckets[name]):
+                    cumulative += count
+                    lines.append(f'{METRIC_PREFIX}_stage_duration_seconds_bucket{{stage="{name}",le="{bound}"}} {cumulative}')
+                lines.append(f'{METRIC_PREFIX}_stage_duration_seconds_bucket{{stage="{name}",le="+Inf"}} {self._count[name]}')
+                lines.append(f'{METRIC_PREFIX}_stage_duration_seconds_sum{{stage="{name}"}} {self._sum_ms[name] / 1000:.6f}')
+                lines.append(f'{METRIC_PREFIX}_stage_duration_seconds_count{{stage="{name}"}} {self._count[name]}')
+
+            lines.append(f"# HELP {METRIC_PREFIX}_stage_errors_total Stages that raised")
+            lines.append(f"# TYPE {METRIC_PREFIX}_stage_errors_total counter")
+            for name in sorted(self._errors):
+                lines.append(f'{METRIC_PREFIX}_stage_errors_total{{stage="{name}"}} {self._errors[name]}')
+
+            for attribute in COUNTED_ATTRIBUTES:
+                lines.append(f"# TYPE {METRIC_PREFIX}_{attribute}_total counter")
+                for (name, counted), value in sorted(self._totals.items()):
+                    if counted == attribute:
+                        lines.append(f'{METRIC_PREFIX}_{attribute}_total{{stage="{name}"}} {value}')
+
+            lines.append(f"# HELP {METRIC_PREFIX}_stage_events_total Span attribute values (cache hits, validation)")
+            lines.append(f"# TYPE {METRIC_PREFIX}_stage_events_total counter")
+            for (name, attribute, value), count in sorted(self._flags.items()):
+                lines.append(f'{METRIC_PREFIX}_stage_events_total{{stage="{name}",attribute="{attribute}",'
+                             f'value="{value}"}} {count}')
+        return "\n".join(lines) + "\n"
+
+
+def _label(value):
+    if value is None:
+        return "none"
+    if isinstance(value, bool):
+        return "true" if value else "false"
+    return str(value).replace("\\", "\\\\").replace('"', '\\"')
+
+
+def get_metrics():
+    """Process-wide span aggregates"""
+    global _metrics
+    if _metrics is None:
+        with _metrics_lock:
+            if _metrics is None:
+                _metrics = Metrics(get_int_setting("TRACE_WINDOW", DEFAULT_WINDOW))
+    return _metrics
+
+
+def _write_span(span):
+    """Append a span to TRACE_FILE (if set) as one JSON line"""
+    global _trace_file
+    path = get_setting("TRACE_FILE")
+    if not path:
+        return
+    try:
+        with _trace_file_lock:
+            if _trace_file is None or _trace_file.name != str(path):
+                if _trace_file is not None:
+                    _trace_file.close()
+                _trace_file = open(path, "a", encoding="utf-8", buffering=1)
+            _trace_file.write(json.dumps(span.to_dict(), default=str) + "\n")
+    except OSError as e:
+        logger.warning("Could not write trace to %s: %s", path, e)
+
+
+@contextmanager
+def span(name, **attributes):
+    """Time a block as a stage span, nested under the current span (if any)"""
+    current = Span(name, _current.get(), attributes)
+    token = _current.set(current)
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        current.error = type(e).__name__
+        raise
+    finally:
+        current.duration_ms = round((time.perf_counter() - start) * 1000, 3)
+        try:
+            _current.reset(token)
+        except ValueError:
+            pass  # a streaming generator closed from another context (e.g. by the garbage collector)
+        get_metrics().record(current)
+        _write_span(current)
+
+
+def annotate(**attributes):
+    """Add attributes to the current span (no-op outside one)"""
+    current = _current.get()
+    if current is not None:
+        current.attributes.update(attributes)
+
+
+def current_span():
+    """The innermost open span of this context, or None"""
+    return _current.get()
+
+
+@contextmanager
+def use_span(parent):
+    """Make parent the current span, e.g. in an asyncio task started on another thread's behalf"""
+    token = _current.set(parent)
+    try:
+        yield parent
+    finally:
+        _current.reset(token)
+
+
+def get_summary():
+    """Recent per-stage latency, token totals and cache / validation counts"""
+    return get_metrics().summary()
+
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = get_metrics().prometheus().encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # scrapes are not worth a log line each
+
+
+def start_metrics_server():
+    """
+    Serve /metrics on METRICS_PORT in a daemon thread (once per process)
+    Returns the bound port, or None when METRICS_PORT is unset / 0 or the port is taken.
+    """
+    global _server
+    port = get_int_setting("METRICS_PORT", 0)
+    if port <= 0:
+        return None
+    with _server_lock:
+        if _server is None:
+            host = get_setting("METRICS_HOST", DEFAULT_METRICS_HOST)
+            try:
+                _server = ThreadingHTTPServer((host, port), _MetricsHandler)
+            except OSError as e:
+                logger.warning("Metrics endpoint unavailable on %s:%s: %s", host, port, e)
+                return None
+            _server.daemon_threads = True
+            threading.Thread(target=_server.serve_forever, name="metrics-server", daemon=True).start()
+    return _server.server_address[1]
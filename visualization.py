@@ -0,0 +1,264 @@
+"""
+Chart selection and data reduction for query results
+The chart type is picked from the column dtypes, and the data is reduced to a
+bounded number of points before anything is plotted:
+- category + measure: bar of the top VIZ_MAX_CATEGORIES, the rest summed as "Other"
+- date + measure: line, averaged into at most VIZ_MAX_POINTS time buckets
+- measure + measure: scatter, or mean per x bin once over VIZ_MAX_POINTS rows
+- single measure: histogram with VIZ_BINS bins
+- categories only: bar of the most frequent values
+Charts cover every row of the result: the data is folded over the paged
+result chunk by chunk, and only the number of plotted points is capped.
+Rendered figures are cached per result id, so reruns of the visualization tab
+reuse them.
+"""
+
+import re
+import threading
+from collections import OrderedDict, namedtuple
+
+import numpy as np
+import pandas as pd
+
+from config import get_int_setting
+
+DEFAULT_MAX_CATEGORIES = 20
+DEFAULT_MAX_POINTS = 2000
+DEFAULT_BINS = 30
+DEFAULT_FIGURE_CACHE_SIZE = 16
+
+OTHER_LABEL = "Other"
+
+ISO_DATE = re.compile(r"^\d{4}-\d{2}-\d{2}")
+
+ChartSpec = namedtuple("ChartSpec", ["kind", "data", "x_label", "y_label", "title", "note"])
+
+_figures = OrderedDict()  # result_id -> (Figure, note)
+_figures_lock = threading.Lock()
+
+
+def _is_identifier(name):
+    name = str(name).lower()
+    return name == "id" or name.endswith("_id")
+
+
+def _as_datetime(series):
+    """The column as datetimes, or None (SQLite returns dates as ISO strings)"""
+    if pd.api.types.is_datetime64_any_dtype(series):
+        return series
+    if not (pd.api.types.is_object_dtype(series) or pd.api.types.is_string_dtype(series)):
+        return None
+    sample = series.dropna().head(50)
+    if sample.empty or not all(isinstance(v, str) and ISO_DATE.match(v) for v in sample):
+        return None
+    return pd.to_datetime(series, errors="coerce")
+
+
+def classify_columns(df):
+    """(measure, category, date) column names; *_id numbers count as categories"""
+    measures, categories, dates = [], [], []
+    for col in df.columns:
+        series = df[col]
+        if pd.api.types.is_bool_dtype(series):
+            categories.append(col)
+        elif pd.api.types.is_numeric_dtype(series):
+            (categories if _is_identifier(col) else measures).append(col)
+        elif _as_datetime(series) is not None:
+            dates.append(col)
+        else:
+            categories.append(col)
+    return measures, categories, dates
+
+
+def _finite(series):
+    """A column as numbers, with ±inf (e.g. a ratio divided by zero) treated as missing"""
+    return pd.to_numeric(series, errors="coerce").replace([np.inf, -np.inf], np.nan)
+
+
+def _add(total, part):
+    """Running per-key sum of chunk aggregates"""
+    return part if total is None else total.add(part, fill_value=0)
+
+
+def top_categories(values, max_categories):
+    """Largest max_categories entries of a Series indexed by category, the rest summed as "Other\""""
+    values = values.sort_values(ascending=False)
+    if len(values) <= max_categories:
+        return values, None
+    top = values.iloc[:max_categories - 1]
+    other = pd.Series([values.iloc[max_categories - 1:].sum()], index=[OTHER_LABEL])
+    note = f"Top {max_categories - 1} of {len(values):,} categories; the rest are grouped as \"{OTHER_LABEL}\""
+    return pd.concat([top, other]), note
+
+
+def _time_series(frames, x, y, max_points):
+    sums = counts = None
+    for df in frames():
+        frame = pd.DataFrame({"x": pd.to_datetime(df[x], errors="coerce"), "y": _finite(df[y])}).dropna()
+        grouped = frame.groupby("x")["y"]
+        sums, counts = _add(sums, grouped.sum()), _add(counts, grouped.count())
+    if sums is None or sums.empty:
+        return None, None
+    sums, counts = sums.sort_index(), counts.sort_index()
+    if len(sums) <= max_points:
+        return sums / counts, None
+    frame = pd.DataFrame({"x": sums.index, "sum": sums.values, "count": counts.values})
+    buckets = pd.cut(frame["x"].astype("int64"), bins=max_points)
+    totals = frame.groupby(buckets, observed=True).agg(x=("x", "min"), sum=("sum", "sum"), count=("count", "sum"))
+    series = pd.Series((totals["sum"] / totals["count"]).values, index=totals["x"].values)
+    return series, f"Averaged into {len(series):,} time buckets from {int(counts.sum()):,} rows"
+
+
+def _finite_range(frames, columns):
+    """(rows, min, max of columns[0], distinct values of it up to 1000) over rows where every column is finite"""
+    rows, low, high, distinct = 0, None, None, set()
+    for df in frames():
+        values = pd.DataFrame({col: _finite(df[col]) for col in columns}).dropna()[columns[0]]
+        if values.empty:
+            continue
+        rows += len(values)
+        low = values.min() if low is None else min(low, values.min())
+        high = values.max() if high is None else max(high, values.max())
+        if len(distinct) <= 1000:
+            distinct.update(values.unique()[:1001])
+    return rows, low, high, len(distinct)
+
+
+def _binned(frames, x, y, edges):
+    sums = counts = None
+    rows = 0
+    for df in frames():
+        frame = pd.DataFrame({"x": _finite(df[x]), "y": _finite(df[y])}).dropna()
+        rows += len(frame)
+        grouped = frame.groupby(pd.cut(frame["x"], bins=edges, include_lowest=True), observed=True)["y"]
+        sums, counts = _add(sums, grouped.sum()), _add(counts, grouped.count())
+    series = (sums / counts).sort_index()
+    series.index = [interval.mid for interval in series.index]
+    return series, f"Mean per x bin ({len(series)} bins) over {rows:,} rows"
+
+
+def plan_chart(frames):
+    """
+    ChartSpec describing a bounded-size chart for a result, or None
+    frames() returns an iterator of DataFrames covering the whole result. The
+    chart is folded over them chunk by chunk (twice where bins need the value
+    range first), so every row counts and no DataFrame of the whole result is
+    built. The rows themselves stay wherever frames() reads them from.
+    """
+    first = next(iter(frames()), None)
+    if first is None or len(first) == 0:
+        return None
+    max_categories = max(2, get_int_setting("VIZ_MAX_CATEGORIES", DEFAULT_MAX_CATEGORIES))
+    max_points = max(10, get_int_setting("VIZ_MAX_POINTS", DEFAULT_MAX_POINTS))
+    bins = max(2, get_int_setting("VIZ_BINS", DEFAULT_BINS))
+    measures, categories, dates = classify_columns(first)
+
+    if measures and dates:
+        x, y = dates[0], measures[0]
+        series, note = _time_series(frames, x, y, max_points)
+        if series is None:
+            return None
+        return ChartSpec("line", series, x, y, f"{y} over {x}", note)
+
+    if measures and categories:
+        x, y = categories[0], measures[0]
+        grouped, rows = None, 0
+        for df in frames():
+            rows += len(df)
+            grouped = _add(grouped, _finite(df[y]).groupby(df[x].astype(str)).sum())
+        label = f"{y} by {x}" if len(grouped) == rows else f"Total {y} by {x}"
+        series, note = top_categories(grouped, max_categories)
+        return ChartSpec("bar", series, x, y, label, note)
+
+    if len(measures) >= 2:
+        x, y = measures[0], measures[1]
+        rows, low, high, _ = _finite_range(frames, [x, y])
+        if not rows:
+            return None
+        if rows <= max_points:
+            points = pd.concat([pd.DataFrame({x: _finite(df[x]), y: _finite(df[y])}).dropna() for df in frames()])
+            return ChartSpec("scatter", points, x, y, f"{y} vs {x}", None)
+        edges = np.histogram_bin_edges(np.array([low, high]), bins=bins * 2)
+        series, note = _binned(frames, x, y, edges)
+        return ChartSpec("bar", series, x, f"mean {y}", f"{y} vs {x}", note)
+
+    if measures:
+        x = measures[0]
+        rows, low, high, distinct = _finite_range(frames, [x])
+        if not rows:
+            return None
+        edges = np.histogram_bin_edges(np.array([low, high]), bins=min(bins, max(1, distinct)))
+        counts = np.zeros(len(edges) - 1, dtype=int)
+        for df in frames():
+            counts += np.histogram(_finite(df[x]).dropna(), bins=edges)[0]
+        return ChartSpec("histogram", (counts, edges), x, "count", f"Distribution of {x}", None)
+
+    if categories:
+        x = categories[0]
+        counts = None
+        for df in frames():
+            counts = _add(counts, df[x].astype(str).value_counts())
+        series, note = top_categories(counts, max_categories)
+        return ChartSpec("bar", series, x, "count", f"Rows per {x}", note)
+
+    return None
+
+
+def render_chart(spec):
+    """Matplotlib Figure for a ChartSpec (no pyplot global state)"""
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(10, 5))
+    ax = fig.subplots()
+    if spec.kind == "line":
+        ax.plot(spec.data.index, spec.data.values)
+        fig.autofmt_xdate()
+    elif spec.kind == "scatter":
+        ax.scatter(spec.data.iloc[:, 0], spec.data.iloc[:, 1], s=12, alpha=0.6)
+    elif spec.kind == "histogram":
+        counts, edges = spec.data
+        ax.bar(edges[:-1], counts, width=np.diff(edges), align="edge")
+    elif pd.api.types.is_numeric_dtype(spec.data.index):
+        # Binned measure: bars centred on the bin midpoints
+        width = np.diff(spec.data.index).min() * 0.9 if len(spec.data) > 1 else 0.8
+        ax.bar(spec.data.index, spec.data.values, width=width)
+    else:
+        labels = [str(label) for label in spec.data.index]
+        ax.bar(range(len(labels)), spec.data.values)
+        ax.set_xticks(range(len(labels)))
+        ax.set_xticklabels(labels, rotation=45, ha="right")
+    ax.set_xlabel(spec.x_label)
+    ax.set_ylabel(spec.y_label)
+    ax.set_title(spec.title)
+    fig.tight_layout()
+    return fig
+
+
+def figure_for(result):
+    """
+    (Figure, note) for a whole paged result, cached per result id
+    Fetches the rows not paged through yet into the result, which keeps every
+    row it fetches (up to QUERY_MAX_ROWS) so its pages stay browsable - charting
+    therefore holds the whole result in memory. Returns (None, None) when the
+    data has nothing to chart.
+    """
+    key = result.result_id
+    with _figures_lock:
+        if key in _figures:
+            _figures.move_to_end(key)
+            return _figures[key]
+
+    spec = plan_chart(result.iter_frames)
+    entry = (render_chart(spec), spec.note) if spec is not None else (None, None)
+
+    with _figures_lock:
+        _figures[key] = entry
+        while len(_figures) > max(1, get_int_setting("VIZ_FIGURE_CACHE_SIZE", DEFAULT_FIGURE_CACHE_SIZE)):
+            _figures.popitem(last=False)
+    return entry
+
+
+def discard(result_id):
+    """Drop cached figures of a result"""
+    with _figures_lock:
+        _figures.pop(result_id, None)
@@ -0,0 +1,135 @@
+"""
+Log of the SQL the apps and the engine actually execute
+Every query that reaches SQLite (result-cache hits do not) is counted under
+its canonical text in a local SQLite file, with its execution count and time.
+The index advisor replays the heaviest entries, so index choices follow the
+questions analysts really ask. WORKLOAD_MAX_QUERIES bounds the log; the least
+recently run queries are dropped first.
+"""
+
+import logging
+import sqlite3
+import threading
+import time
+from collections import namedtuple
+from pathlib import Path
+
+import result_cache
+from config import get_int_setting, get_setting
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LOG_PATH = Path(__file__).parent / "workload.db"
+DEFAULT_MAX_QUERIES = 1000
+
+WorkloadQuery = namedtuple("WorkloadQuery", ["sql", "executions", "total_ms", "last_run_at"])
+
+_log = None
+_log_lock = threading.Lock()
+
+
+class WorkloadLog:
+    """SQLite-backed execution counts per canonical SQL statement"""
+
+    def __init__(self, path, max_queries=DEFAULT_MAX_QUERIES):
+        self.path = Path(path)
+        self.max_queries = max(1, max_queries)
+        self._lock = threading.Lock()
+        self._writes = 0
+        self._conn = sqlite3.connect(str(self.path), check_same_thread=False, isolation_level=None, timeout=5)
+        self._conn.execute("PRAGMA journal_mode = WAL")
+        self._conn.execute("PRAGMA synchronous = NORMAL")
+        self._conn.execute("""CREATE TABLE IF NOT EXISTS queries (
+    query_key TEXT PRIMARY KEY,
+    sql TEXT NOT NULL,
+    executions INTEGER NOT NULL,
+    total_ms REAL NOT NULL,
+    last_run_at REAL NOT NULL
+)""")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_queries_last_run ON queries (last_run_at)")
+
+    def record(self, sql, execution_ms):
+        """Count one execution of sql taking execution_ms, pruning the log every 100 writes"""
+        with self._lock:
+            self._conn.execute(
+                """INSERT INTO queries VALUES (?, ?, 1, ?, ?)
+ON CONFLICT(query_key) DO UPDATE SET
+    sql = excluded.sql,
+    executions = executions + 1,
+    total_ms = total_ms + excluded.total_ms,
+    last_run_at = excluded.last_run_at""",
+                (result_cache.canonicalize_sql(sql), sql.strip(), execution_ms, time.time())
+            )
+            self._writes += 1
+            if self._writes % 100 == 0:
+                self._conn.execute(
+                    "DELETE FROM queries WHERE query_key NOT IN "
+                    "(SELECT query_key FROM queries ORDER BY last_run_at DESC LIMIT ?)", (self.max_queries,))
+
+    def top(self, limit):
+        """WorkloadQuery tuples of the limit queries with the most total execution time"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT sql, executions, total_ms, last_run_at FROM queries ORDER BY total_ms DESC LIMIT ?",
+                (limit,)).fetchall()
+        return [WorkloadQuery(*row) for row in rows]
+
+    def clear(self):
+        """Forget every logged query"""
+        with self._lock:
+            self._conn.execute("DELETE FROM queries")
+
+    def stats(self):
+        """{"queries": distinct queries logged, "executions": total executions}"""
+        with self._lock:
+            count, executions = self._conn.execute("SELECT COUNT(*), SUM(executions) FROM queries").fetchone()
+        return {"queries": count, "executions": executions or 0}
+
+
+def is_enabled():
+    """WORKLOAD_LOG_ENABLED setting (default on)"""
+    return str(get_setting("WORKLOAD_LOG_ENABLED", "true")).lower() not in ("0", "false", "no", "off")
+
+
+def get_workload_log():
+    """Process-wide workload log, or None when disabled or the file cannot be opened"""
+    global _log
+    if _log is None and is_enabled():
+        with _log_lock:
+            if _log is None:
+                try:
+                    _log = WorkloadLog(get_setting("WORKLOAD_LOG_PATH", DEFAULT_LOG_PATH),
+                                       max_queries=get_int_setting("WORKLOAD_MAX_QUERIES", DEFAULT_MAX_QUERIES))
+                except sqlite3.Error as e:
+                    logger.warning("Workload log unavailable: %s", e)
+                    return None
+    return _log if is_enabled() else None
+
+
+def record(sql, execution_time):
+    """Count one execution of sql that took execution_time seconds (never raises)"""
+    log = get_workload_log()
+    if log is None or not sql:
+        return
+    try:
+        log.record(sql, execution_time * 1000)
+    except sqlite3.Error as e:
+        logger.warning("Workload log write failed: %s", e)
+
+
+def top_queries(limit=50):
+    """Heaviest logged queries as WorkloadQuery tuples ([] when the log is disabled)"""
+    log = get_workload_log()
+    if log is None:
+        return []
+    try:
+        return log.top(limit)
+    except sqlite3.Error as e:
+        logger.warning("Workload log read failed: %s", e)
+        return []
+
+
+def get_stats():
+    """Logged query and execution counts, or None when disabled"""
+    log = get_workload_log()
+    return log.stats() if log is not None else None